@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+"""
+Performance benchmarks for the Clinical RAG System
+
+Usage:
+  # Compare per-chunk vs batched embedding throughput
+  python benchmark.py embed --chunks 500 --batch-size 64
+  
+  # CLI startup time; exits non-zero if the median exceeds the budget
+  python benchmark.py startup --max-ms 200
+  
+  # Section detection on multi-megabyte notes vs the per-line regex loop
+  python benchmark.py sections --mb 8
+  
+  # End-to-end pipeline throughput against a local mock Ollama server
+  # (no network or GPU with --offline-embedding); save JSON for comparison
+  python benchmark.py --output bench.json e2e --notes 50 --scale 4 --workers 4 --offline-embedding
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_chunks(count: int) -> List[Dict[str, str]]:
+    """Build `count` chunks by cycling through the sample notes"""
+    from chunker import ClinicalNoteChunker
+    from sample_notes import SAMPLE_NOTES
+
+    chunker = ClinicalNoteChunker()
+    base = []
+    for case_name, note in SAMPLE_NOTES.items():
+        base.extend(chunker.process_note(note, patient_id=case_name.upper()))
+
+    return [base[i % len(base)] for i in range(count)]
+
+
+def build_notes(count: int, scale: int = 1) -> List[Dict[str, str]]:
+    """
+    Build `count` synthetic notes from the sample notes
+    
+    Each note repeats its source `scale` times with every content line tagged
+    by note and copy, so no two chunks are identical and notes grow linearly.
+    """
+    from sample_notes import SAMPLE_NOTES
+    
+    sources = list(SAMPLE_NOTES.values())
+    notes = []
+    for i in range(count):
+        lines = sources[i % len(sources)].strip().split('\n')
+        copies = []
+        for copy in range(scale):
+            copies.append('\n'.join(
+                line if not line.strip() or line.rstrip().endswith(':')
+                else f"{line} [{i}.{copy}]"
+                for line in lines
+            ))
+        notes.append({"patient_id": f"BENCH-{i:05d}", "note": '\n\n'.join(copies)})
+    return notes
+
+
+class HashingEmbedder:
+    """
+    Deterministic bag-of-words embedder for offline benchmarks
+    
+    Stands in for the sentence-transformers model through the retriever's
+    embedding_batcher hook, so no model download is needed.
+    """
+    
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in re.findall(r'\w+', text.lower()):
+                digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+                embeddings[row, int.from_bytes(digest, "little") % self.dim] += 1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/mean of a list of seconds"""
+    if not values:
+        return {}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "mean": float(np.mean(values))}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> str:
+    """Short hash of the checked-out commit, so results can be compared across commits"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_e2e(args) -> Dict:
+    """Notes/sec and per-stage latency percentiles for the full pipeline"""
+    from config import config
+    from mock_ollama import start_mock_server
+    
+    mock = None
+    if not args.ollama_url:
+        mock = start_mock_server(
+            latency=args.latency,
+            tokens_per_sec=args.tokens_per_sec,
+            eval_tokens=args.eval_tokens,
+            models=[config.OLLAMA_MODEL]
+        )
+    
+    workdir = tempfile.TemporaryDirectory(prefix="clinical_rag_bench_")
+    # Isolated vector DB, no caches: every note is embedded and generated
+    config.VECTOR_DB_PATH = os.path.join(workdir.name, "chroma_db")
+    config.EMBEDDING_CACHE_ENABLED = False
+    config.GENERATION_CACHE_ENABLED = False
+    config.OLLAMA_BASE_URL = args.ollama_url or mock.base_url
+    
+    from pipeline import ClinicalRAGPipeline
+    
+    notes = build_notes(args.notes, args.scale)
+    log = None if args.verbose else io.StringIO()
+    
+    with contextlib.redirect_stdout(log) if log is not None else contextlib.nullcontext():
+        pipeline = ClinicalRAGPipeline()
+        if args.offline_embedding:
+            pipeline.retriever.embedding_batcher = HashingEmbedder()
+        
+        # Warm up so model load and collection creation are not measured
+        pipeline.analyze_note(**build_notes(1, args.scale)[0], persist=args.persist)
+        
+        results = []
+        start = time.perf_counter()
+        if args.workers <= 1:
+            for item in notes:
+                results.append(pipeline.analyze_note(**item, persist=args.persist))
+        else:
+            results = [
+                result for _, result in pipeline.analyze_notes(
+                    notes, generation_workers=args.workers, ordered=False, persist=args.persist
+                )
+            ]
+        wall_s = time.perf_counter() - start
+    
+    stage_values: Dict[str, List[float]] = {}
+    totals = []
+    for result in results:
+        timings = result.get("model_metadata", {}).get("timings", {})
+        for stage, seconds in timings.items():
+            stage_values.setdefault(stage, []).append(seconds)
+        totals.append(sum(timings.values()))
+    
+    if mock is not None:
+        mock.shutdown()
+    workdir.cleanup()
+    
+    return {
+        "benchmark": "e2e",
+        "commit": git_commit(),
+        "notes": len(notes),
+        "scale": args.scale,
+        "chars_per_note": int(statistics.mean(len(item["note"]) for item in notes)) if notes else 0,
+        "workers": args.workers,
+        "offline_embedding": args.offline_embedding,
+        "persist": args.persist,
+        "ollama": args.ollama_url or {
+            "latency": args.latency,
+            "tokens_per_sec": args.tokens_per_sec,
+            "eval_tokens": args.eval_tokens
+        },
+        "errors": sum(1 for result in results if "error" in result),
+        "wall_s": wall_s,
+        "notes_per_sec": len(notes) / wall_s if wall_s else 0.0,
+        "stages": {stage: percentiles(values) for stage, values in stage_values.items()},
+        "note_total": percentiles(totals),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# Per-line section detection that extract_sections replaced, kept as the
+# reference for the sections benchmark
+LEGACY_SECTION_PATTERNS = [
+    r"(?i)^(Chief Complaint|CC):",
+    r"(?i)^(History of Present Illness|HPI):",
+    r"(?i)^(Past Medical History|PMH):",
+    r"(?i)^(Medications|MEDS):",
+    r"(?i)^(Allergies):",
+    r"(?i)^(Physical Exam|PE):",
+    r"(?i)^(Vital Signs|VS):",
+    r"(?i)^(Laboratory|Labs|Lab Results):",
+    r"(?i)^(Imaging|Radiology):",
+    r"(?i)^(Assessment|A&P|Assessment and Plan):",
+    r"(?i)^(Plan):",
+    r"(?i)^(Differential Diagnosis|DDx):",
+]
+
+
+def legacy_extract_sections(note: str) -> List[Dict[str, str]]:
+    sections = []
+    current_section = "UNKNOWN"
+    current_text = []
+    for line in note.split('\n'):
+        is_section_header = False
+        for pattern in LEGACY_SECTION_PATTERNS:
+            if re.match(pattern, line.strip()):
+                if current_text:
+                    sections.append({"section": current_section, "text": '\n'.join(current_text).strip()})
+                current_section = line.strip().rstrip(':')
+                current_text = []
+                is_section_header = True
+                break
+        if not is_section_header and line.strip():
+            current_text.append(line)
+    if current_text:
+        sections.append({"section": current_section, "text": '\n'.join(current_text).strip()})
+    return sections
+
+
+def bench_sections(args) -> Dict:
+    """MB/s of extract_sections vs the legacy per-line loop on a large note"""
+    from chunker import ClinicalNoteChunker
+    from sample_notes import SAMPLE_NOTES
+    
+    # Discharge-summary-like input: sample notes repeated to the target size
+    base = '\n\n'.join(SAMPLE_NOTES.values())
+    note = (base + '\n\n') * max(1, int(args.mb * 1024 * 1024 / (len(base) + 2)))
+    size_mb = len(note.encode("utf-8")) / (1024 * 1024)
+    
+    chunker = ClinicalNoteChunker(section_aliases=[])
+    
+    def best_of(func) -> float:
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            func(note)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+    
+    compiled_s = best_of(chunker.extract_sections)
+    legacy_s = best_of(legacy_extract_sections)
+    
+    sections = chunker.extract_sections(note)
+    identical = [
+        {"section": s["section"], "text": s["text"]} for s in sections
+    ] == legacy_extract_sections(note)
+    
+    return {
+        "benchmark": "sections",
+        "size_mb": size_mb,
+        "sections": len(sections),
+        "compiled_mb_per_sec": size_mb / compiled_s,
+        "legacy_mb_per_sec": size_mb / legacy_s,
+        "speedup": legacy_s / compiled_s,
+        "identical": identical,
+        "passed": identical,
+    }
+
+
+def bench_embed(args) -> Dict:
+    """Chunks/sec for the per-chunk path vs the batched path"""
+    from retriever import ClinicalRAGRetriever
+
+    retriever = ClinicalRAGRetriever()
+    # Measure the model itself, not the embedding cache
+    retriever.embedding_cache = None
+    texts = [chunk["text"] for chunk in build_chunks(args.chunks)]
+
+    # Warm up so model load and first-call overhead is not measured
+    retriever.get_embeddings(texts[:args.batch_size], batch_size=args.batch_size)
+
+    start = time.perf_counter()
+    for text in texts:
+        retriever.get_embedding(text)
+    per_chunk_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    retriever.get_embeddings(texts, batch_size=args.batch_size)
+    batched_s = time.perf_counter() - start
+
+    return {
+        "benchmark": "embed",
+        "chunks": len(texts),
+        "batch_size": args.batch_size,
+        "per_chunk_chunks_per_sec": len(texts) / per_chunk_s,
+        "batched_chunks_per_sec": len(texts) / batched_s,
+        "speedup": per_chunk_s / batched_s,
+    }
+
+
+def bench_startup(args) -> Dict:
+    """Wall time of lightweight CLI commands, which must not load any models"""
+    result = {"benchmark": "startup", "runs": args.runs, "max_ms": args.max_ms}
+    passed = True
+
+    for flag in ("--help", "--list-cases"):
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, os.path.join(PROJECT_DIR, "main.py"), flag],
+                cwd=PROJECT_DIR,
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+            timings.append((time.perf_counter() - start) * 1000)
+
+        median_ms = statistics.median(timings)
+        name = flag.lstrip('-').replace('-', '_')
+        result[f"{name}_median_ms"] = median_ms
+        result[f"{name}_max_ms"] = max(timings)
+        passed = passed and median_ms <= args.max_ms
+
+    result["passed"] = passed
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clinical RAG System - benchmarks")
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--output', type=str, help='Also write results as JSON to this file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    embed = subparsers.add_parser('embed', help='Per-chunk vs batched embedding throughput')
+    embed.add_argument('--chunks', type=int, default=500, help='Number of chunks to embed')
+    embed.add_argument('--batch-size', type=int, default=64, help='Batch size for the batched path')
+    embed.set_defaults(func=bench_embed)
+
+    startup = subparsers.add_parser('startup', help='CLI startup time for --help/--list-cases')
+    startup.add_argument('--runs', type=int, default=10, help='Runs per command')
+    startup.add_argument('--max-ms', type=float, default=200.0, help='Budget for the median run')
+    startup.set_defaults(func=bench_startup)
+
+    sections = subparsers.add_parser('sections', help='Section detection throughput on large notes')
+    sections.add_argument('--mb', type=float, default=4.0, help='Input size in MiB')
+    sections.add_argument('--runs', type=int, default=3, help='Runs per implementation (best is kept)')
+    sections.set_defaults(func=bench_sections)
+    
+    e2e = subparsers.add_parser('e2e', help='End-to-end pipeline throughput against a mock Ollama')
+    e2e.add_argument('--notes', type=int, default=20, help='Number of synthetic notes')
+    e2e.add_argument('--scale', type=int, default=1, help='Copies of the source note per synthetic note')
+    e2e.add_argument('--workers', type=int, default=1,
+                     help='Concurrent generations (1 = serial analyze_note, >1 = analyze_notes)')
+    e2e.add_argument('--latency', type=float, default=0.2, help='Mock time to first token (s)')
+    e2e.add_argument('--tokens-per-sec', type=float, default=200.0, help='Mock generation speed')
+    e2e.add_argument('--eval-tokens', type=int, default=400, help='Mock output tokens per note')
+    e2e.add_argument('--ollama-url', type=str, help='Benchmark a real Ollama server instead of the mock')
+    e2e.add_argument('--offline-embedding', action='store_true',
+                     help='Use a hashing embedder instead of sentence-transformers (no download)')
+    e2e.add_argument('--persist', action='store_true',
+                     help='Also write each note to Chroma (default: in-memory retrieval only)')
+    e2e.add_argument('--verbose', action='store_true', help='Show pipeline output')
+    e2e.set_defaults(func=bench_e2e)
+    
+    args = parser.parse_args()
+    result = args.func(args)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print("\n" + "=" * 70)
+        print(f"Benchmark: {result['benchmark']}")
+        print("=" * 70)
+        for key, value in result.items():
+            if key == "benchmark":
+                continue
+            if isinstance(value, float):
+                value = f"{value:.2f}"
+            if isinstance(value, dict) and all(isinstance(v, dict) for v in value.values()):
+                print(f"  {key}:")
+                for name, stats in value.items():
+                    print(f"    {name}: " + ", ".join(
+                        f"{stat} {seconds * 1000:.1f}ms" for stat, seconds in stats.items()
+                    ))
+                continue
+            if key == "note_total" and isinstance(value, dict):
+                value = ", ".join(f"{stat} {seconds * 1000:.1f}ms" for stat, seconds in value.items())
+            print(f"  {key}: {value}")
+    return 1 if result.get("passed") is False else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
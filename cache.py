@@ -0,0 +1,320 @@
+"""
+Persistent caches for the Clinical RAG System
+Embeddings are content-addressed so unchanged note sections are never re-embedded;
+deterministic generations are keyed by their full request so re-runs skip the LLM
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from config import config
+
+
+class EmbeddingCache:
+    """On-disk embedding cache backed by SQLite with LRU eviction"""
+
+    def __init__(
+        self,
+        model_name: str = None,
+        path: str = None,
+        max_entries: int = None
+    ):
+        self.model_name = model_name or config.LOCAL_EMBEDDING_MODEL
+        self.path = path or config.EMBEDDING_CACHE_PATH
+        self.max_entries = max_entries or config.EMBEDDING_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Collapse whitespace so formatting-only edits still hit the cache"""
+        return ' '.join(text.split())
+
+    def key(self, text: str) -> str:
+        """Content address for (embedding model, normalized text)"""
+        payload = f"{self.model_name}\0{self.normalize(text)}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get_many(self, texts: List[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """
+        Look up embeddings for texts
+
+        Returns:
+            (found, missing): found maps text index -> float32 vector,
+            missing lists the indices that must be embedded
+        """
+        keys = [self.key(text) for text in texts]
+        unique_keys = list(set(keys))
+        rows = {}
+
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start:start + 500]
+                placeholders = ','.join('?' * len(batch))
+                for key, vector in self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch
+                ):
+                    rows[key] = np.frombuffer(vector, dtype=np.float32)
+
+            if rows:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in rows]
+                )
+                self._conn.commit()
+
+            found = {}
+            missing = []
+            for i, key in enumerate(keys):
+                if key in rows:
+                    found[i] = rows[key]
+                else:
+                    missing.append(i)
+
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """Look up a single embedding, or None on a miss"""
+        found, _ = self.get_many([text])
+        return found.get(0)
+
+    def put_many(self, texts: List[str], embeddings: np.ndarray):
+        """Store embeddings and evict least recently used entries over the limit"""
+        if not texts:
+            return
+
+        now = time.time()
+        rows = [
+            (self.key(text), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                rows
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN ("
+                    "SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def put(self, text: str, embedding: np.ndarray):
+        """Store a single embedding"""
+        self.put_many([text], [embedding])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> Dict:
+        """Hit/miss counters for this process"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "max_entries": self.max_entries
+        }
+
+    def clear(self):
+        """Remove all cached embeddings"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+
+    def close(self):
+        """Close the underlying database connection"""
+        with self._lock:
+            self._conn.close()
+
+
+class GenerationCache:
+    """
+    Two-level (memory + SQLite) cache of Ollama generation responses
+
+    Keys are a hash of the full request (model, options, format, prompt), so
+    any change to the prompt, retrieved chunks or settings is a miss. Entries
+    expire after a TTL and the least recently used are evicted beyond the
+    size limit. Only deterministic (temperature 0) requests should be cached.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        ttl: float = None,
+        max_entries: int = None,
+        memory_entries: int = None
+    ):
+        self.path = path or config.GENERATION_CACHE_PATH
+        self.ttl = ttl if ttl is not None else config.GENERATION_CACHE_TTL
+        self.max_entries = max_entries or config.GENERATION_CACHE_MAX_ENTRIES
+        self.memory_entries = memory_entries or config.GENERATION_CACHE_MEMORY_ENTRIES
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (stored_at, response)
+        self._memory: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "stored_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(request_body: Dict) -> str:
+        """Fingerprint of a generation request (streaming mode is irrelevant)"""
+        fingerprint = {k: v for k, v in request_body.items() if k not in ("stream", "prompt")}
+        fingerprint["prompt_sha256"] = hashlib.sha256(
+            request_body.get("prompt", "").encode("utf-8")
+        ).hexdigest()
+        payload = json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - stored_at > self.ttl
+
+    def _remember(self, key: str, stored_at: float, response: Dict):
+        self._memory[key] = (stored_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, request_body: Dict) -> Optional[Dict]:
+        """Cached Ollama response for this request, or None"""
+        key = self.key(request_body)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0], now):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._memory.pop(key, None)
+
+            row = self._conn.execute(
+                "SELECT response, stored_at FROM generations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or self._expired(row[1], now):
+                if row is not None:
+                    self._conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE generations SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            response = json.loads(row[0])
+            self._remember(key, row[1], response)
+            self.hits += 1
+            return response
+
+    def put(self, request_body: Dict, response: Dict):
+        """Store a response, then drop expired and least recently used entries"""
+        key = self.key(request_body)
+        now = time.time()
+
+        with self._lock:
+            self._remember(key, now, response)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generations (key, response, stored_at, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(response), now, now)
+            )
+            if self.ttl > 0:
+                self._conn.execute(
+                    "DELETE FROM generations WHERE stored_at < ?", (now - self.ttl,)
+                )
+            count = self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM generations WHERE key IN ("
+                    "SELECT key FROM generations ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+    def stats(self) -> Dict:
+        """Hit/miss counters for this process"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "max_entries": self.max_entries
+        }
+
+    def clear(self):
+        """Remove all cached generations"""
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM generations")
+            self._conn.commit()
+
+    def close(self):
+        """Close the underlying database connection"""
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    # Test the embedding cache
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = EmbeddingCache(path=os.path.join(tmp, "cache.db"), max_entries=2)
+        cache.put("Metformin 1000mg BID", np.ones(4, dtype=np.float32))
+        print(f"Hit: {cache.get('Metformin   1000mg BID') is not None}")
+        print(f"Miss: {cache.get('Lisinopril 10mg daily') is None}")
+        print(f"Stats: {cache.stats()}")
+        cache.close()
@@ -1,121 +1,457 @@
 """
 Document chunking and preprocessing module for clinical notes
 """
+import codecs
+import hashlib
+import mmap
+import os
 import re
-from typing import List, Dict, Tuple
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import accumulate, islice
+from typing import IO, Dict, Iterator, List, Sequence, Tuple, Union
 from config import config
 
 
+# A word for chunk sizing: any run of non-whitespace
+WORD = re.compile(r'\S+')
+
+# Whitespace-only line inside a section body (dropped from section text)
+BLANK_LINE = re.compile(r'\n[^\S\n]*(?=\n)')
+
+
+@lru_cache(maxsize=32)
+def compile_section_pattern(aliases: Tuple[str, ...]) -> "re.Pattern":
+    """
+    One multiline pattern matching any header line, e.g. "Labs:" or "  HPI: ..."
+    
+    Aliases are literal, case-insensitive and must be followed by a colon.
+    The match spans the whole header line (without the newline).
+    """
+    alternation = '|'.join(re.escape(alias) for alias in sorted(aliases, key=len, reverse=True))
+    return re.compile(rf'^[^\S\n]*(?:{alternation}):[^\n]*', re.IGNORECASE | re.MULTILINE)
+
+
+@lru_cache(maxsize=4)
+def load_tokenizer(model_name: str):
+    """
+    Fast tokenizer of a sentence-transformers model, loaded once per process
+    
+    Bare names like "all-MiniLM-L6-v2" resolve to the sentence-transformers
+    organization on the Hugging Face Hub, as SentenceTransformer does.
+    """
+    from transformers import AutoTokenizer
+    
+    if '/' not in model_name and not os.path.isdir(model_name):
+        model_name = f"sentence-transformers/{model_name}"
+    return AutoTokenizer.from_pretrained(model_name, use_fast=True)
+
+
 class ClinicalNoteChunker:
     """Chunks clinical notes into sections with metadata"""
     
-    # Common clinical note sections
-    SECTION_PATTERNS = [
-        r"(?i)^(Chief Complaint|CC):",
-        r"(?i)^(History of Present Illness|HPI):",
-        r"(?i)^(Past Medical History|PMH):",
-        r"(?i)^(Medications|MEDS):",
-        r"(?i)^(Allergies):",
-        r"(?i)^(Physical Exam|PE):",
-        r"(?i)^(Vital Signs|VS):",
-        r"(?i)^(Laboratory|Labs|Lab Results):",
-        r"(?i)^(Imaging|Radiology):",
-        r"(?i)^(Assessment|A&P|Assessment and Plan):",
-        r"(?i)^(Plan):",
-        r"(?i)^(Differential Diagnosis|DDx):",
-    ]
-    
-    def __init__(self, chunk_size: int = None, overlap: int = None):
+    # Common clinical note section headers (extend with SECTION_ALIASES in .env)
+    SECTION_ALIASES = (
+        "Chief Complaint", "CC",
+        "History of Present Illness", "HPI",
+        "Past Medical History", "PMH",
+        "Medications", "MEDS",
+        "Allergies",
+        "Physical Exam", "PE",
+        "Vital Signs", "VS",
+        "Laboratory", "Labs", "Lab Results",
+        "Imaging", "Radiology",
+        "Assessment", "A&P", "Assessment and Plan",
+        "Plan",
+        "Differential Diagnosis", "DDx",
+    )
+    
+    UNITS = ("words", "tokens")
+    
+    def __init__(
+        self,
+        chunk_size: int = None,
+        overlap: int = None,
+        section_aliases: List[str] = None,
+        unit: str = None
+    ):
         self.chunk_size = chunk_size or config.CHUNK_SIZE
         self.overlap = overlap or config.CHUNK_OVERLAP
+        
+        self.unit = (unit or config.CHUNK_UNIT).lower()
+        if self.unit not in self.UNITS:
+            raise ValueError(f"Unknown chunk unit '{self.unit}' (expected one of {self.UNITS})")
+        if self.unit == "tokens":
+            # Anything past the model's limit (less [CLS]/[SEP]) is truncated when embedded
+            self.chunk_size = min(self.chunk_size, config.EMBEDDING_MAX_TOKENS - 2)
+        
+        extra = config.SECTION_ALIASES if section_aliases is None else section_aliases
+        aliases = self.SECTION_ALIASES + tuple(a for a in extra if a not in self.SECTION_ALIASES)
+        self.section_pattern = compile_section_pattern(aliases)
     
     def extract_sections(self, note: str) -> List[Dict[str, str]]:
-        """Extract sections from clinical note"""
+        """
+        Extract sections from clinical note in a single regex pass
+        
+        Text before the first header belongs to section "UNKNOWN". Blank
+        lines inside a section are dropped from its text.
+        
+        Returns:
+            List of dicts with section, text, and start/end character
+            offsets of the section body in `note`
+        """
         sections = []
-        lines = note.split('\n')
         current_section = "UNKNOWN"
-        current_text = []
-        
-        for line in lines:
-            # Check if line starts a new section
-            is_section_header = False
-            for pattern in self.SECTION_PATTERNS:
-                if re.match(pattern, line.strip()):
-                    # Save previous section
-                    if current_text:
-                        sections.append({
-                            "section": current_section,
-                            "text": '\n'.join(current_text).strip()
-                        })
-                    
-                    # Start new section
-                    current_section = line.strip().rstrip(':')
-                    current_text = []
-                    is_section_header = True
-                    break
-            
-            if not is_section_header and line.strip():
-                current_text.append(line)
+        body_start = 0
         
-        # Add last section
-        if current_text:
-            sections.append({
-                "section": current_section,
-                "text": '\n'.join(current_text).strip()
-            })
+        for header in self.section_pattern.finditer(note):
+            self._add_section(sections, note, current_section, body_start, header.start())
+            current_section = header.group().strip().rstrip(':')
+            body_start = header.end() + 1
         
+        self._add_section(sections, note, current_section, body_start, len(note))
         return sections
     
-    def chunk_text(self, text: str, max_size: int) -> List[str]:
-        """Split text into chunks of max_size with overlap"""
-        words = text.split()
-        chunks = []
+    @staticmethod
+    def _add_section(sections: List[Dict], note: str, section: str, start: int, end: int):
+        """Append the body note[start:end] (trimmed) as a section, unless it is empty"""
+        body = note[start:end]
+        text = body.strip()
+        if not text:
+            return
+        
+        if BLANK_LINE.search(text):
+            text = '\n'.join(line for line in text.split('\n') if line.strip())
+        
+        leading = len(body) - len(body.lstrip())
+        trailing = len(body.rstrip())
+        sections.append({
+            "section": section,
+            "text": text,
+            "start": start + leading,
+            "end": start + trailing
+        })
+    
+    @property
+    def tokenizer(self):
+        """Embedding model tokenizer (only loaded in "tokens" mode)"""
+        return load_tokenizer(config.LOCAL_EMBEDDING_MODEL)
+    
+    def token_counts(self, text: str, bodies: Sequence[Tuple[int, int]]) -> List[List[int]]:
+        """
+        Word-piece tokens per word of each body text[start:end]
+        
+        All bodies go through the tokenizer in one batched call; each token
+        is credited to the word its first character falls in.
+        """
+        words = [[match.start() for match in WORD.finditer(text, start, end)] for start, end in bodies]
+        encoded = self.tokenizer(
+            [text[start:end] for start, end in bodies],
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False
+        )
+        
+        counts = []
+        for (start, _), starts, offsets in zip(bodies, words, encoded["offset_mapping"]):
+            sizes = [0] * len(starts)
+            for token_start, token_end in offsets:
+                owner = bisect_right(starts, start + token_start) - 1
+                if token_end > token_start and owner >= 0:
+                    sizes[owner] += 1
+            counts.append(sizes)
+        return counts
+    
+    def chunk_spans(
+        self,
+        text: str,
+        max_size: int,
+        start: int = 0,
+        end: int = None,
+        sizes: Sequence[int] = None
+    ) -> List[Tuple[int, int]]:
+        """
+        Character spans of windows of at most max_size units, with overlap
+        
+        Only text[start:end] is split; spans are offsets into `text`, running
+        from the first word's first character to the last word's last one,
+        so the original formatting inside each window is preserved. Windows
+        always break between words; in "tokens" mode each word weighs its
+        token count (`sizes`, computed here if not given).
+        """
+        end = len(text) if end is None else end
+        words = [match.span() for match in WORD.finditer(text, start, end)]
+        if not words:
+            return []
+        
+        if self.unit == "tokens":
+            if sizes is None:
+                sizes = self.token_counts(text, [(start, end)])[0]
+            cumulative = list(accumulate(sizes, initial=0))
+        else:
+            cumulative = range(len(words) + 1)
         
-        if len(words) <= max_size:
-            return [text]
+        if cumulative[-1] <= max_size:
+            return [(words[0][0], words[-1][1])]
         
-        start = 0
-        while start < len(words):
-            end = min(start + max_size, len(words))
-            chunk = ' '.join(words[start:end])
-            chunks.append(chunk)
+        spans = []
+        first = 0
+        while first < len(words):
+            # Longest run of whole words within max_size (at least one word)
+            last = max(bisect_right(cumulative, cumulative[first] + max_size) - 1, first + 1)
+            spans.append((words[first][0], words[last - 1][1]))
             
-            if end >= len(words):
+            if last >= len(words):
                 break
             
-            start = end - self.overlap
+            # Step back over at most `overlap` units of trailing words
+            first = max(bisect_left(cumulative, cumulative[last] - self.overlap), first + 1)
         
-        return chunks
+        return spans
+    
+    def chunk_text(self, text: str, max_size: int) -> List[str]:
+        """Split text into chunks of max_size units with overlap, keeping formatting"""
+        return [text[start:end] for start, end in self.chunk_spans(text, max_size)]
+    
+    @staticmethod
+    def make_chunk_id(patient_id: str, note_id: str, section: str, text: str) -> str:
+        """
+        Stable, globally unique chunk ID
+        
+        The same chunk of the same note always gets the same ID, so indexing
+        can upsert and skip chunks that are already stored.
+        """
+        digest = hashlib.sha1(f"{section}\0{text}".encode("utf-8")).hexdigest()[:16]
+        return f"{patient_id}:{note_id}:{digest}"
+    
+    @staticmethod
+    def default_note_id(note: str) -> str:
+        """
+        Note ID derived from the note text, for notes indexed without one
+        
+        Distinct notes of one patient or encounter then never overwrite each
+        other's chunks; pass an explicit note_id to have a revision replace
+        its previous version instead.
+        """
+        return "note-" + hashlib.sha1(note.encode("utf-8")).hexdigest()[:16]
     
-    def process_note(self, note: str, patient_id: str = None) -> List[Dict[str, str]]:
+    def process_note(
+        self,
+        note: str,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> List[Dict[str, str]]:
         """
         Process clinical note into chunks with metadata
         
+        Args:
+            note: Clinical note text
+            patient_id: Optional patient identifier
+            encounter_id: Optional encounter identifier
+            note_id: Optional note identifier (defaults to a hash of the note text)
+        
         Returns:
-            List of dicts with: chunk_id, section, text, patient_id
+            List of dicts with: id (stable global ID), chunk_id (per-note alias,
+            e.g. chunk_3), section, text, start/end (character
+            offsets in `note`, with text == note[start:end]), patient_id,
+            encounter_id, note_id
         """
+        patient_id = patient_id or "unknown"
+        encounter_id = encounter_id or "unknown"
+        note_id = note_id or self.default_note_id(note)
+        
         sections = self.extract_sections(note)
         chunks = []
         chunk_counter = 0
         
-        for section_data in sections:
+        # Tokenize every section in one batch rather than one call per section
+        sizes = [None] * len(sections)
+        if self.unit == "tokens" and sections:
+            sizes = self.token_counts(note, [(s["start"], s["end"]) for s in sections])
+        
+        for section_data, section_sizes in zip(sections, sizes):
             section_name = section_data["section"]
-            section_text = section_data["text"]
             
-            # Chunk the section text if it's too long
-            text_chunks = self.chunk_text(section_text, self.chunk_size)
+            # Chunk the section body if it's too long, as slices of the note
+            spans = self.chunk_spans(
+                note, self.chunk_size, section_data["start"], section_data["end"], section_sizes
+            )
             
-            for chunk_text in text_chunks:
+            for start, end in spans:
                 chunk_counter += 1
-                chunks.append({
-                    "chunk_id": f"chunk_{chunk_counter}",
-                    "section": section_name,
-                    "text": chunk_text,
-                    "patient_id": patient_id or "unknown"
-                })
+                chunks.append(self._make_chunk(
+                    note[start:end], start, end, section_name, chunk_counter,
+                    patient_id, encounter_id, note_id
+                ))
         
         return chunks
     
+    def _make_chunk(
+        self,
+        text: str,
+        start: int,
+        end: int,
+        section: str,
+        number: int,
+        patient_id: str,
+        encounter_id: str,
+        note_id: str
+    ) -> Dict:
+        return {
+            "id": self.make_chunk_id(patient_id, note_id, section, text),
+            "chunk_id": f"chunk_{number}",
+            "section": section,
+            "text": text,
+            "start": start,
+            "end": end,
+            "patient_id": patient_id,
+            "encounter_id": encounter_id,
+            "note_id": note_id
+        }
+    
+    def iter_chunks(
+        self,
+        source: Union[str, IO, mmap.mmap],
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None,
+        block_size: int = 1 << 20
+    ) -> Iterator[Dict]:
+        """
+        Lazily chunk a very large note with bounded memory
+        
+        The source is read `block_size` at a time; only complete lines are
+        scanned, and text before the current window is dropped, so memory is
+        bounded by one block, the open chunk window and the longest line.
+        Each chunk is a slice of the buffered text. Output is the same as
+        process_note on the full text (identical in "words" mode; in "tokens"
+        mode words are tokenized a block at a time).
+        
+        Args:
+            source: Note text, a text or binary file object, or an mmap
+                (bytes are decoded as UTF-8; offsets count characters)
+            patient_id / encounter_id / note_id: As for process_note, except
+                that a file or mmap source without note_id falls back to the
+                encounter ID (its text is not known up front)
+            block_size: Characters (or bytes) read per step
+        
+        Yields:
+            Chunk dicts as returned by process_note
+        """
+        patient_id = patient_id or "unknown"
+        encounter_id = encounter_id or "unknown"
+        if isinstance(source, str):
+            note_id = note_id or self.default_note_id(source)
+        note_id = note_id or encounter_id
+        
+        if isinstance(source, str):
+            blocks = iter([source])
+        else:
+            blocks = iter(lambda: source.read(block_size), source.read(0))
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        
+        buffer = ""
+        base = 0           # note offset of buffer[0]
+        scanned = 0        # note offset up to which complete lines were scanned
+        section = "UNKNOWN"
+        words: List[Tuple[int, int]] = []   # open section's words from the window start
+        cumulative = [0]   # running unit counts over `words`
+        first = 0          # index in `words` where the next window starts
+        counter = 0
+        
+        def window(last: int) -> Dict:
+            nonlocal counter
+            counter += 1
+            start, end = words[first][0], words[last - 1][1]
+            return self._make_chunk(
+                buffer[start - base:end - base], start, end, section, counter,
+                patient_id, encounter_id, note_id
+            )
+        
+        def next_first(last: int) -> int:
+            return max(bisect_left(cumulative, cumulative[last] - self.overlap), first + 1)
+        
+        def add_words(start: int, end: int):
+            spans = [match.span() for match in WORD.finditer(buffer, start - base, end - base)]
+            if not spans:
+                return
+            if self.unit == "tokens":
+                sizes = self.token_counts(buffer, [(start - base, end - base)])[0]
+            else:
+                sizes = [1] * len(spans)
+            words.extend((s + base, e + base) for s, e in spans)
+            cumulative.extend(islice(accumulate(sizes, initial=cumulative[-1]), 1, None))
+        
+        def full_windows() -> Iterator[Dict]:
+            # Windows that cannot change as more words arrive
+            nonlocal first
+            while True:
+                last = max(bisect_right(cumulative, cumulative[first] + self.chunk_size) - 1, first + 1)
+                if last >= len(words):
+                    return
+                yield window(last)
+                first = next_first(last)
+        
+        def close_section() -> Iterator[Dict]:
+            nonlocal first, words, cumulative
+            while first < len(words):
+                last = max(bisect_right(cumulative, cumulative[first] + self.chunk_size) - 1, first + 1)
+                yield window(last)
+                if last >= len(words):
+                    break
+                first = next_first(last)
+            words, cumulative, first = [], [0], 0
+        
+        def scan(upto: int) -> Iterator[Dict]:
+            # Headers close the open section; words in between extend it
+            nonlocal scanned, section
+            for header in self.section_pattern.finditer(buffer, scanned - base, upto - base):
+                add_words(scanned, header.start() + base)
+                yield from close_section()
+                section = header.group().strip().rstrip(':')
+                scanned = header.end() + 1 + base
+            if scanned < upto:
+                add_words(scanned, upto)
+                scanned = upto
+            yield from full_windows()
+        
+        def trim():
+            # Forget text and words before the open window
+            nonlocal buffer, base, words, cumulative, first
+            if first:
+                offset = cumulative[first]
+                words = words[first:]
+                cumulative = [total - offset for total in cumulative[first:]]
+                first = 0
+            keep = words[0][0] if words else scanned
+            buffer = buffer[keep - base:]
+            base = keep
+        
+        for block in blocks:
+            buffer += block if isinstance(block, str) else decoder.decode(block)
+            # Only complete lines: a header or word may continue in the next block
+            yield from scan(base + buffer.rfind('\n') + 1)
+            trim()
+        
+        buffer += decoder.decode(b"", final=True)
+        yield from scan(base + len(buffer))
+        yield from close_section()
+    
+    def iter_file_chunks(
+        self,
+        path: str,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> Iterator[Dict]:
+        """Lazily chunk a note file through a read-only memory map (see iter_chunks)"""
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield from self.iter_chunks(mapped, patient_id, encounter_id, note_id)
+    
     def format_chunks_for_prompt(self, chunks: List[Dict[str, str]]) -> str:
         """Format chunks for LLM prompt"""
         formatted = []
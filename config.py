@@ -16,23 +16,84 @@ class LocalConfig:
     OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2")
     OLLAMA_API_KEY = os.getenv("OLLAMA_API_KEY", None)  # For Ollama Cloud
     
+    # Ollama HTTP connection pool and timeouts (seconds)
+    OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "10"))
+    OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "10"))
+    OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "180"))
+    # Concurrent async generations per process (match the server's OLLAMA_NUM_PARALLEL)
+    OLLAMA_MAX_PARALLEL = int(os.getenv("OLLAMA_MAX_PARALLEL", "4"))
+    
     # Local Embedding Configuration (FREE)
     LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "all-MiniLM-L6-v2")
     
     # Model Configuration
     LLM_MODEL = os.getenv("LLM_MODEL", "llama3.2")
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
     TEMPERATURE = float(os.getenv("TEMPERATURE", "0.0"))
     MAX_TOKENS = int(os.getenv("MAX_TOKENS", "1200"))
     
+    # Embedding Cache Configuration (content-addressed, on disk)
+    EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.db")
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+    
+    # Send the output JSON schema as Ollama's `format` so responses are valid JSON
+    OLLAMA_STRUCTURED_OUTPUT = os.getenv("OLLAMA_STRUCTURED_OUTPUT", "true").lower() == "true"
+    
+    # Generation Cache Configuration (only used when TEMPERATURE is 0)
+    GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "true").lower() == "true"
+    GENERATION_CACHE_PATH = os.getenv("GENERATION_CACHE_PATH", "./generation_cache.db")
+    GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", "604800"))  # 7 days
+    GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", "10000"))
+    GENERATION_CACHE_MEMORY_ENTRIES = int(os.getenv("GENERATION_CACHE_MEMORY_ENTRIES", "256"))
+    
     # Retrieval Configuration
     RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "10"))
+    # Fuse BM25 keyword hits with dense hits for free-text queries (reciprocal rank fusion)
+    HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "true").lower() == "true"
+    HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "30"))
+    RRF_K = int(os.getenv("RRF_K", "60"))
+    # Re-rank the top MMR_FETCH_K candidates by maximal marginal relevance before the prompt
+    MMR_ENABLED = os.getenv("MMR_ENABLED", "true").lower() == "true"
+    MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", "25"))
+    MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+    MMR_REDUNDANCY = float(os.getenv("MMR_REDUNDANCY", "0.95"))  # drop near-duplicates of a pick
+    SECTION_QUOTA = int(os.getenv("SECTION_QUOTA", "0"))         # max chunks per section, 0 = no limit
     CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "512"))
     CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+    # "words" or "tokens" (embedding-model word pieces, capped at EMBEDDING_MAX_TOKENS)
+    CHUNK_UNIT = os.getenv("CHUNK_UNIT", "words").lower()
+    EMBEDDING_MAX_TOKENS = int(os.getenv("EMBEDDING_MAX_TOKENS", "256"))
+    # Extra section headers recognized by the chunker, comma-separated
+    SECTION_ALIASES = [
+        alias.strip() for alias in os.getenv("SECTION_ALIASES", "").split(",") if alias.strip()
+    ]
+    
+    # Batch Analysis Configuration (ClinicalRAGPipeline.analyze_notes)
+    BATCH_PREP_WORKERS = int(os.getenv("BATCH_PREP_WORKERS", "1"))
+    BATCH_GENERATION_WORKERS = int(os.getenv("BATCH_GENERATION_WORKERS", "2"))
+    BATCH_MAX_PENDING = int(os.getenv("BATCH_MAX_PENDING", "8"))
+    
+    # Bulk Ingest Configuration (python main.py --ingest); 0 = size from the CPU count
+    INGEST_CHUNK_WORKERS = int(os.getenv("INGEST_CHUNK_WORKERS", "0"))
+    INGEST_EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "0"))
+    INGEST_THREADS_PER_WORKER = int(os.getenv("INGEST_THREADS_PER_WORKER", "0"))
+    INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+    
+    # HTTP Service Configuration (python main.py --serve)
+    SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+    SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
+    SERVER_MAX_GENERATIONS = int(os.getenv("SERVER_MAX_GENERATIONS", "2"))
+    SERVER_EMBED_MAX_BATCH = int(os.getenv("SERVER_EMBED_MAX_BATCH", "128"))
+    SERVER_EMBED_WAIT_MS = float(os.getenv("SERVER_EMBED_WAIT_MS", "5"))
+    SERVER_MAX_BODY_BYTES = int(os.getenv("SERVER_MAX_BODY_BYTES", "1048576"))
     
     # Vector DB Configuration
     VECTOR_DB_PATH = "./chroma_db"
     COLLECTION_NAME = "clinical_notes"
+    # Per-note record of indexed chunks (default: note_manifest.db in VECTOR_DB_PATH)
+    INDEX_MANIFEST_PATH = os.getenv("INDEX_MANIFEST_PATH", "")
     
     # Prompts
     SYSTEM_PROMPT = """You are a clinical assistant. Output ONLY valid JSON. No explanations, no thinking, just JSON."""
@@ -54,7 +115,7 @@ Output ONLY this JSON structure (no other text):
   "patient_id": null,
   "summary": {{
     "text": ["bullet point 1", "bullet point 2", "bullet point 3"],
-    "supporting_evidence": [{{"chunk_id":"chunk_1","offset":[0,50],"quote":"relevant text"}}]
+    "supporting_evidence": [{{"chunk_id":"E1","offset":[0,50],"quote":"relevant text"}}]
   }},
   "differential": [
     {{
@@ -62,7 +123,7 @@ Output ONLY this JSON structure (no other text):
       "diagnosis": "Diagnosis Name",
       "confidence": 0.95,
       "rationale": "brief explanation",
-      "supporting_evidence": [{{"chunk_id":"chunk_2","offset":[0,30],"quote":"supporting text"}}],
+      "supporting_evidence": [{{"chunk_id":"E2","offset":[0,30],"quote":"supporting text"}}],
       "evidence_score": 0.9
     }}
   ],
@@ -2,12 +2,104 @@
 LLM generation using Ollama (Cloud or Local)
 Supports both Ollama Cloud (no GPU needed) and local Ollama
 """
+import asyncio
 import json
 import requests
 import os
-from typing import List, Dict, Optional
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable, Iterator, List, Dict, Optional, Tuple
 from config import config
+from cache import GenerationCache
 from chunker import ClinicalNoteChunker
+from json_stream import IncrementalJSONParser
+from timing import ollama_stats, record, rounded, timed
+
+# Word runs of a quote, matched across any punctuation/whitespace in the source
+QUOTE_WORD = re.compile(r'\w+')
+
+# Streamed arrays reported as soon as each element is complete
+STREAM_EVENT_TYPES = {
+    ("summary", "text"): "summary_bullet",
+    ("differential",): "differential",
+}
+
+
+def locate_quote(text: str, quote: str, hint: int = None) -> Optional[Tuple[int, int]]:
+    """
+    Character span of a quote in text, or None if it does not occur
+    
+    Tries an exact substring first, then a case-insensitive one, then the
+    quote's words in order separated by any non-word characters (models often
+    re-space, re-punctuate or elide with "..."). Among several exact matches
+    the one nearest `hint` (the model's claimed start) wins.
+    """
+    quote = quote.strip().strip('"\'')
+    if not quote or not text:
+        return None
+    
+    start = text.find(quote)
+    if start >= 0:
+        if hint is not None:
+            best = start
+            while start >= 0 and start <= hint:
+                best = start
+                start = text.find(quote, start + 1)
+            if start >= 0 and abs(start - hint) < abs(best - hint):
+                best = start
+            start = best
+        return start, start + len(quote)
+    
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        start = lowered.find(quote.lower())
+        if start >= 0:
+            return start, start + len(quote)
+    
+    words = QUOTE_WORD.findall(quote)
+    if not words:
+        return None
+    match = re.search(r'\W+'.join(map(re.escape, words)), text, re.IGNORECASE)
+    return match.span() if match else None
+
+
+def schema_from_example(value: Any) -> Dict:
+    """Infer a JSON schema from an example value (all object keys required)"""
+    if isinstance(value, dict):
+        return {
+            "type": "object",
+            "properties": {key: schema_from_example(item) for key, item in value.items()},
+            "required": list(value)
+        }
+    if isinstance(value, list):
+        schema = {"type": "array"}
+        schema["items"] = schema_from_example(value[0]) if value else {"type": "string"}
+        return schema
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, int):
+        return {"type": "integer"}
+    if isinstance(value, float):
+        return {"type": "number"}
+    if value is None:
+        return {"type": ["string", "null"]}
+    return {"type": "string"}
+
+
+@lru_cache(maxsize=1)
+def generation_output_schema() -> Dict:
+    """
+    JSON schema of the output structure shown in GENERATION_PROMPT_TEMPLATE
+    
+    Derived from the template's example so the two cannot drift apart.
+    """
+    template = config.GENERATION_PROMPT_TEMPLATE.format(chunks="")
+    example = json.loads(template[template.index('{'):template.rindex('}') + 1])
+    return schema_from_example(example)
 
 
 class ClinicalGenerator:
@@ -22,8 +114,30 @@ class ClinicalGenerator:
         # Determine if using cloud or local
         self.is_cloud = 'ollama.com' in self.base_url
         
-        # Check if Ollama is accessible
-        self._check_ollama()
+        # Ollama is probed on the first generation, not at construction
+        self._ollama_checked = False
+        
+        # Constrain output to the prompt's JSON schema; regex parsing is a fallback
+        self.structured_output = config.OLLAMA_STRUCTURED_OUTPUT
+        
+        # How often each parse path fires (see _parse_response)
+        self.parse_stats = Counter()
+        self._stats_lock = threading.Lock()
+        
+        # Separate connect and read timeouts for every Ollama call
+        self.timeout = (config.OLLAMA_CONNECT_TIMEOUT, config.OLLAMA_READ_TIMEOUT)
+        self._session = None
+        self._init_lock = threading.Lock()
+        
+        # Async client and in-flight limit, bound to the event loop that made them
+        self._async_client = None
+        self._async_semaphore = None
+        self._async_loop = None
+        
+        # Deterministic re-runs of the same prompt skip the LLM entirely
+        self.generation_cache = None
+        if config.GENERATION_CACHE_ENABLED:
+            self.generation_cache = GenerationCache()
     
     def _get_headers(self):
         """Get headers for API requests"""
@@ -32,12 +146,80 @@ class ClinicalGenerator:
             headers['Authorization'] = f'Bearer {self.api_key}'
         return headers
     
+    @property
+    def session(self) -> requests.Session:
+        """
+        Pooled keep-alive HTTP session, created on first use
+        
+        Reusing connections avoids a TCP (and, for Ollama Cloud, TLS)
+        handshake on every generation.
+        """
+        if self._session is None:
+            with self._init_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=config.OLLAMA_POOL_SIZE,
+                        pool_maxsize=config.OLLAMA_POOL_SIZE
+                    )
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.headers.update(self._get_headers())
+                    self._session = session
+        return self._session
+    
+    def close(self):
+        """Close pooled connections"""
+        with self._init_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+    
+    def _get_async_client(self) -> Tuple[Any, asyncio.Semaphore]:
+        """
+        Shared pooled httpx.AsyncClient and in-flight semaphore for the running loop
+        
+        Both are bound to the event loop that created them, so a later
+        asyncio.run() (a new loop) gets fresh ones instead of reusing
+        connections and a semaphore tied to a closed loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            import httpx
+            
+            # Connections of a previous loop died with it; nothing left to close
+            self._async_client = httpx.AsyncClient(
+                headers=self._get_headers(),
+                timeout=httpx.Timeout(
+                    config.OLLAMA_READ_TIMEOUT, connect=config.OLLAMA_CONNECT_TIMEOUT
+                ),
+                limits=httpx.Limits(
+                    max_connections=config.OLLAMA_POOL_SIZE,
+                    max_keepalive_connections=config.OLLAMA_POOL_SIZE
+                )
+            )
+            # Match the server's OLLAMA_NUM_PARALLEL to keep it saturated
+            self._async_semaphore = asyncio.Semaphore(config.OLLAMA_MAX_PARALLEL)
+            self._async_loop = loop
+        return self._async_client, self._async_semaphore
+    
+    async def aclose(self):
+        """Close the async client's pooled connections"""
+        client, loop = self._async_client, self._async_loop
+        self._async_client = None
+        self._async_semaphore = None
+        self._async_loop = None
+        # A client from an earlier (closed) loop cannot be closed from this one
+        if client is not None and loop is asyncio.get_running_loop():
+            await client.aclose()
+    
     def _check_ollama(self):
         """Check if Ollama is accessible"""
+        self._ollama_checked = True
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/api/tags",
-                headers=self._get_headers()
+                timeout=self.timeout
             )
             if response.status_code == 200:
                 mode = "Ollama Cloud" if self.is_cloud else "Local Ollama"
@@ -47,7 +229,7 @@ class ClinicalGenerator:
                     print(f"✓ Available models: {[m['name'] for m in models]}")
             else:
                 print(f"⚠ Ollama returned status {response.status_code}")
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             if self.is_cloud:
                 print(f"⚠ WARNING: Cannot connect to Ollama Cloud")
                 print(f"  Check your API key and internet connection")
@@ -55,21 +237,318 @@ class ClinicalGenerator:
                 print(f"⚠ WARNING: Cannot connect to Ollama at {self.base_url}")
                 print("  Please start Ollama: ollama serve")
     
+    @staticmethod
+    def evidence_aliases(chunks: List[Dict[str, str]]) -> List[str]:
+        """
+        Prompt-local citation IDs (E1..En) for chunks, in prompt order
+        
+        Per-note aliases (chunk_3) repeat across notes of one patient, so the
+        prompt numbers its excerpts itself and citations resolve by position.
+        """
+        return [f"E{i}" for i in range(1, len(chunks) + 1)]
+    
     def format_chunks_for_prompt(self, chunks: List[Dict[str, str]]) -> str:
         """Format chunks for the generation prompt"""
         formatted = []
-        for chunk in chunks:
+        for alias, chunk in zip(self.evidence_aliases(chunks), chunks):
             formatted.append(
-                f"CHUNK_ID: {chunk['chunk_id']}\n"
+                f"CHUNK_ID: {alias}\n"
                 f"SECTION: {chunk['section']}\n"
                 f"TEXT: {chunk['text']}\n"
             )
         return '\n'.join(formatted)
     
+    @staticmethod
+    def iter_evidence(result: Dict) -> Iterator[Dict]:
+        """Every supporting_evidence item in the summary and differential"""
+        evidence = []
+        summary = result.get('summary')
+        if isinstance(summary, dict):
+            evidence.extend(summary.get('supporting_evidence') or [])
+        for dx in result.get('differential') or []:
+            if isinstance(dx, dict):
+                evidence.extend(dx.get('supporting_evidence') or [])
+        
+        return (ev for ev in evidence if isinstance(ev, dict))
+    
+    def cited_chunks(self, chunks: List[Dict[str, str]]) -> Dict[str, Dict[str, str]]:
+        """
+        Citation ID -> chunk for a prompt's chunks
+        
+        Prompt aliases (E1..En) always resolve; a per-note alias (chunk_3) is
+        also accepted when exactly one chunk in the prompt carries it.
+        """
+        aliases = Counter(chunk.get('chunk_id') for chunk in chunks)
+        cited = {
+            chunk['chunk_id']: chunk for chunk in chunks
+            if chunk.get('chunk_id') and aliases[chunk['chunk_id']] == 1
+        }
+        cited.update(zip(self.evidence_aliases(chunks), chunks))
+        return cited
+    
+    def resolve_chunk_ids(self, result: Dict, chunks: List[Dict[str, str]]):
+        """Attach the stored chunk ID and note of each cited excerpt"""
+        cited = self.cited_chunks(chunks)
+        for ev in self.iter_evidence(result):
+            chunk = cited.get(ev.get('chunk_id'))
+            if chunk is None or 'id' not in chunk:
+                continue
+            ev['source_id'] = chunk['id']
+            if chunk.get('note_id'):
+                ev['note_id'] = chunk['note_id']
+    
+    def resolve_offsets(self, result: Dict, chunks: List[Dict[str, str]]) -> Dict[str, int]:
+        """
+        Replace model-reported offsets with the quote's real position
+        
+        Each citation's quote is looked up in the cited chunk's text; when
+        found, `offset` becomes the chunk-relative span and `note_offset` the
+        span in the original note (for chunks that carry start/end). Every
+        citation gets `verified` so unsupported quotes are easy to flag.
+        
+        Returns:
+            Counts of verified and total citations
+        """
+        texts = self.cited_chunks(chunks)
+        counts = {"verified": 0, "total": 0}
+        
+        for ev in self.iter_evidence(result):
+            counts["total"] += 1
+            chunk = texts.get(ev.get('chunk_id'))
+            claimed = ev.get('offset')
+            hint = claimed[0] if isinstance(claimed, list) and claimed and isinstance(claimed[0], int) else None
+            span = None
+            if chunk is not None and isinstance(ev.get('quote'), str):
+                span = locate_quote(chunk['text'], ev['quote'], hint)
+            
+            ev['verified'] = span is not None
+            if span is None:
+                continue
+            
+            counts["verified"] += 1
+            ev['offset'] = list(span)
+            if chunk.get('start') is not None:
+                ev['note_offset'] = [chunk['start'] + span[0], chunk['start'] + span[1]]
+        
+        return counts
+    
+    def build_prompt(self, chunks: List[Dict[str, str]]) -> str:
+        """Build the full generation prompt for a set of chunks"""
+        chunks_text = self.format_chunks_for_prompt(chunks)
+        user_prompt = config.GENERATION_PROMPT_TEMPLATE.format(chunks=chunks_text)
+        return f"{config.SYSTEM_PROMPT}\n\n{user_prompt}"
+    
+    def _request_body(self, prompt: str, stream: bool) -> Dict:
+        """JSON body for /api/generate"""
+        body = {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": stream,
+            "options": {
+                "temperature": config.TEMPERATURE,
+                "num_predict": config.MAX_TOKENS
+            }
+        }
+        if self.structured_output:
+            body["format"] = generation_output_schema()
+        return body
+    
+    def _cached_generation(self, request_body: Dict) -> Optional[Dict]:
+        """Cached response for a request; sampled (temperature > 0) requests never hit"""
+        if self.generation_cache is None or config.TEMPERATURE > 0:
+            return None
+        return self.generation_cache.get(request_body)
+    
+    def _store_generation(self, request_body: Dict, response_data: Dict):
+        """Cache a successfully parsed response (without Ollama's token context)"""
+        if self.generation_cache is None or config.TEMPERATURE > 0:
+            return
+        self.generation_cache.put(
+            request_body,
+            {key: value for key, value in response_data.items() if key != 'context'}
+        )
+    
+    def _count_parse(self, path: str):
+        with self._stats_lock:
+            self.parse_stats[path] += 1
+    
+    def get_parse_stats(self) -> Dict[str, int]:
+        """Counts of how each generation was parsed
+        
+        structured: schema-constrained output parsed directly
+        direct / fenced: plain output parsed as-is / after stripping ``` fences
+        thinking_regex / thinking_raw: JSON recovered from the thinking field
+        failed: no valid JSON
+        """
+        with self._stats_lock:
+            return dict(self.parse_stats)
+    
+    def _parse_response(self, response_data: Dict) -> Tuple[Dict, str]:
+        """
+        Parse an Ollama response into the result dict
+        
+        Returns:
+            (result, parse_path); JSON errors are counted as 'failed' and re-raised
+        """
+        try:
+            generated_text, source = self._extract_generated_text(response_data)
+            result, parsed_as = self._parse_generated_text(generated_text)
+        except json.JSONDecodeError:
+            self._count_parse("failed")
+            raise
+        
+        if source != "response":
+            path = source
+        elif parsed_as == "direct" and self.structured_output:
+            path = "structured"
+        else:
+            path = parsed_as
+        
+        self._count_parse(path)
+        return result, path
+    
+    def _extract_generated_text(self, response_data: Dict) -> Tuple[str, str]:
+        """
+        Get the generated text from an Ollama response - try multiple fields
+        
+        Returns:
+            (text, source) where source is response, thinking_regex or thinking_raw
+        """
+        generated_text = ''
+        thinking_text = ''
+        source = "response"
+        
+        if response_data.get('response'):
+            generated_text = response_data['response']
+            print(f"DEBUG: Got response field ({len(generated_text)} chars)")
+        
+        if response_data.get('thinking'):
+            thinking_text = response_data['thinking']
+            print(f"DEBUG: Got thinking field ({len(thinking_text)} chars)")
+        
+        # If we have thinking but no response, extract JSON from thinking
+        if thinking_text and not generated_text:
+            # Look for JSON object in thinking
+            # Find JSON-like structures
+            json_pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
+            matches = list(re.finditer(json_pattern, thinking_text, re.DOTALL))
+            
+            if matches:
+                # Try the largest match first (likely the complete JSON)
+                matches.sort(key=lambda m: len(m.group()), reverse=True)
+                for match in matches:
+                    potential_json = match.group()
+                    try:
+                        # Try to parse it
+                        test = json.loads(potential_json)
+                        if 'summary' in test or 'differential' in test:
+                            generated_text = potential_json
+                            source = "thinking_regex"
+                            print(f"DEBUG: Extracted valid JSON from thinking ({len(generated_text)} chars)")
+                            break
+                    except:
+                        continue
+            
+            if not generated_text:
+                # Fallback: use full thinking
+                generated_text = thinking_text
+                source = "thinking_raw"
+                print("DEBUG: Using full thinking field as fallback")
+        
+        if not generated_text:
+            print("WARNING: Empty response from Ollama")
+            print(f"Full response data: {str(response_data)[:500]}")
+            raise Exception("Empty response from Ollama API")
+        
+        return generated_text, source
+    
+    def _parse_generated_text(self, generated_text: str) -> Tuple[Dict, str]:
+        """
+        Parse the model's JSON, unwrapping markdown code blocks if present
+        
+        Returns:
+            (result, 'direct' or 'fenced')
+        """
+        generated_text = generated_text.strip()
+        
+        # Fast path: structured output (and most plain output) is bare JSON
+        if generated_text.startswith('{'):
+            try:
+                return json.loads(generated_text), "direct"
+            except json.JSONDecodeError:
+                pass
+        
+        # Sometimes models wrap JSON in markdown code blocks
+        if '```json' in generated_text:
+            generated_text = generated_text.split('```json')[1].split('```')[0].strip()
+        elif '```' in generated_text:
+            generated_text = generated_text.split('```')[1].split('```')[0].strip()
+        
+        return json.loads(generated_text), "fenced"
+    
+    def _finalize_result(
+        self,
+        result: Dict,
+        chunks: List[Dict[str, str]],
+        patient_id: str,
+        parse_path: str,
+        cache_hit: bool = False,
+        timings: Dict[str, float] = None,
+        response_data: Dict = None
+    ) -> Dict:
+        """
+        Add metadata, patient ID and resolved citations to a parsed result
+        
+        Stage timings and, for fresh (non-cached) generations, Ollama's own
+        token counts and durations from `response_data` are included.
+        """
+        if "model_metadata" not in result:
+            result["model_metadata"] = {}
+        
+        cost_info = "Ollama Cloud (cheap!)" if self.is_cloud else "FREE (local)"
+        result["model_metadata"].update({
+            "llm_model": self.model,
+            "embedding_model": config.LOCAL_EMBEDDING_MODEL,
+            "retrieval_k": len(chunks),
+            "cost": cost_info,
+            "parse_path": parse_path,
+            "generation_cache_hit": cache_hit,
+            "timings": rounded(timings or {})
+        })
+        if response_data is not None and not cache_hit:
+            result["model_metadata"]["ollama_stats"] = ollama_stats(response_data)
+        
+        if patient_id and not result.get("patient_id"):
+            result["patient_id"] = patient_id
+        
+        # Citations use prompt aliases (E3); map them to stored IDs and notes
+        # and check each quote against the chunk text rather than trusting offsets
+        self.resolve_chunk_ids(result, chunks)
+        result["model_metadata"]["evidence"] = self.resolve_offsets(result, chunks)
+        
+        return result
+    
+    def error_result(self, error: str, warning: str, chunks: List[Dict[str, str]], patient_id: str) -> Dict:
+        """Empty result carrying an error, in the same shape as a successful one"""
+        return {
+            "error": error,
+            "patient_id": patient_id,
+            "summary": {"text": [], "supporting_evidence": []},
+            "differential": [],
+            "warnings": [warning],
+            "model_metadata": {
+                "llm_model": self.model,
+                "embedding_model": config.LOCAL_EMBEDDING_MODEL,
+                "retrieval_k": len(chunks),
+                "cost": "FREE"
+            }
+        }
+    
     def generate_clinical_output(
         self, 
         chunks: List[Dict[str, str]], 
-        patient_id: str = None
+        patient_id: str = None,
+        on_event: Callable[[Dict], None] = None
     ) -> Dict:
         """
         Generate clinical summary and differential diagnoses from chunks
@@ -78,148 +557,249 @@ class ClinicalGenerator:
         Args:
             chunks: List of retrieved chunks
             patient_id: Optional patient identifier
+            on_event: Optional callback; if given, the output is streamed and
+                the callback receives each summary bullet and differential
+                entry as soon as it is complete (see stream_clinical_output)
         
         Returns:
             Structured JSON output with summary and differential diagnoses
         """
-        # Format chunks for prompt
-        chunks_text = self.format_chunks_for_prompt(chunks)
+        if on_event is not None:
+            result = None
+            for event in self.stream_clinical_output(chunks, patient_id=patient_id):
+                if event["type"] == "result":
+                    result = event["data"]
+                else:
+                    on_event(event)
+            return result
         
         # Build the generation prompt
-        user_prompt = config.GENERATION_PROMPT_TEMPLATE.format(chunks=chunks_text)
-        full_prompt = f"{config.SYSTEM_PROMPT}\n\n{user_prompt}"
+        full_prompt = self.build_prompt(chunks)
+        request_body = self._request_body(full_prompt, stream=False)
+        generated_text = ''
+        timings = {}
         
-        # Call Ollama API
+        # Call Ollama API (unless this exact request was answered before)
         try:
-            mode_desc = "Ollama Cloud" if self.is_cloud else "local"
-            print(f"Generating with {self.model} ({mode_desc} model)...")
+            response_data = self._cached_generation(request_body)
+            cache_hit = response_data is not None
             
-            response = requests.post(
-                f"{self.base_url}/api/generate",
-                headers=self._get_headers(),
-                json={
-                    "model": self.model,
-                    "prompt": full_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": config.TEMPERATURE,
-                        "num_predict": config.MAX_TOKENS
-                    }
-                },
-                timeout=180  # Longer timeout for cloud/large models
-            )
-            
-            if response.status_code != 200:
-                print(f"ERROR: Ollama API returned status {response.status_code}")
-                print(f"Response: {response.text[:500]}")
-                raise Exception(f"Ollama API returned status {response.status_code}: {response.text}")
-            
-            response_data = response.json()
+            if cache_hit:
+                print(f"✓ Reusing cached generation from {self.model} (prompt unchanged)")
+            else:
+                if not self._ollama_checked:
+                    self._check_ollama()
+                
+                mode_desc = "Ollama Cloud" if self.is_cloud else "local"
+                print(f"Generating with {self.model} ({mode_desc} model)...")
+                
+                with timed("http_generation", timings):
+                    response = self.session.post(
+                        f"{self.base_url}/api/generate",
+                        json=request_body,
+                        timeout=self.timeout
+                    )
+                    
+                    if response.status_code != 200:
+                        print(f"ERROR: Ollama API returned status {response.status_code}")
+                        print(f"Response: {response.text[:500]}")
+                        raise Exception(f"Ollama API returned status {response.status_code}: {response.text}")
+                    
+                    response_data = response.json()
             
-            # Get the generated text - try multiple fields
-            generated_text = ''
-            thinking_text = ''
+            generated_text = response_data.get('response') or response_data.get('thinking') or ''
             
-            if response_data.get('response'):
-                generated_text = response_data['response']
-                print(f"DEBUG: Got response field ({len(generated_text)} chars)")
+            # Parse response
+            with timed("json_parse", timings):
+                result, parse_path = self._parse_response(response_data)
+            if not cache_hit:
+                self._store_generation(request_body, response_data)
+            return self._finalize_result(
+                result, chunks, patient_id, parse_path, cache_hit, timings, response_data
+            )
             
-            if response_data.get('thinking'):
-                thinking_text = response_data['thinking']
-                print(f"DEBUG: Got thinking field ({len(thinking_text)} chars)")
+        except json.JSONDecodeError as e:
+            print(f"Error parsing JSON response: {e}")
+            print(f"Raw response: {generated_text[:500]}...")
+            return self.error_result(
+                "Failed to parse LLM response",
+                f"JSON parsing error: {str(e)}. Try using a different model or adjusting the prompt.",
+                chunks, patient_id
+            )
+        except Exception as e:
+            print(f"Error generating output: {e}")
+            return self.error_result(str(e), f"Generation error: {str(e)}", chunks, patient_id)
+    
+    async def agenerate_clinical_output(
+        self,
+        chunks: List[Dict[str, str]],
+        patient_id: str = None
+    ) -> Dict:
+        """
+        Async variant of generate_clinical_output
+        
+        All calls share one httpx.AsyncClient, and at most OLLAMA_MAX_PARALLEL
+        generations are in flight at once, so many notes can be analyzed
+        concurrently from a single process.
+        """
+        full_prompt = self.build_prompt(chunks)
+        request_body = self._request_body(full_prompt, stream=False)
+        generated_text = ''
+        timings = {}
+        
+        try:
+            response_data = self._cached_generation(request_body)
+            cache_hit = response_data is not None
             
-            # If we have thinking but no response, extract JSON from thinking
-            if thinking_text and not generated_text:
-                # Look for JSON object in thinking
-                import re
-                # Find JSON-like structures
-                json_pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
-                matches = list(re.finditer(json_pattern, thinking_text, re.DOTALL))
+            if cache_hit:
+                print(f"✓ Reusing cached generation from {self.model} (prompt unchanged)")
+            else:
+                client, semaphore = self._get_async_client()
+                if not self._ollama_checked:
+                    await asyncio.get_running_loop().run_in_executor(None, self._check_ollama)
                 
-                if matches:
-                    # Try the largest match first (likely the complete JSON)
-                    matches.sort(key=lambda m: len(m.group()), reverse=True)
-                    for match in matches:
-                        potential_json = match.group()
-                        try:
-                            # Try to parse it
-                            test = json.loads(potential_json)
-                            if 'summary' in test or 'differential' in test:
-                                generated_text = potential_json
-                                print(f"DEBUG: Extracted valid JSON from thinking ({len(generated_text)} chars)")
-                                break
-                        except:
-                            continue
+                async with semaphore:
+                    mode_desc = "Ollama Cloud" if self.is_cloud else "local"
+                    print(f"Generating with {self.model} ({mode_desc} model, async)...")
+                    
+                    with timed("http_generation", timings):
+                        response = await client.post(
+                            f"{self.base_url}/api/generate",
+                            json=request_body
+                        )
+                
+                if response.status_code != 200:
+                    print(f"ERROR: Ollama API returned status {response.status_code}")
+                    print(f"Response: {response.text[:500]}")
+                    raise Exception(f"Ollama API returned status {response.status_code}: {response.text}")
                 
-                if not generated_text:
-                    # Fallback: use full thinking
-                    generated_text = thinking_text
-                    print("DEBUG: Using full thinking field as fallback")
+                response_data = response.json()
             
-            if not generated_text:
-                print("WARNING: Empty response from Ollama")
-                print(f"Full response data: {str(response_data)[:500]}")
-                raise Exception("Empty response from Ollama API")
-            
-            # Try to extract JSON from response
-            # Sometimes models wrap JSON in markdown code blocks
-            generated_text = generated_text.strip()
-            if '```json' in generated_text:
-                generated_text = generated_text.split('```json')[1].split('```')[0].strip()
-            elif '```' in generated_text:
-                generated_text = generated_text.split('```')[1].split('```')[0].strip()
+            generated_text = response_data.get('response') or response_data.get('thinking') or ''
             
             # Parse response
-            result = json.loads(generated_text)
-            
-            # Add metadata
-            if "model_metadata" not in result:
-                result["model_metadata"] = {}
+            with timed("json_parse", timings):
+                result, parse_path = self._parse_response(response_data)
+            if not cache_hit:
+                self._store_generation(request_body, response_data)
+            return self._finalize_result(
+                result, chunks, patient_id, parse_path, cache_hit, timings, response_data
+            )
             
-            cost_info = "Ollama Cloud (cheap!)" if self.is_cloud else "FREE (local)"
-            result["model_metadata"].update({
-                "llm_model": self.model,
-                "embedding_model": config.LOCAL_EMBEDDING_MODEL,
-                "retrieval_k": len(chunks),
-                "cost": cost_info
-            })
+        except json.JSONDecodeError as e:
+            print(f"Error parsing JSON response: {e}")
+            print(f"Raw response: {generated_text[:500]}...")
+            return self.error_result(
+                "Failed to parse LLM response",
+                f"JSON parsing error: {str(e)}. Try using a different model or adjusting the prompt.",
+                chunks, patient_id
+            )
+        except Exception as e:
+            print(f"Error generating output: {e}")
+            return self.error_result(str(e), f"Generation error: {str(e)}", chunks, patient_id)
+    
+    def stream_clinical_output(
+        self,
+        chunks: List[Dict[str, str]],
+        patient_id: str = None
+    ) -> Iterator[Dict]:
+        """
+        Stream generation and yield output pieces as soon as they are complete
+        
+        Consumes Ollama's NDJSON token stream and parses the JSON incrementally.
+        
+        Yields:
+            {"type": "summary_bullet", "index": i, "data": str}
+            {"type": "differential", "index": i, "data": dict}
+            and finally {"type": "result", "data": <full result dict>}
+        """
+        full_prompt = self.build_prompt(chunks)
+        request_body = self._request_body(full_prompt, stream=True)
+        parser = IncrementalJSONParser(watch=STREAM_EVENT_TYPES.keys())
+        generated_text = ''
+        timings = {}
+        
+        try:
+            response_data = self._cached_generation(request_body)
+            cache_hit = response_data is not None
             
-            if patient_id and not result.get("patient_id"):
-                result["patient_id"] = patient_id
+            if cache_hit:
+                print(f"✓ Reusing cached generation from {self.model} (prompt unchanged)")
+                for path, index, value in parser.feed(response_data.get('response') or ''):
+                    yield {"type": STREAM_EVENT_TYPES[path], "index": index, "data": value}
+            else:
+                if not self._ollama_checked:
+                    self._check_ollama()
+                
+                mode_desc = "Ollama Cloud" if self.is_cloud else "local"
+                print(f"Streaming with {self.model} ({mode_desc} model)...")
+                
+                response_parts = []
+                thinking_parts = []
+                final_message = {}
+                
+                # Includes time spent in the consumer between streamed events
+                stream_start = time.perf_counter()
+                with self.session.post(
+                    f"{self.base_url}/api/generate",
+                    json=request_body,
+                    timeout=self.timeout,
+                    stream=True
+                ) as response:
+                    if response.status_code != 200:
+                        print(f"ERROR: Ollama API returned status {response.status_code}")
+                        print(f"Response: {response.text[:500]}")
+                        raise Exception(f"Ollama API returned status {response.status_code}: {response.text}")
+                    
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        message = json.loads(line)
+                        if message.get('error'):
+                            raise Exception(f"Ollama stream error: {message['error']}")
+                        
+                        if message.get('thinking'):
+                            thinking_parts.append(message['thinking'])
+                        
+                        piece = message.get('response')
+                        if piece:
+                            response_parts.append(piece)
+                            for path, index, value in parser.feed(piece):
+                                yield {"type": STREAM_EVENT_TYPES[path], "index": index, "data": value}
+                        
+                        if message.get('done'):
+                            final_message = message
+                            break
+                record("http_generation", time.perf_counter() - stream_start, timings)
+                
+                response_data = {
+                    **final_message,
+                    "response": ''.join(response_parts),
+                    "thinking": ''.join(thinking_parts)
+                }
             
-            return result
+            generated_text = response_data.get('response') or response_data.get('thinking') or ''
+            with timed("json_parse", timings):
+                result, parse_path = self._parse_response(response_data)
+            if not cache_hit:
+                self._store_generation(request_body, response_data)
+            yield {"type": "result", "data": self._finalize_result(
+                result, chunks, patient_id, parse_path, cache_hit, timings, response_data
+            )}
             
         except json.JSONDecodeError as e:
             print(f"Error parsing JSON response: {e}")
             print(f"Raw response: {generated_text[:500]}...")
-            return {
-                "error": "Failed to parse LLM response",
-                "patient_id": patient_id,
-                "summary": {"text": [], "supporting_evidence": []},
-                "differential": [],
-                "warnings": [f"JSON parsing error: {str(e)}. Try using a different model or adjusting the prompt."],
-                "model_metadata": {
-                    "llm_model": self.model,
-                    "embedding_model": config.LOCAL_EMBEDDING_MODEL,
-                    "retrieval_k": len(chunks),
-                    "cost": "FREE"
-                }
-            }
+            yield {"type": "result", "data": self.error_result(
+                "Failed to parse LLM response",
+                f"JSON parsing error: {str(e)}. Try using a different model or adjusting the prompt.",
+                chunks, patient_id
+            )}
         except Exception as e:
             print(f"Error generating output: {e}")
-            return {
-                "error": str(e),
-                "patient_id": patient_id,
-                "summary": {"text": [], "supporting_evidence": []},
-                "differential": [],
-                "warnings": [f"Generation error: {str(e)}"],
-                "model_metadata": {
-                    "llm_model": self.model,
-                    "embedding_model": config.LOCAL_EMBEDDING_MODEL,
-                    "retrieval_k": len(chunks),
-                    "cost": "FREE"
-                }
-            }
+            yield {"type": "result", "data": self.error_result(
+                str(e), f"Generation error: {str(e)}", chunks, patient_id
+            )}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+"""
+Bulk ingest engine for back-filling the vector DB
+Chunks notes in a process pool, embeds them in N embedding worker processes
+and writes to Chroma from a single writer thread, with bounded queues between
+the stages so memory stays flat however many notes are fed in
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from typing import Dict, Iterable, List
+
+import numpy as np
+from chunker import ClinicalNoteChunker
+from config import config
+
+# Per-process state of pool workers (set by the initializers below)
+_chunker = None
+_model = None
+
+# Marks the end of a stage's queue
+_DONE = object()
+
+
+def _init_chunk_worker():
+    global _chunker
+    _chunker = ClinicalNoteChunker()
+
+
+def _chunk_note(note: str, patient_id: str, encounter_id: str, note_id: str) -> List[Dict]:
+    return _chunker.process_note(
+        note, patient_id=patient_id, encounter_id=encounter_id, note_id=note_id
+    )
+
+
+def _init_embedding_worker(model_name: str, threads: int):
+    """Load the model with `threads` intra-op threads so workers x threads fits the cores"""
+    global _model
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    _model = SentenceTransformer(model_name)
+
+
+def _embed_texts(texts: List[str], batch_size: int) -> np.ndarray:
+    return _model.encode(
+        texts,
+        batch_size=batch_size,
+        convert_to_numpy=True,
+        show_progress_bar=False
+    ).astype(np.float32, copy=False)
+
+
+def default_workers(embed_workers: int = None, cpu_count: int = None) -> Dict[str, int]:
+    """
+    Worker counts for this machine, where not given or configured
+
+    Embedding gets the cores as several processes with a few intra-op
+    threads each (one process per 4 cores by default), which scales better
+    than one process with many threads; workers x threads never exceeds the
+    core count. Chunking is cheap and gets a small pool.
+    """
+    cpus = cpu_count or os.cpu_count() or 1
+    embed_workers = embed_workers or config.INGEST_EMBED_WORKERS or max(1, cpus // 4)
+    return {
+        "chunk_workers": config.INGEST_CHUNK_WORKERS or max(1, min(8, cpus // 8)),
+        "embed_workers": embed_workers,
+        "threads_per_worker": config.INGEST_THREADS_PER_WORKER or max(1, cpus // embed_workers),
+    }
+
+
+class ProcessEncoder:
+    """
+    Embedding-batcher hook (see ClinicalRAGRetriever.embedding_batcher) that
+    runs forward passes in a pool of model-loading worker processes
+
+    Each call is split into EMBEDDING_BATCH_SIZE pieces spread over the
+    workers, so one large note keeps every worker busy.
+    """
+
+    def __init__(self, workers: int, threads_per_worker: int, batch_size: int = None):
+        self.batch_size = batch_size or config.EMBEDDING_BATCH_SIZE
+        self.texts = 0
+        self._lock = threading.Lock()
+        self._pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_embedding_worker,
+            initargs=(config.LOCAL_EMBEDDING_MODEL, threads_per_worker)
+        )
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        futures = [
+            self._pool.submit(_embed_texts, texts[start:start + self.batch_size], self.batch_size)
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        with self._lock:
+            self.texts += len(texts)
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+class BulkIngestor:
+    """
+    Three-stage ingest: chunk (process pool) -> embed (N worker processes)
+    -> write (one thread owning all Chroma writes)
+
+    Notes go through the same incremental path as ClinicalRAGPipeline.index_note,
+    so re-running an ingest skips unchanged notes and only rewrites revised ones.
+    """
+
+    def __init__(
+        self,
+        pipeline=None,
+        chunk_workers: int = None,
+        embed_workers: int = None,
+        threads_per_worker: int = None,
+        queue_size: int = None,
+        encoder=None
+    ):
+        from pipeline import ClinicalRAGPipeline
+
+        defaults = default_workers(embed_workers)
+        self.chunk_workers = chunk_workers or defaults["chunk_workers"]
+        self.embed_workers = defaults["embed_workers"]
+        self.threads_per_worker = threads_per_worker or defaults["threads_per_worker"]
+        self.queue_size = queue_size or config.INGEST_QUEUE_SIZE
+        self.pipeline = pipeline or ClinicalRAGPipeline()
+        # Embedding-batcher hook; a ProcessEncoder pool is started per ingest if
+        # unset. A hook that counts what it encodes in `texts` (as ProcessEncoder
+        # does) gets embedded_texts reported; others report None.
+        self.encoder = encoder
+        self.errors: List[Dict] = []
+
+    def ingest(self, records: Iterable[Dict]) -> Dict:
+        """
+        Index every record ({note, patient_id?, encounter_id?, note_id?, record_id?})
+
+        A record without note_id uses its record_id (or else a hash of its
+        text), so distinct files or lines of one patient never overwrite
+        each other.
+
+        Returns:
+            Counts (notes, chunks, unchanged notes, chunks reused from the
+            index, embedded texts, errors) and throughput for this run;
+            the failed records are in `errors`
+        """
+        retriever = self.pipeline.retriever
+        retriever.get_collection()
+        self.errors = []
+
+        encoder = self.encoder or ProcessEncoder(self.embed_workers, self.threads_per_worker)
+        texts_before = getattr(encoder, "texts", None)
+        previous_batcher = retriever.embedding_batcher
+        retriever.embedding_batcher = encoder
+
+        chunked: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        embedded: "queue.Queue" = queue.Queue(maxsize=self.queue_size)
+        stats = {"notes": 0, "chunks": 0, "unchanged": 0, "reused_chunks": 0}
+        stats_lock = threading.Lock()
+        start = time.perf_counter()
+
+        print(f"Ingesting with {self.chunk_workers} chunk worker(s), {self.embed_workers} "
+              f"embedding worker(s) x {self.threads_per_worker} thread(s), queues of {self.queue_size}")
+
+        embedders = [
+            threading.Thread(target=self._embed_stage, args=(chunked, embedded), name=f"ingest-embed-{i}")
+            for i in range(self.embed_workers)
+        ]
+        writer = threading.Thread(
+            target=self._write_stage, args=(embedded, stats, stats_lock), name="ingest-writer"
+        )
+        for thread in embedders + [writer]:
+            thread.start()
+
+        try:
+            self._chunk_stage(records, chunked)
+        finally:
+            for _ in embedders:
+                chunked.put(_DONE)
+            for thread in embedders:
+                thread.join()
+            embedded.put(_DONE)
+            writer.join()
+            retriever.embedding_batcher = previous_batcher
+            if encoder is not self.encoder:
+                encoder.close()
+
+        elapsed = time.perf_counter() - start
+        return {
+            **stats,
+            "embedded_texts": None if texts_before is None else encoder.texts - texts_before,
+            "errors": len(self.errors),
+            "seconds": round(elapsed, 3),
+            "notes_per_sec": round(stats["notes"] / elapsed, 2) if elapsed else 0.0,
+            "chunks_per_sec": round(stats["chunks"] / elapsed, 1) if elapsed else 0.0
+        }
+
+    def _fail(self, record: Dict, stage: str, error: Exception):
+        self.errors.append({"record_id": record.get("record_id"), "stage": stage, "error": str(error)})
+        print(f"⚠ {record.get('record_id', '?')}: {stage} failed: {error}")
+
+    def _chunk_stage(self, records: Iterable[Dict], chunked: "queue.Queue"):
+        """Fan chunking out over processes, at most queue_size notes in flight"""
+        pool = ProcessPoolExecutor(
+            max_workers=self.chunk_workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_chunk_worker
+        )
+        pending = {}
+
+        def drain(block: bool):
+            if block:
+                done = wait(pending, return_when=FIRST_COMPLETED).done
+            else:
+                done = [future for future in pending if future.done()]
+            for future in done:
+                record = pending.pop(future)
+                try:
+                    chunked.put((record, future.result()))
+                except Exception as e:
+                    self._fail(record, "chunking", e)
+
+        try:
+            for record in records:
+                record = self._scoped(record)
+                future = pool.submit(
+                    _chunk_note, record["note"], record["patient_id"],
+                    record["encounter_id"], record["note_id"]
+                )
+                pending[future] = {key: value for key, value in record.items() if key != "note"}
+                drain(block=len(pending) >= self.queue_size)
+            while pending:
+                drain(block=True)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _scoped(record: Dict) -> Dict:
+        return {
+            **record,
+            "patient_id": record.get("patient_id") or "unknown",
+            "encounter_id": record.get("encounter_id") or "unknown",
+            "note_id": (
+                record.get("note_id") or record.get("record_id")
+                or ClinicalNoteChunker.default_note_id(record.get("note") or "")
+            )
+        }
+
+    def _embed_stage(self, chunked: "queue.Queue", embedded: "queue.Queue"):
+        """Embed the chunks of each note that the index does not have yet"""
+        retriever = self.pipeline.retriever
+        while True:
+            item = chunked.get()
+            if item is _DONE:
+                return
+            record, chunks = item
+
+            embeddings: Dict[str, np.ndarray] = {}
+            try:
+                # Chunks already in the note's manifest entry are reused, not re-embedded
+                previous = retriever.manifest.get(record["patient_id"], record["note_id"]) or {}
+                missing = list({
+                    chunk["id"]: chunk["text"] for chunk in chunks if chunk["id"] not in previous
+                }.items())
+                if missing:
+                    vectors = retriever.get_embeddings([text for _, text in missing])
+                    embeddings = {chunk_key: vector for (chunk_key, _), vector in zip(missing, vectors)}
+            except Exception as e:
+                self._fail(record, "embedding", e)
+                continue
+            embedded.put((record, chunks, embeddings, len(chunks) - len(missing)))
+
+    def _write_stage(self, embedded: "queue.Queue", stats: Dict, stats_lock: threading.Lock):
+        """The only thread that writes to Chroma"""
+        while True:
+            item = embedded.get()
+            if item is _DONE:
+                return
+            record, chunks, embeddings, reused = item
+            try:
+                changes = self.pipeline._store_chunks(
+                    chunks, record["patient_id"], record["encounter_id"], record["note_id"],
+                    embeddings=embeddings
+                )
+            except Exception as e:
+                self._fail(record, "write", e)
+                continue
+
+            with stats_lock:
+                stats["notes"] += 1
+                stats["chunks"] += len(chunks)
+                stats["reused_chunks"] += reused
+                if not changes["added"] and not changes["removed"]:
+                    stats["unchanged"] += 1
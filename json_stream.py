@@ -0,0 +1,156 @@
+"""
+Incremental JSON parsing for streamed LLM output
+Emits array elements (summary bullets, differential entries) as soon as they are complete
+"""
+import json
+from typing import Any, Dict, Iterable, List, Tuple
+
+WHITESPACE = ' \t\r\n'
+
+
+class IncrementalJSONParser:
+    """
+    Scans a JSON object as it streams in and reports completed elements of
+    watched arrays
+
+    Paths are tuples of object keys from the root, e.g. ("summary", "text")
+    for the summary bullets or ("differential",) for the differential list.
+    Text before the root '{' (such as a ```json fence) is skipped.
+    """
+
+    def __init__(self, watch: Iterable[Tuple[str, ...]]):
+        self.watch = {tuple(path) for path in watch}
+        self.text = ''
+        self.complete = False
+
+        self._pos = 0
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._stack: List[Dict[str, Any]] = []
+        self._counts: Dict[Tuple[str, ...], int] = {}
+
+    def feed(self, piece: str) -> List[Tuple[Tuple[str, ...], int, Any]]:
+        """
+        Add streamed text
+
+        Returns:
+            List of (path, index, value) for each watched element completed by this piece
+        """
+        self.text += piece
+        events = []
+        text = self.text
+
+        while self._pos < len(text) and not self.complete:
+            i = self._pos
+            c = text[i]
+            self._pos += 1
+
+            if not self._started:
+                if c == '{':
+                    self._started = True
+                    self._push('{', ())
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._end_string(i, events)
+                continue
+
+            if c in WHITESPACE:
+                continue
+
+            top = self._stack[-1]
+            if top["kind"] == '[' and top["elem_start"] is None \
+                    and not top["after_value"] and c not in ',]':
+                top["elem_start"] = i
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in '{[':
+                if top["kind"] == '{':
+                    path = top["path"] + (top["key"],)
+                else:
+                    path = top["path"] + ('*',)
+                self._push(c, path)
+            elif c in '}]':
+                frame = self._stack.pop()
+                if frame["kind"] == '[':
+                    self._end_scalar(frame, i, events)
+                if not self._stack:
+                    self.complete = True
+                    break
+                parent = self._stack[-1]
+                if parent["kind"] == '[':
+                    self._emit(parent, text[parent["elem_start"]:i + 1], events)
+                    parent["elem_start"] = None
+                    parent["after_value"] = True
+            elif c == ',':
+                if top["kind"] == '[':
+                    self._end_scalar(top, i, events)
+                    top["after_value"] = False
+                else:
+                    top["expect_key"] = True
+            elif c == ':' and top["kind"] == '{':
+                top["expect_key"] = False
+
+        return events
+
+    def _push(self, kind: str, path: Tuple[str, ...]):
+        self._stack.append({
+            "kind": kind,
+            "path": path,
+            "key": None,
+            "expect_key": True,
+            "elem_start": None,
+            "after_value": False
+        })
+
+    def _end_string(self, end: int, events: List):
+        """Handle a closed string: an object key or a complete array element"""
+        top = self._stack[-1]
+        literal = self.text[self._string_start:end + 1]
+
+        if top["kind"] == '{' and top["expect_key"]:
+            top["key"] = json.loads(literal)
+        elif top["kind"] == '[' and top["elem_start"] == self._string_start:
+            self._emit(top, literal, events)
+            top["elem_start"] = None
+            top["after_value"] = True
+
+    def _end_scalar(self, frame: Dict, end: int, events: List):
+        """Emit a number/true/false/null element ended by ',' or ']'"""
+        if frame["elem_start"] is not None:
+            self._emit(frame, self.text[frame["elem_start"]:end].strip(), events)
+            frame["elem_start"] = None
+
+    def _emit(self, frame: Dict, literal: str, events: List):
+        path = frame["path"]
+        if path not in self.watch:
+            return
+        try:
+            value = json.loads(literal)
+        except json.JSONDecodeError:
+            return
+        index = self._counts.get(path, 0)
+        self._counts[path] = index + 1
+        events.append((path, index, value))
+
+
+if __name__ == "__main__":
+    # Test the incremental parser on a stream split into small pieces
+    sample = '```json\n{"summary": {"text": ["Fever \\"39C\\"", "Cough"]}, ' \
+             '"differential": [{"rank": 1, "diagnosis": "CAP"}, {"rank": 2, "diagnosis": "Flu"}]}\n```'
+
+    parser = IncrementalJSONParser(watch=[("summary", "text"), ("differential",)])
+    for start in range(0, len(sample), 5):
+        for path, index, value in parser.feed(sample[start:start + 5]):
+            print(f"{'.'.join(path)}[{index}] -> {value}")
+    print(f"Complete: {parser.complete}")
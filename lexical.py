@@ -0,0 +1,187 @@
+"""
+In-process BM25 keyword index for the Clinical RAG System
+Finds exact clinical tokens (drug names, lab codes, doses) that dense
+embeddings retrieve poorly, without calling the embedding model
+"""
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Words, numbers and compound tokens such as 150/90, 38.9, HbA1c or 1000mg
+TOKEN = re.compile(r'\w+(?:[./]\w+)*')
+
+# Digit/letter boundaries, so "1000mg" also matches a query for "1000 mg"
+ALPHA_NUMERIC = re.compile(r'\d+(?:\.\d+)?|[^\W\d_]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms of a text, plus the parts of mixed tokens like 1000mg or 150/90"""
+    terms = []
+    for token in TOKEN.findall(text.lower()):
+        terms.append(token)
+        parts = ALPHA_NUMERIC.findall(token)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Fuse ranked ID lists: score(id) = sum over lists of 1 / (k + rank)
+
+    Returns:
+        (id, score) pairs, best first; ties keep first-seen order
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class BM25Index:
+    """
+    Incrementally updated inverted index with Okapi BM25 scoring
+
+    Each document is a chunk key with its scope (patient, encounter, note),
+    so searches can be restricted like the metadata filters on Chroma.
+    Removal deletes postings, so scores always match the live documents.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._postings: Dict[str, Dict[int, int]] = {}   # term -> slot -> term frequency
+        self._keys: List[Optional[str]] = []              # slot -> chunk key (None if free)
+        self._slots: Dict[str, int] = {}                  # chunk key -> slot
+        self._terms: List[Tuple[str, ...]] = []           # slot -> distinct terms
+        self._lengths: List[int] = []
+        self._scopes: List[Tuple[str, str, str]] = []
+        self._free: List[int] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._slots
+
+    def add(self, key: str, text: str, patient_id: str = None, encounter_id: str = None, note_id: str = None):
+        """Index (or re-index) one chunk"""
+        counts = Counter(tokenize(text))
+        length = sum(counts.values())
+        scope = (patient_id or "unknown", encounter_id or "unknown", note_id or "unknown")
+
+        with self._lock:
+            if key in self._slots:
+                self._remove(key)
+
+            if self._free:
+                slot = self._free.pop()
+                self._keys[slot] = key
+                self._terms[slot] = tuple(counts)
+                self._lengths[slot] = length
+                self._scopes[slot] = scope
+            else:
+                slot = len(self._keys)
+                self._keys.append(key)
+                self._terms.append(tuple(counts))
+                self._lengths.append(length)
+                self._scopes.append(scope)
+
+            self._slots[key] = slot
+            self._total_length += length
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[slot] = count
+
+    def remove(self, keys: Iterable[str]):
+        """Drop chunks from the index (unknown keys are ignored)"""
+        with self._lock:
+            for key in keys:
+                if key in self._slots:
+                    self._remove(key)
+
+    def remove_where(self, patient_id: str, encounter_id: str = None, note_id: str = None):
+        """Drop a patient's chunks (optionally only one encounter's or note's)"""
+        with self._lock:
+            doomed = [
+                key for key, slot in self._slots.items()
+                if self._in_scope(slot, patient_id, encounter_id, note_id)
+            ]
+            for key in doomed:
+                self._remove(key)
+
+    def _remove(self, key: str):
+        slot = self._slots.pop(key)
+        for term in self._terms[slot]:
+            postings = self._postings[term]
+            del postings[slot]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= self._lengths[slot]
+        self._keys[slot] = None
+        self._terms[slot] = ()
+        self._free.append(slot)
+
+    def _in_scope(self, slot: int, patient_id: str, encounter_id: str, note_id: str) -> bool:
+        patient, encounter, note = self._scopes[slot]
+        return (
+            (not patient_id or patient == patient_id)
+            and (not encounter_id or encounter == encounter_id)
+            and (not note_id or note == note_id)
+        )
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Top-k chunk keys by BM25 score for a keyword query
+
+        Returns:
+            (chunk key, score) pairs, best first; chunks matching no query term are omitted
+        """
+        terms = Counter(tokenize(query))
+        with self._lock:
+            documents = len(self._slots)
+            if not documents or not terms:
+                return []
+            average_length = self._total_length / documents
+
+            scores: Dict[int, float] = {}
+            for term, query_count in terms.items():
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                for slot, count in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[slot] / average_length)
+                    scores[slot] = scores.get(slot, 0.0) + query_count * idf * count * (self.k1 + 1) / (count + norm)
+
+            if patient_id or encounter_id or note_id:
+                scores = {
+                    slot: score for slot, score in scores.items()
+                    if self._in_scope(slot, patient_id, encounter_id, note_id)
+                }
+            top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(self._keys[slot], score) for slot, score in top]
+
+
+if __name__ == "__main__":
+    # Test the keyword index
+    index = BM25Index()
+    index.add("a", "Metformin 1000mg BID for type 2 diabetes", patient_id="PT001")
+    index.add("b", "Lisinopril 10mg daily; BP 150/90", patient_id="PT001")
+    index.add("c", "Metformin held due to AKI", patient_id="PT002")
+    print(f"Tokens: {tokenize('Metformin 1000mg, BP 150/90')}")
+    print(f"'metformin 1000 mg': {index.search('metformin 1000 mg', 3)}")
+    print(f"'metformin' for PT002: {index.search('metformin', 3, patient_id='PT002')}")
+    print(f"RRF: {reciprocal_rank_fusion([['a', 'b'], ['b', 'c']])}")
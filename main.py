@@ -6,13 +6,25 @@ Works with both FREE (local) and PAID (OpenAI) versions
 import argparse
 import json
 import sys
+import time
 from pathlib import Path
-from pipeline import ClinicalRAGPipeline
+from typing import Dict, Iterator, Set
 from sample_notes import get_sample_note, list_cases
-from config import config
 
+# pipeline (chromadb, sentence-transformers, requests) is imported inside the
+# commands that need it, so --help and --list-cases start instantly
 
-def run_demo(case_name: str = "pneumonia_case", output_file: str = None):
+
+def print_stream_event(event: dict):
+    """Print summary bullets and diagnoses as soon as the LLM completes them"""
+    if event["type"] == "summary_bullet":
+        print(f"  • {event['data']}")
+    elif event["type"] == "differential":
+        dx = event["data"]
+        print(f"  {dx.get('rank', event['index'] + 1)}. {dx.get('diagnosis', 'Unknown')}")
+
+
+def run_demo(case_name: str = "pneumonia_case", output_file: str = None, stream: bool = False):
     """Run the demo with a sample case"""
     print("=" * 70)
     print("Clinical RAG System - Demo Mode")
@@ -33,8 +45,8 @@ def run_demo(case_name: str = "pneumonia_case", output_file: str = None):
     
     # Initialize pipeline
     print("\nInitializing Clinical RAG pipeline...")
+    from pipeline import ClinicalRAGPipeline
     pipeline = ClinicalRAGPipeline()
-    pipeline.initialize_collection()
     
     # Analyze
     print("\nAnalyzing clinical note...")
@@ -42,7 +54,8 @@ def run_demo(case_name: str = "pneumonia_case", output_file: str = None):
     result = pipeline.analyze_note(
         note=note,
         patient_id=patient_id,
-        use_indexed=False
+        use_indexed=False,
+        on_event=print_stream_event if stream else None
     )
     
     # Display results
@@ -55,7 +68,12 @@ def run_demo(case_name: str = "pneumonia_case", output_file: str = None):
         save_output(result, f"output_{case_name}.json")
 
 
-def run_custom(note_file: str, patient_id: str = None, output_file: str = None):
+def run_custom(
+    note_file: str,
+    patient_id: str = None,
+    output_file: str = None,
+    stream: bool = False
+):
     """Run with a custom clinical note file"""
     print("=" * 70)
     print("Clinical RAG System - Custom Note Analysis")
@@ -75,15 +93,16 @@ def run_custom(note_file: str, patient_id: str = None, output_file: str = None):
     
     # Initialize pipeline
     print("\nInitializing Clinical RAG pipeline...")
+    from pipeline import ClinicalRAGPipeline
     pipeline = ClinicalRAGPipeline()
-    pipeline.initialize_collection()
     
     # Analyze
     print("\nAnalyzing clinical note...")
     result = pipeline.analyze_note(
         note=note,
         patient_id=patient_id or "CUSTOM",
-        use_indexed=False
+        use_indexed=False,
+        on_event=print_stream_event if stream else None
     )
     
     # Display results
@@ -96,6 +115,208 @@ def run_custom(note_file: str, patient_id: str = None, output_file: str = None):
         save_output(result, "output_custom.json")
 
 
+def run_index(note_file: str, patient_id: str = None):
+    """Stream a (possibly very large) note file into the vector DB"""
+    print("=" * 70)
+    print("Clinical RAG System - Index Note File")
+    print("=" * 70)
+    
+    note_path = Path(note_file)
+    if not note_path.exists():
+        print(f"Error: File '{note_file}' not found.")
+        return
+    
+    print(f"\nIndexing {note_file} ({note_path.stat().st_size / 1e6:.1f} MB)")
+    from pipeline import ClinicalRAGPipeline
+    pipeline = ClinicalRAGPipeline()
+    
+    start = time.perf_counter()
+    count = pipeline.index_document(
+        str(note_path), patient_id=patient_id or "CUSTOM", note_id=note_path.stem
+    )
+    print(f"\n✓ Indexed {count} chunks in {time.perf_counter() - start:.1f}s")
+
+
+def run_ingest(source: str, embed_workers: int = None, threads_per_worker: int = None):
+    """Bulk-index a directory or JSONL file of notes using all cores"""
+    print("=" * 70)
+    print("Clinical RAG System - Bulk Ingest")
+    print("=" * 70)
+    
+    if not Path(source).exists():
+        print(f"Error: '{source}' not found.")
+        return
+    
+    from ingest import BulkIngestor
+    ingestor = BulkIngestor(embed_workers=embed_workers, threads_per_worker=threads_per_worker)
+    stats = ingestor.ingest(iter_batch_records(source))
+    
+    print("\n" + "=" * 70)
+    print(f"✓ Indexed {stats['notes']} note(s), {stats['chunks']} chunks in {stats['seconds']:.1f}s "
+          f"({stats['notes_per_sec']} notes/sec, {stats['chunks_per_sec']} chunks/sec)")
+    print(f"  Unchanged (skipped): {stats['unchanged']}, chunks reused: {stats['reused_chunks']}, "
+          f"texts embedded: {stats['embedded_texts']}")
+    if stats["errors"]:
+        print(f"  ⚠ Failed: {stats['errors']}")
+
+
+def iter_batch_records(source: str) -> Iterator[Dict]:
+    """
+    Read batch input lazily
+    
+    A directory yields one record per *.txt file (patient ID = file stem);
+    a JSONL file yields its {patient_id, note, encounter_id?, note_id?} lines.
+    Every record gets a stable record_id used for resuming.
+    """
+    path = Path(source)
+    
+    if path.is_dir():
+        for note_path in sorted(path.rglob("*.txt")):
+            yield {
+                "record_id": str(note_path.relative_to(path)),
+                "patient_id": note_path.stem,
+                "note": note_path.read_text()
+            }
+        return
+    
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"⚠ Skipping line {line_number}: invalid JSON ({e})")
+                continue
+            if not isinstance(record, dict) or not record.get("note"):
+                print(f"⚠ Skipping line {line_number}: no 'note' field")
+                continue
+            
+            record_id = record.get("record_id") or record.get("note_id")
+            if not record_id:
+                record_id = f"{record.get('patient_id', 'unknown')}:{line_number}"
+            record["record_id"] = str(record_id)
+            yield record
+
+
+def load_completed(output_path: Path, checkpoint_path: Path) -> Set[str]:
+    """
+    Record IDs already finished by a previous run
+    
+    The checkpoint lists completed IDs; the output file is also scanned so a
+    crash between writing a result and checkpointing it is not redone. A
+    partially written last line (no trailing newline) is truncated away;
+    corrupt complete lines are skipped, keeping the results after them.
+    """
+    completed = set()
+    
+    if checkpoint_path.exists():
+        with open(checkpoint_path, 'r') as f:
+            completed.update(line.strip() for line in f if line.strip())
+    
+    if output_path.exists():
+        with open(output_path, 'rb+') as f:
+            valid_size = 0
+            for line_number, line in enumerate(f, 1):
+                if not line.endswith(b"\n"):
+                    f.truncate(valid_size)
+                    break
+                valid_size += len(line)
+                try:
+                    completed.add(json.loads(line)["record_id"])
+                except (ValueError, KeyError, TypeError) as e:
+                    print(f"⚠ Skipping line {line_number} of {output_path.name}: corrupt result ({e})")
+    
+    return completed
+
+
+def run_batch(
+    source: str,
+    output_file: str = None,
+    workers: int = None,
+    checkpoint_file: str = None,
+    persist: bool = False
+):
+    """Analyze a directory or JSONL file of notes, streaming results to JSONL"""
+    print("=" * 70)
+    print("Clinical RAG System - Batch Analysis")
+    print("=" * 70)
+    
+    if not Path(source).exists():
+        print(f"Error: '{source}' not found.")
+        return
+    
+    output_path = Path(output_file or "batch_results.jsonl")
+    checkpoint_path = Path(checkpoint_file or f"{output_path}.checkpoint")
+    errors_path = output_path.with_name(output_path.name + ".errors")
+    
+    completed = load_completed(output_path, checkpoint_path)
+    if completed:
+        print(f"\nResuming: {len(completed)} record(s) already done")
+    
+    # index (position among submitted records) -> record_id
+    submitted: Dict[int, str] = {}
+    
+    def pending_records():
+        index = 0
+        for record in iter_batch_records(source):
+            if record["record_id"] in completed:
+                continue
+            submitted[index] = record["record_id"]
+            index += 1
+            yield record
+    
+    print("\nInitializing Clinical RAG pipeline...")
+    from pipeline import ClinicalRAGPipeline
+    pipeline = ClinicalRAGPipeline()
+    
+    succeeded = failed = 0
+    start = time.perf_counter()
+    
+    with open(output_path, 'a') as output, \
+            open(checkpoint_path, 'a') as checkpoint, \
+            open(errors_path, 'a') as errors:
+        for index, result in pipeline.analyze_notes(
+            pending_records(), generation_workers=workers, ordered=False, persist=persist
+        ):
+            record_id = submitted.pop(index)
+            line = json.dumps({"record_id": record_id, **result})
+            
+            if "error" in result:
+                # Failures are not checkpointed, so the next run retries them
+                errors.write(line + "\n")
+                errors.flush()
+                failed += 1
+                print(f"⚠ {record_id}: {result['error']}")
+                continue
+            
+            # Result first, then checkpoint: a crash in between is caught by the output scan
+            output.write(line + "\n")
+            output.flush()
+            checkpoint.write(record_id + "\n")
+            checkpoint.flush()
+            succeeded += 1
+            print(f"✓ [{succeeded + failed}] {record_id}")
+    
+    elapsed = time.perf_counter() - start
+    processed = succeeded + failed
+    print("\n" + "=" * 70)
+    print(f"Processed {processed} note(s) in {elapsed:.1f}s"
+          + (f" ({processed / elapsed:.2f} notes/sec)" if processed and elapsed else ""))
+    print(f"  Succeeded: {succeeded} → {output_path.absolute()}")
+    if failed:
+        print(f"  Failed: {failed} → {errors_path.absolute()} (retried on next run)")
+    print(f"  Skipped (already done): {len(completed)}")
+    
+    # Mean wall time per stage shows whether the run was embedding- or LLM-bound
+    from timing import STAGE_SECONDS
+    stage_summary = STAGE_SECONDS.summary()
+    if stage_summary:
+        print("  Mean stage time: " + ", ".join(
+            f"{stage} {stats['mean'] * 1000:.0f}ms" for stage, stats in stage_summary.items()
+        ))
+
+
 def display_results(result: dict):
     """Display results in a formatted way"""
     print("\n" + "=" * 70)
@@ -142,7 +363,8 @@ def display_results(result: dict):
                 print(f"     Citations: {len(dx['supporting_evidence'])} chunk(s)")
                 for i, ev in enumerate(dx['supporting_evidence'][:2], 1):  # Show first 2
                     quote = ev.get('quote', '')[:60]
-                    print(f"       └─ {ev.get('chunk_id', '?')}: \"{quote}...\"")
+                    mark = "" if ev.get('verified', True) else " ⚠ quote not found in chunk"
+                    print(f"       └─ {ev.get('chunk_id', '?')}: \"{quote}...\"{mark}")
     else:
         print("  No differential diagnoses generated.")
     
@@ -186,8 +408,24 @@ Examples:
   # Analyze custom note file
   python main.py --file my_note.txt --patient-id PT123
   
+  # Analyze a directory of *.txt notes or a JSONL file of {patient_id, note}
+  # records; re-running resumes where the last run stopped
+  python main.py --batch notes.jsonl --output results.jsonl --workers 4
+  
+  # Back-fill the vector DB from many notes using every core
+  python main.py --ingest notes_dir/ --embed-workers 16 --threads-per-worker 4
+  
+  # Index a very large note file with bounded memory (for later retrieval)
+  python main.py --index record_export.txt --patient-id PT123
+  
+  # Stream bullets and diagnoses as soon as they are generated
+  python main.py --demo --stream
+  
   # List available demo cases
   python main.py --list-cases
+  
+  # Run as an HTTP service with warm models
+  python main.py --serve --port 8080
         """
     )
     
@@ -210,6 +448,54 @@ Examples:
         help='Path to custom clinical note file'
     )
     
+    parser.add_argument(
+        '--index',
+        type=str,
+        help='Stream a (very large) note file into the vector DB without analyzing it'
+    )
+    
+    parser.add_argument(
+        '--ingest',
+        type=str,
+        help='Bulk-index a directory of *.txt notes or JSONL file (no analysis)'
+    )
+    
+    parser.add_argument(
+        '--embed-workers',
+        type=int,
+        help='Embedding processes for --ingest (default: INGEST_EMBED_WORKERS or cores / 4)'
+    )
+    
+    parser.add_argument(
+        '--threads-per-worker',
+        type=int,
+        help='Intra-op threads per embedding process for --ingest (default: cores / workers)'
+    )
+    
+    parser.add_argument(
+        '--batch',
+        type=str,
+        help='Directory of *.txt notes or JSONL file of {patient_id, note} records'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Concurrent LLM requests in batch mode (default: BATCH_GENERATION_WORKERS)'
+    )
+    
+    parser.add_argument(
+        '--checkpoint',
+        type=str,
+        help='Batch checkpoint file (default: <output>.checkpoint)'
+    )
+    
+    parser.add_argument(
+        '--persist',
+        action='store_true',
+        help='Also store batch notes in the vector DB (retrieval is in-memory either way)'
+    )
+    
     parser.add_argument(
         '--patient-id',
         type=str,
@@ -219,7 +505,31 @@ Examples:
     parser.add_argument(
         '--output',
         type=str,
-        help='Output JSON file path'
+        help='Output JSON file path (JSONL in batch mode)'
+    )
+    
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Stream summary bullets and diagnoses as they are generated'
+    )
+    
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Run as a long-lived HTTP service (POST /analyze, /index, /retrieve)'
+    )
+    
+    parser.add_argument(
+        '--host',
+        type=str,
+        help='Host to bind in --serve mode (default: SERVER_HOST)'
+    )
+    
+    parser.add_argument(
+        '--port',
+        type=int,
+        help='Port to bind in --serve mode (default: SERVER_PORT)'
     )
     
     parser.add_argument(
@@ -237,14 +547,38 @@ Examples:
             print(f"  {i}. {case}")
         return
     
+    # Run service
+    if args.serve:
+        from server import serve
+        serve(args.host, args.port)
+        return
+    
     # Run demo
     if args.demo:
-        run_demo(args.case, args.output)
+        run_demo(args.case, args.output, stream=args.stream)
+        return
+    
+    # Run batch
+    if args.batch:
+        run_batch(
+            args.batch, args.output, workers=args.workers,
+            checkpoint_file=args.checkpoint, persist=args.persist
+        )
+        return
+    
+    # Bulk ingest
+    if args.ingest:
+        run_ingest(args.ingest, args.embed_workers, args.threads_per_worker)
+        return
+    
+    # Index a note file
+    if args.index:
+        run_index(args.index, args.patient_id)
         return
     
     # Run custom
     if args.file:
-        run_custom(args.file, args.patient_id, args.output)
+        run_custom(args.file, args.patient_id, args.output, stream=args.stream)
         return
     
     # Default: show help
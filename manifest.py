@@ -0,0 +1,119 @@
+"""
+Per-note index manifest for the Clinical RAG System
+Records which chunks of each note are stored in the vector DB, so a revised
+note can be diffed against its indexed version without querying Chroma
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from config import config
+
+
+class NoteManifest:
+    """
+    SQLite table of the chunks indexed for each (collection, patient, note)
+
+    Each entry maps stable chunk IDs to the chunk's prompt alias, section and
+    note offsets. Entries must only change after the matching vector DB
+    write succeeded.
+    """
+
+    def __init__(self, path: str = None, collection: str = None):
+        self.path = path or config.INDEX_MANIFEST_PATH or os.path.join(
+            config.VECTOR_DB_PATH, "note_manifest.db"
+        )
+        self.collection = collection or config.COLLECTION_NAME
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS notes ("
+            "collection TEXT NOT NULL, patient_id TEXT NOT NULL, note_id TEXT NOT NULL, "
+            "encounter_id TEXT NOT NULL, chunks TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (collection, patient_id, note_id))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def record(chunk: Dict) -> Dict:
+        """What the manifest keeps per chunk (everything but the text)"""
+        return {
+            "chunk_id": chunk["chunk_id"],
+            "section": chunk["section"],
+            "start": chunk.get("start"),
+            "end": chunk.get("end")
+        }
+
+    def get(self, patient_id: str, note_id: str) -> Optional[Dict[str, Dict]]:
+        """Chunk ID -> record for the indexed version of a note, or None if unknown"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunks FROM notes WHERE collection = ? AND patient_id = ? AND note_id = ?",
+                (self.collection, patient_id, note_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, patient_id: str, encounter_id: str, note_id: str, chunks: Dict[str, Dict]):
+        """Replace the entry for a note with its chunk records"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO notes "
+                "(collection, patient_id, note_id, encounter_id, chunks, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.collection, patient_id, note_id, encounter_id, json.dumps(chunks), time.time())
+            )
+            self._conn.commit()
+
+    def delete(self, patient_id: str, encounter_id: str = None, note_id: str = None):
+        """Forget a patient's notes (optionally only one encounter's or note's)"""
+        query = "DELETE FROM notes WHERE collection = ? AND patient_id = ?"
+        params = [self.collection, patient_id]
+        if encounter_id:
+            query += " AND encounter_id = ?"
+            params.append(encounter_id)
+        if note_id:
+            query += " AND note_id = ?"
+            params.append(note_id)
+
+        with self._lock:
+            self._conn.execute(query, params)
+            self._conn.commit()
+
+    def clear(self):
+        """Forget every note of this collection"""
+        with self._lock:
+            self._conn.execute("DELETE FROM notes WHERE collection = ?", (self.collection,))
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM notes WHERE collection = ?", (self.collection,)
+            ).fetchone()[0]
+
+    def close(self):
+        """Close the underlying database connection"""
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    # Test the manifest
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest = NoteManifest(path=os.path.join(tmp, "manifest.db"), collection="demo")
+        chunk = {"chunk_id": "chunk_1", "section": "HPI", "start": 0, "end": 42}
+        manifest.put("PT001", "ENC1", "NOTE1", {"PT001:NOTE1:abc": NoteManifest.record(chunk)})
+        print(f"Entry: {manifest.get('PT001', 'NOTE1')}")
+        manifest.delete("PT001", encounter_id="ENC1")
+        print(f"After delete: {manifest.get('PT001', 'NOTE1')}")
+        manifest.close()
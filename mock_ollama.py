@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Ollama HTTP API, for benchmarks and offline testing
+Answers /api/generate with canned clinical JSON after a configurable delay
+
+Usage:
+  python mock_ollama.py --port 11435 --latency 0.2 --tokens-per-sec 80
+  OLLAMA_BASE_URL=http://127.0.0.1:11435 python main.py --demo
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+CHUNK_ID_PATTERN = re.compile(r'CHUNK_ID: (E\d+)')
+
+
+def canned_output(chunk_ids: List[str]) -> Dict:
+    """Schema-valid output citing chunks that appear in the prompt"""
+    first = chunk_ids[0] if chunk_ids else "E1"
+    second = chunk_ids[1] if len(chunk_ids) > 1 else first
+    return {
+        "patient_id": None,
+        "summary": {
+            "text": [
+                "Patient presents with acute symptoms documented in the note.",
+                "Vital signs and laboratory findings are abnormal.",
+                "Imaging findings support the leading diagnosis."
+            ],
+            "supporting_evidence": [
+                {"chunk_id": first, "offset": [0, 20], "quote": "Chief complaint"}
+            ]
+        },
+        "differential": [
+            {
+                "rank": rank,
+                "diagnosis": diagnosis,
+                "confidence": confidence,
+                "rationale": "Consistent with the documented history and findings.",
+                "supporting_evidence": [
+                    {"chunk_id": second, "offset": [0, 20], "quote": "Assessment"}
+                ],
+                "evidence_score": confidence
+            }
+            for rank, (diagnosis, confidence) in enumerate(
+                [("Leading diagnosis", 0.8), ("Alternative diagnosis", 0.5), ("Less likely diagnosis", 0.2)],
+                start=1
+            )
+        ],
+        "warnings": []
+    }
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer with the mock's timing settings
+
+    Each generation takes `latency` seconds (time to first token) plus
+    `eval_tokens` / `tokens_per_sec`, and reports matching Ollama stats.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        latency: float = 0.2,
+        tokens_per_sec: float = 80.0,
+        eval_tokens: int = 400,
+        models: List[str] = None
+    ):
+        super().__init__(address, MockOllamaHandler)
+        self.latency = latency
+        self.tokens_per_sec = tokens_per_sec
+        self.eval_tokens = eval_tokens
+        self.models = models or ["llama3.2"]
+        self.requests_served = 0
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """Implements GET /api/tags and POST /api/generate (streaming and non-streaming)"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; avoid Nagle/delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data: Dict, status: int = 200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, message: Dict):
+        line = (json.dumps(message) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": name} for name in self.server.models]})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path != "/api/generate":
+            self._send_json({"error": "not found"}, 404)
+            return
+
+        server = self.server
+        prompt = request.get("prompt", "")
+        text = json.dumps(canned_output(CHUNK_ID_PATTERN.findall(prompt)))
+        eval_seconds = server.eval_tokens / server.tokens_per_sec
+        stats = {
+            "model": request.get("model"),
+            "done": True,
+            "prompt_eval_count": max(1, len(prompt) // 4),
+            "prompt_eval_duration": int(server.latency * 1e9),
+            "eval_count": server.eval_tokens,
+            "eval_duration": int(eval_seconds * 1e9),
+            "load_duration": 0,
+            "total_duration": int((server.latency + eval_seconds) * 1e9)
+        }
+        server.requests_served += 1
+
+        time.sleep(server.latency)
+
+        if not request.get("stream", True):
+            time.sleep(eval_seconds)
+            self._send_json({**stats, "response": text})
+            return
+
+        # Spread the canned text over the eval time, like real token streaming
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        pieces = max(1, min(server.eval_tokens, len(text)))
+        step = -(-len(text) // pieces)
+        for start in range(0, len(text), step):
+            self._write_chunk({"model": request.get("model"), "response": text[start:start + step], "done": False})
+            time.sleep(eval_seconds * step / len(text))
+        self._write_chunk({**stats, "response": ""})
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    **settings
+) -> MockOllamaServer:
+    """Start a mock server on a background thread (port 0 picks a free port)"""
+    server = MockOllamaServer((host, port), **settings)
+    threading.Thread(target=server.serve_forever, name="mock-ollama", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Ollama server for benchmarks")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds before the first token')
+    parser.add_argument('--tokens-per-sec', type=float, default=80.0, help='Simulated generation speed')
+    parser.add_argument('--eval-tokens', type=int, default=400, help='Simulated output tokens per request')
+    parser.add_argument('--model', action='append', help='Model name(s) listed by /api/tags')
+    args = parser.parse_args()
+
+    server = MockOllamaServer(
+        (args.host, args.port),
+        latency=args.latency,
+        tokens_per_sec=args.tokens_per_sec,
+        eval_tokens=args.eval_tokens,
+        models=args.model
+    )
+    print(f"✓ Mock Ollama listening on {server.base_url} "
+          f"(latency {args.latency}s, {args.tokens_per_sec} tok/s, {args.eval_tokens} tokens)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,20 @@
 FREE End-to-end Clinical RAG Pipeline using local models
 NO OpenAI API required - 100% FREE!
 """
+import asyncio
+import functools
 import json
-from typing import Dict, Optional
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import IO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from chunker import ClinicalNoteChunker
 from retriever import ClinicalRAGRetriever
+from manifest import NoteManifest
 from generator import ClinicalGenerator
 from config import config
+from timing import collect, rounded, timed
 
 
 class ClinicalRAGPipeline:
@@ -15,25 +23,210 @@ class ClinicalRAGPipeline:
     
     def __init__(self):
         self.chunker = ClinicalNoteChunker()
-        self.retriever = ClinicalRAGRetriever()
-        self.generator = ClinicalGenerator()
+        # Retriever and generator are created on first use so that
+        # constructing the pipeline stays cheap
+        self._retriever = None
+        self._generator = None
+        self._init_lock = threading.Lock()
+        # Executor for blocking chunk/embed/index work in the async API
+        self._prep_executor = None
         print("✓ Initialized FREE Clinical RAG Pipeline (no API costs!)")
     
-    def index_note(self, note: str, patient_id: str = None):
+    @property
+    def retriever(self) -> ClinicalRAGRetriever:
+        """Vector retriever, created on first use"""
+        if self._retriever is None:
+            with self._init_lock:
+                if self._retriever is None:
+                    self._retriever = ClinicalRAGRetriever()
+        return self._retriever
+    
+    @property
+    def generator(self) -> ClinicalGenerator:
+        """LLM generator, created on first use"""
+        if self._generator is None:
+            with self._init_lock:
+                if self._generator is None:
+                    self._generator = ClinicalGenerator()
+        return self._generator
+    
+    def index_note(
+        self,
+        note: str,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ):
         """
         Index a clinical note into the vector database
         
+        Incremental: a revised note is diffed against the indexed version
+        (via the per-note manifest), so only changed chunks are embedded and
+        chunks that vanished are deleted. Re-indexing an unchanged note does
+        no embedding and no vector DB writes.
+        
         Args:
             note: Clinical note text
             patient_id: Optional patient identifier
+            encounter_id: Optional encounter identifier
+            note_id: Optional note identifier (defaults to a hash of the note
+                text, so only notes indexed with the same note_id replace
+                each other)
         """
+        note_id = note_id or self.chunker.default_note_id(note)
+        
         # Chunk the note
-        chunks = self.chunker.process_note(note, patient_id=patient_id)
+        with timed("chunking"):
+            chunks = self.chunker.process_note(
+                note, patient_id=patient_id, encounter_id=encounter_id, note_id=note_id
+            )
+        
+        self._store_chunks(chunks, patient_id, encounter_id, note_id)
+        return chunks
+    
+    def index_document(
+        self,
+        source: Union[str, IO],
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None,
+        batch_chunks: int = None
+    ) -> int:
+        """
+        Index a very large note (multi-hundred-page record, bundled export)
+        with bounded memory
+        
+        Chunks are streamed from the file and embedded and upserted a batch
+        at a time; only their manifest records are kept until the end, when
+        chunks of a previous version of the note are removed.
+        
+        Args:
+            source: Path to a note file (read through mmap), or a text or
+                binary file object
+            patient_id / encounter_id: As for index_note
+            note_id: Optional note identifier (defaults to the file name)
+            batch_chunks: Chunks per embed-and-upsert step
+                (default: 8 x EMBEDDING_BATCH_SIZE)
+        
+        Returns:
+            Number of chunks indexed
+        """
+        patient_id = patient_id or "unknown"
+        encounter_id = encounter_id or "unknown"
+        name = source if isinstance(source, (str, os.PathLike)) else getattr(source, "name", None)
+        note_id = note_id or (os.path.basename(name) if isinstance(name, (str, os.PathLike)) else encounter_id)
+        batch_chunks = batch_chunks or config.EMBEDDING_BATCH_SIZE * 8
+        
+        if isinstance(source, (str, os.PathLike)):
+            chunks = self.chunker.iter_file_chunks(source, patient_id, encounter_id, note_id)
+        else:
+            chunks = self.chunker.iter_chunks(source, patient_id, encounter_id, note_id)
+        
+        records = {}
+        batch = []
+        for chunk in chunks:
+            records[chunk["id"]] = NoteManifest.record(chunk)
+            batch.append(chunk)
+            if len(batch) >= batch_chunks:
+                self.retriever.add_chunks(batch)
+                batch = []
+        if batch:
+            self.retriever.add_chunks(batch)
+        
+        self.retriever.prune_note(patient_id, encounter_id, note_id, records)
+        print(f"Indexed {len(records)} chunks for patient {patient_id} (streamed)")
+        return len(records)
+    
+    def _store_chunks(
+        self,
+        chunks: List[Dict],
+        patient_id: str,
+        encounter_id: str,
+        note_id: str,
+        embeddings=None
+    ) -> Dict[str, int]:
+        """Replace the stored version of a note with `chunks`, writing only the difference"""
+        encounter_id = encounter_id or "unknown"
+        changes = self.retriever.index_note_chunks(
+            chunks,
+            patient_id=patient_id or "unknown",
+            encounter_id=encounter_id,
+            note_id=note_id or encounter_id,
+            embeddings=embeddings
+        )
         
-        # Add to vector database
-        self.retriever.add_chunks(chunks)
+        print(f"Indexed {len(chunks)} chunks for patient {patient_id or 'unknown'} "
+              f"({changes['added']} added, {changes['removed']} removed, "
+              f"{changes['unchanged'] + changes['moved']} unchanged)")
+        return changes
+    
+    def prepare_chunks(
+        self,
+        note: str = None,
+        patient_id: str = None,
+        use_indexed: bool = False,
+        retrieval_k: int = None,
+        encounter_id: str = None,
+        note_id: str = None,
+        timings: Dict[str, float] = None,
+        persist: bool = False
+    ) -> List[Dict]:
+        """
+        Retrieve the chunks for generation
+        
+        A provided note (use_indexed=False) is chunked, embedded and searched
+        entirely in memory; it is only written to the vector DB if `persist`.
+        Stage wall times (chunking, embedding, vector_add, retrieval) are
+        added to `timings` if given.
+        """
+        with collect(timings):
+            return self._prepare_chunks(
+                note, patient_id, use_indexed, retrieval_k, encounter_id, note_id, persist
+            )
+    
+    def _prepare_chunks(
+        self,
+        note: str,
+        patient_id: str,
+        use_indexed: bool,
+        retrieval_k: int,
+        encounter_id: str,
+        note_id: str,
+        persist: bool
+    ) -> List[Dict]:
+        # The query intent is constant, so its embedding is precomputed once
+        k = retrieval_k or config.RETRIEVAL_K
+        
+        if not use_indexed and note:
+            note_id = note_id or self.chunker.default_note_id(note)
+            
+            # Step 1: Chunk and embed the note in memory
+            with timed("chunking"):
+                chunks = self.chunker.process_note(
+                    note, patient_id=patient_id, encounter_id=encounter_id, note_id=note_id
+                )
+            with timed("embedding"):
+                index = self.retriever.build_memory_index(chunks)
+            
+            if persist:
+                self._store_chunks(
+                    index.chunks, patient_id, encounter_id, note_id, embeddings=index.embeddings
+                )
+            
+            # Step 2: Exact cosine top-k over this note's chunks
+            with timed("retrieval"):
+                chunks = index.search(self.retriever.get_query_embedding(), k)
+        else:
+            # Step 2: Search indexed notes, scoped by metadata filter
+            with timed("retrieval"):
+                chunks = self.retriever.retrieve(
+                    k=k,
+                    patient_id=patient_id,
+                    encounter_id=encounter_id,
+                    note_id=note_id
+                )
         
-        print(f"Indexed {len(chunks)} chunks for patient {patient_id or 'unknown'}")
+        print(f"Retrieved {len(chunks)} chunks")
         return chunks
     
     def analyze_note(
@@ -41,7 +234,11 @@ class ClinicalRAGPipeline:
         note: str = None, 
         patient_id: str = None,
         use_indexed: bool = False,
-        retrieval_k: int = None
+        retrieval_k: int = None,
+        encounter_id: str = None,
+        note_id: str = None,
+        on_event: Callable[[Dict], None] = None,
+        persist: bool = False
     ) -> Dict:
         """
         Analyze a clinical note and generate summary + differential diagnoses
@@ -50,36 +247,215 @@ class ClinicalRAGPipeline:
         Args:
             note: Clinical note text (if not using indexed notes)
             patient_id: Optional patient identifier
-            use_indexed: If True, retrieve from indexed notes; else index the provided note first
+            use_indexed: If True, retrieve from indexed notes; else chunk, embed
+                and search the provided note in memory
             retrieval_k: Number of chunks to retrieve
+            encounter_id: Optional encounter identifier to scope retrieval to
+            note_id: Optional note identifier (defaults to a hash of the note
+                text, see ClinicalNoteChunker.default_note_id)
+            on_event: Optional callback to stream summary bullets and
+                differential entries as soon as the LLM completes them
+            persist: Also store the provided note in the vector DB so later
+                use_indexed calls can find it (retrieval stays in memory)
         
         Returns:
             Structured JSON output with summary and differential diagnoses
         """
-        # Step 1: Index the note if needed
-        if not use_indexed and note:
-            self.index_note(note, patient_id)
+        timings = {}
+        chunks = self.prepare_chunks(
+            note, patient_id, use_indexed, retrieval_k, encounter_id, note_id, timings, persist
+        )
         
-        # Step 2: Retrieve relevant chunks
-        query = config.RETRIEVAL_QUERY_TEMPLATE + \
-                f" Patient ID: {patient_id or 'unknown'}"
+        # Step 3: Generate clinical output (FREE!)
+        result = self.generator.generate_clinical_output(
+            chunks, patient_id=patient_id, on_event=on_event
+        )
         
-        k = retrieval_k or config.RETRIEVAL_K
-        chunks = self.retriever.retrieve(query, k=k)
+        return self.merge_timings(result, timings)
+    
+    @staticmethod
+    def merge_timings(result: Dict, timings: Dict[str, float]) -> Dict:
+        """Add prepare-stage timings to the generation timings in model_metadata"""
+        metadata = result.setdefault("model_metadata", {})
+        metadata["timings"] = rounded({**timings, **metadata.get("timings", {})})
+        return result
+    
+    async def aanalyze_note(
+        self,
+        note: str = None,
+        patient_id: str = None,
+        use_indexed: bool = False,
+        retrieval_k: int = None,
+        encounter_id: str = None,
+        note_id: str = None,
+        persist: bool = False
+    ) -> Dict:
+        """
+        Async variant of analyze_note
         
-        print(f"Retrieved {len(chunks)} chunks")
+        Chunking, embedding and vector DB work run in a thread pool
+        (BATCH_PREP_WORKERS threads) so the event loop stays free; the LLM
+        call goes through the generator's shared async client. Run many with
+        asyncio.gather to keep a local Ollama server saturated.
+        """
+        if self._prep_executor is None:
+            with self._init_lock:
+                if self._prep_executor is None:
+                    self._prep_executor = ThreadPoolExecutor(
+                        config.BATCH_PREP_WORKERS, thread_name_prefix="prepare"
+                    )
         
-        # Step 3: Generate clinical output (FREE!)
-        result = self.generator.generate_clinical_output(chunks, patient_id=patient_id)
+        timings = {}
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(
+            self._prep_executor,
+            functools.partial(
+                self.prepare_chunks,
+                note, patient_id, use_indexed, retrieval_k, encounter_id, note_id, timings, persist
+            )
+        )
         
-        return result
+        result = await self.generator.agenerate_clinical_output(chunks, patient_id=patient_id)
+        return self.merge_timings(result, timings)
+    
+    async def aclose(self):
+        """Release the async client and the prepare-stage executor"""
+        if self._generator is not None:
+            await self._generator.aclose()
+        if self._prep_executor is not None:
+            self._prep_executor.shutdown(wait=False)
+            self._prep_executor = None
+    
+    @staticmethod
+    def _normalize_batch_item(item: Union[Dict, Tuple[str, str]]) -> Dict:
+        """Accept {"note", "patient_id", ...} dicts or (patient_id, note) tuples"""
+        if isinstance(item, dict):
+            return {
+                "note": item["note"],
+                "patient_id": item.get("patient_id"),
+                "encounter_id": item.get("encounter_id"),
+                "note_id": item.get("note_id")
+            }
+        patient_id, note = item
+        return {"note": note, "patient_id": patient_id, "encounter_id": None, "note_id": None}
+    
+    def analyze_notes(
+        self,
+        notes: Iterable[Union[Dict, Tuple[str, str]]],
+        retrieval_k: int = None,
+        prep_workers: int = None,
+        generation_workers: int = None,
+        max_pending: int = None,
+        ordered: bool = True,
+        persist: bool = False
+    ) -> Iterator[Tuple[int, Dict]]:
+        """
+        Analyze many notes with chunking/embedding overlapped with generation
+        
+        Notes flow through two bounded stages: prepare (chunk, embed, index,
+        retrieve) and generate (LLM call). While note N is being generated,
+        note N+1 is already being prepared. At most `max_pending` notes are
+        in flight, so `notes` may be a lazy iterator over a huge backlog.
+        
+        Args:
+            notes: {"note", "patient_id", "encounter_id", "note_id"} dicts or
+                (patient_id, note) tuples
+            retrieval_k: Number of chunks to retrieve per note
+            prep_workers: Concurrent prepare-stage workers
+            generation_workers: Concurrent LLM requests
+            max_pending: Notes in flight before reading more input (backpressure)
+            ordered: Yield in input order if True, else as each note completes
+            persist: Also store each note in the vector DB
+        
+        Yields:
+            (index, result) where index is the note's position in `notes`;
+            a note that fails yields a result with an "error" key
+        """
+        prep_workers = prep_workers or config.BATCH_PREP_WORKERS
+        generation_workers = generation_workers or config.BATCH_GENERATION_WORKERS
+        max_pending = max_pending or max(
+            config.BATCH_MAX_PENDING, prep_workers + generation_workers
+        )
+        
+        # Open the collection once, before worker threads need it
+        if persist:
+            self.retriever.get_collection()
+        generator = self.generator
+        
+        prep_pool = ThreadPoolExecutor(prep_workers, thread_name_prefix="prepare")
+        generation_pool = ThreadPoolExecutor(generation_workers, thread_name_prefix="generate")
+        
+        def fail(outcome: Future, item: Dict, error: Exception):
+            print(f"Error analyzing note for patient {item['patient_id'] or 'unknown'}: {error}")
+            outcome.set_result(generator.error_result(
+                str(error), f"Pipeline error: {str(error)}", [], item["patient_id"]
+            ))
+        
+        def start(item: Dict) -> Future:
+            outcome = Future()
+            timings = {}
+            
+            def on_generated(generation: Future):
+                try:
+                    outcome.set_result(self.merge_timings(generation.result(), timings))
+                except Exception as e:
+                    fail(outcome, item, e)
+            
+            def on_prepared(preparation: Future):
+                try:
+                    chunks = preparation.result()
+                    generation = generation_pool.submit(
+                        generator.generate_clinical_output,
+                        chunks, patient_id=item["patient_id"]
+                    )
+                    generation.add_done_callback(on_generated)
+                except Exception as e:
+                    fail(outcome, item, e)
+            
+            preparation = prep_pool.submit(
+                self.prepare_chunks,
+                item["note"], item["patient_id"], False, retrieval_k,
+                item["encounter_id"], item["note_id"], timings, persist
+            )
+            preparation.add_done_callback(on_prepared)
+            return outcome
+        
+        pending = deque()
+        source = enumerate(notes)
+        exhausted = False
+        
+        try:
+            while True:
+                # Backpressure: only read more input while under the in-flight limit
+                while not exhausted and len(pending) < max_pending:
+                    try:
+                        index, item = next(source)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((index, start(self._normalize_batch_item(item))))
+                
+                if not pending:
+                    break
+                
+                if ordered:
+                    index, outcome = pending.popleft()
+                    yield index, outcome.result()
+                else:
+                    wait([outcome for _, outcome in pending], return_when=FIRST_COMPLETED)
+                    for entry in [entry for entry in pending if entry[1].done()]:
+                        pending.remove(entry)
+                        yield entry[0], entry[1].result()
+        finally:
+            prep_pool.shutdown(wait=True, cancel_futures=True)
+            generation_pool.shutdown(wait=True, cancel_futures=True)
     
     def clear_index(self):
         """Clear the vector database"""
         self.retriever.clear_collection()
     
     def initialize_collection(self):
-        """Initialize a fresh collection"""
+        """Initialize a fresh collection (deletes all indexed patients)"""
         self.retriever.create_collection()
 
 
@@ -150,7 +526,6 @@ Assessment and Plan:
     
     # Initialize pipeline
     pipeline = ClinicalRAGPipeline()
-    pipeline.initialize_collection()
     
     # Analyze the note
     print("\nAnalyzing clinical note with FREE local models...")
@@ -2,27 +2,244 @@
 Local RAG retrieval system using FREE sentence-transformers for embeddings
 NO OpenAI API required!
 """
-import chromadb
-from chromadb.config import Settings
-from typing import List, Dict, Optional
-from sentence_transformers import SentenceTransformer
+import hashlib
+import os
+import threading
+import numpy as np
+from typing import List, Dict, Optional, Tuple, Union
+from cache import EmbeddingCache
+from chunker import ClinicalNoteChunker
 from config import config
+from lexical import BM25Index, reciprocal_rank_fusion
+from manifest import NoteManifest
+from timing import timed
+
+
+def mmr_select(
+    relevance: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    lambda_mult: float = None,
+    sections: List[str] = None,
+    section_quota: int = None,
+    redundancy: float = None
+) -> List[int]:
+    """
+    Maximal marginal relevance selection over already-fetched candidates
+    
+    Greedily picks the candidate maximizing
+    lambda * relevance - (1 - lambda) * max cosine similarity to those picked,
+    so overlapping windows of one passage stop crowding out other sections.
+    
+    Args:
+        relevance: Relevance of each candidate to the query (higher is better)
+        embeddings: Candidate embeddings, one row per candidate
+        k: Maximum number of candidates to pick
+        lambda_mult: Relevance vs. diversity trade-off (1.0 = plain top-k)
+        sections: Section of each candidate, for the per-section quota
+        section_quota: Maximum picks per section (0 = no limit)
+        redundancy: Candidates at least this similar to a pick are dropped (1.0 = keep all)
+    
+    Returns:
+        Indices of the picked candidates in pick order; fewer than k when
+        the remaining candidates are near-duplicates or over quota
+    """
+    lambda_mult = config.MMR_LAMBDA if lambda_mult is None else lambda_mult
+    section_quota = config.SECTION_QUOTA if section_quota is None else section_quota
+    redundancy = config.MMR_REDUNDANCY if redundancy is None else redundancy
+    
+    relevance = np.asarray(relevance, dtype=np.float32)
+    if not len(relevance) or k <= 0:
+        return []
+    
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    sections = np.asarray(sections, dtype=object) if sections is not None and section_quota else None
+    
+    available = np.ones(len(relevance), dtype=bool)
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    per_section: Dict[str, int] = {}
+    picked: List[int] = []
+    
+    while len(picked) < k and available.any():
+        scores = lambda_mult * relevance - (1.0 - lambda_mult) * max_similarity
+        i = int(np.argmax(np.where(available, scores, -np.inf)))
+        picked.append(i)
+        available[i] = False
+        
+        similarity = matrix @ matrix[i]
+        np.maximum(max_similarity, similarity, out=max_similarity)
+        if redundancy < 1.0:
+            available &= similarity < redundancy
+        if sections is not None:
+            section = sections[i]
+            per_section[section] = per_section.get(section, 0) + 1
+            if per_section[section] >= section_quota:
+                available &= sections != section
+    
+    return picked
+
+
+class InMemoryIndex:
+    """
+    Exact cosine top-k over one note's chunks, held in a NumPy matrix
+    
+    For the handful of chunks in a single note, a matrix-vector product is
+    far cheaper than writing to Chroma and building an HNSW index.
+    """
+    
+    def __init__(self, chunks: List[Dict[str, str]], embeddings: np.ndarray):
+        self.chunks = chunks
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(self.embeddings, axis=1, keepdims=True)
+        self.matrix = self.embeddings / np.maximum(norms, 1e-12)
+    
+    def __len__(self) -> int:
+        return len(self.chunks)
+    
+    @staticmethod
+    def position(chunk: Dict) -> Dict[str, int]:
+        """Character offsets of a chunk in its note, when known"""
+        return {key: chunk[key] for key in ("start", "end") if chunk.get(key) is not None}
+    
+    def search(self, query_embedding: List[float], k: int, diverse: bool = None) -> List[Dict[str, str]]:
+        """
+        Top-k chunks by cosine similarity
+        
+        Args:
+            query_embedding: Query vector
+            k: Number of chunks to return (at most)
+            diverse: Pick from the top MMR_FETCH_K by MMR (default: MMR_ENABLED)
+        
+        Returns:
+            Chunks in the same shape as ClinicalRAGRetriever.retrieve, with
+            cosine distance (1 - similarity) like a cosine Chroma collection
+        """
+        if not self.chunks:
+            return []
+        diverse = config.MMR_ENABLED if diverse is None else diverse
+        
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = self.matrix @ query
+        
+        n = min(max(k, config.MMR_FETCH_K) if diverse else k, len(self.chunks))
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        if diverse:
+            picks = mmr_select(
+                scores[top], self.matrix[top], k,
+                sections=[self.chunks[i]["section"] for i in top]
+            )
+            top = top[picks]
+        
+        return [
+            {
+                "id": self.chunks[i]["id"],
+                "chunk_id": self.chunks[i]["chunk_id"],
+                "section": self.chunks[i]["section"],
+                "text": self.chunks[i]["text"],
+                "patient_id": self.chunks[i].get("patient_id", "unknown"),
+                "note_id": self.chunks[i].get("note_id", "unknown"),
+                "distance": float(1.0 - scores[i]),
+                **self.position(self.chunks[i])
+            }
+            for i in top
+        ]
 
 
 class ClinicalRAGRetriever:
     """Vector-based retrieval system using FREE local embeddings"""
     
     def __init__(self):
-        self.client = chromadb.PersistentClient(
-            path=config.VECTOR_DB_PATH,
-            settings=Settings(anonymized_telemetry=False)
-        )
+        # The Chroma client and embedding model are heavy; both load on first use
+        self._client = None
+        self._embedding_model = None
+        self._load_lock = threading.Lock()
         self.collection = None
+        self._manifest = None
+        
+        # Keyword index over the collection, built from Chroma on first use and
+        # then kept current by every write below
+        self._lexical = None
+        self._lexical_lock = threading.Lock()
+        
+        # Unchanged sections across a patient's visits are served from disk
+        self.embedding_cache = None
+        if config.EMBEDDING_CACHE_ENABLED:
+            self.embedding_cache = EmbeddingCache(model_name=config.LOCAL_EMBEDDING_MODEL)
+        
+        # Embeddings of constant retrieval queries, keyed by (model, query) hash
+        self._query_embeddings: Dict[str, List[float]] = {}
         
-        # Load FREE local embedding model
-        print(f"Loading local embedding model: {config.LOCAL_EMBEDDING_MODEL}")
-        self.embedding_model = SentenceTransformer(config.LOCAL_EMBEDDING_MODEL)
-        print("✓ Local embedding model loaded (100% FREE!)")
+        # Optional micro-batcher (see server.py) that coalesces concurrent
+        # encode calls into one forward pass; None encodes directly
+        self.embedding_batcher = None
+    
+    @property
+    def client(self):
+        """Chroma persistent client, opened on first use"""
+        if self._client is None:
+            with self._load_lock:
+                if self._client is None:
+                    import chromadb
+                    from chromadb.config import Settings
+                    
+                    self._client = chromadb.PersistentClient(
+                        path=config.VECTOR_DB_PATH,
+                        settings=Settings(anonymized_telemetry=False)
+                    )
+        return self._client
+    
+    @property
+    def manifest(self) -> NoteManifest:
+        """Per-note record of indexed chunks, opened on first use"""
+        if self._manifest is None:
+            with self._load_lock:
+                if self._manifest is None:
+                    self._manifest = NoteManifest()
+        return self._manifest
+    
+    @property
+    def lexical_index(self) -> BM25Index:
+        """BM25 index of every stored chunk, loaded from the collection on first use"""
+        # Outside the lock: creating a missing collection resets this index under it
+        if not self.collection:
+            self.get_collection()
+        with self._lexical_lock:
+            if self._lexical is None:
+                index = BM25Index()
+                page = 5000
+                for offset in range(0, self.collection.count(), page):
+                    stored = self.collection.get(
+                        include=["documents", "metadatas"], limit=page, offset=offset
+                    )
+                    for chunk_key, text, metadata in zip(
+                        stored["ids"], stored["documents"], stored["metadatas"]
+                    ):
+                        index.add(chunk_key, text, metadata.get("patient_id"),
+                                  metadata.get("encounter_id"), metadata.get("note_id"))
+                self._lexical = index
+            return self._lexical
+    
+    def _update_lexical(self, update):
+        """Apply a write to the keyword index if it has been loaded (else it loads later)"""
+        with self._lexical_lock:
+            if self._lexical is not None:
+                update(self._lexical)
+    
+    @property
+    def embedding_model(self):
+        """FREE local embedding model, loaded on first use"""
+        if self._embedding_model is None:
+            with self._load_lock:
+                if self._embedding_model is None:
+                    from sentence_transformers import SentenceTransformer
+                    
+                    print(f"Loading local embedding model: {config.LOCAL_EMBEDDING_MODEL}")
+                    self._embedding_model = SentenceTransformer(config.LOCAL_EMBEDDING_MODEL)
+                    print("✓ Local embedding model loaded (100% FREE!)")
+        return self._embedding_model
     
     def create_collection(self, collection_name: str = None):
         """Create or get collection"""
@@ -38,97 +255,621 @@ class ClinicalRAGRetriever:
             name=name,
             metadata={"hnsw:space": "cosine"}
         )
+        # The manifest follows the active collection
+        self.manifest.collection = name
+        self.manifest.clear()
+        with self._lexical_lock:
+            self._lexical = None
         print(f"Created collection: {name}")
     
     def get_collection(self, collection_name: str = None):
         """Get existing collection"""
         name = collection_name or config.COLLECTION_NAME
         try:
-            self.collection = self.client.get_collection(name=name)
-            print(f"Loaded collection: {name}")
-        except:
+            collection = self.client.get_collection(name=name)
+        except self._collection_not_found():
             print(f"Collection {name} not found. Creating new one...")
             self.create_collection(name)
+            return
+        
+        switched = self.collection is not None and self.collection.name != name
+        self.collection = collection
+        self.manifest.collection = name
+        # A collection emptied behind our back invalidates the manifest
+        if self.collection.count() == 0:
+            self.manifest.clear()
+        if switched:
+            with self._lexical_lock:
+                self._lexical = None
+        print(f"Loaded collection: {name}")
+    
+    @staticmethod
+    def _collection_not_found() -> Tuple[type, ...]:
+        """Exceptions Chroma raises for a missing collection (they vary by version)"""
+        import chromadb.errors
+        
+        names = ("NotFoundError", "InvalidCollectionException")
+        return tuple(
+            getattr(chromadb.errors, name) for name in names if hasattr(chromadb.errors, name)
+        ) + (ValueError,)
+    
+    def encode_texts(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """Embed texts through the attached batcher if any, bypassing the cache"""
+        if self.embedding_batcher is not None:
+            return self.embedding_batcher.encode(texts)
+        return self.encode_direct(texts, batch_size=batch_size)
+    
+    def encode_direct(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """Run texts through the embedding model as float32 vectors"""
+        return self.embedding_model.encode(
+            texts,
+            batch_size=batch_size or config.EMBEDDING_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        ).astype(np.float32, copy=False)
     
     def get_embedding(self, text: str) -> List[float]:
         """Get embedding from FREE local model"""
-        embedding = self.embedding_model.encode(text, convert_to_tensor=False)
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get(text)
+            if cached is not None:
+                return cached.tolist()
+        
+        embedding = self.encode_texts([text])[0]
+        
+        if self.embedding_cache is not None:
+            self.embedding_cache.put(text, embedding)
         return embedding.tolist()
     
-    def add_chunks(self, chunks: List[Dict[str, str]]):
-        """Add chunks to the vector database"""
+    def get_embeddings(self, texts: List[str], batch_size: int = None) -> np.ndarray:
+        """
+        Get embeddings for many texts using batched forward passes
+        
+        Args:
+            texts: Texts to embed
+            batch_size: Texts per forward pass (defaults to config.EMBEDDING_BATCH_SIZE)
+        
+        Returns:
+            float32 array of shape (len(texts), embedding_dim)
+        """
+        if not texts:
+            dim = self.embedding_model.get_sentence_embedding_dimension()
+            return np.empty((0, dim), dtype=np.float32)
+        
+        if self.embedding_cache is not None:
+            found, missing = self.embedding_cache.get_many(texts)
+        else:
+            found, missing = {}, list(range(len(texts)))
+        
+        # Only cache misses go through the model
+        computed = None
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            computed = self.encode_texts(missing_texts, batch_size=batch_size)
+            
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(missing_texts, computed)
+        
+        if not found:
+            return computed
+        
+        dim = next(iter(found.values())).shape[0]
+        embeddings = np.empty((len(texts), dim), dtype=np.float32)
+        for i, vector in found.items():
+            embeddings[i] = vector
+        if missing:
+            embeddings[missing] = computed
+        
+        return embeddings
+    
+    def get_query_embedding(self, query: str = None) -> List[float]:
+        """
+        Get the embedding of a constant retrieval query, computed once per model
+        
+        The embedding is kept in memory and persisted next to the Chroma DB,
+        so a warm process (or a restarted one) never re-embeds the template.
+        
+        Args:
+            query: Constant query text (defaults to config.RETRIEVAL_QUERY_TEMPLATE)
+        """
+        query = query or config.RETRIEVAL_QUERY_TEMPLATE
+        key = hashlib.sha256(
+            f"{config.LOCAL_EMBEDDING_MODEL}\0{query}".encode("utf-8")
+        ).hexdigest()[:16]
+        
+        if key in self._query_embeddings:
+            return self._query_embeddings[key]
+        
+        path = os.path.join(config.VECTOR_DB_PATH, f"query_embedding_{key}.npy")
+        if os.path.exists(path):
+            embedding = np.load(path).tolist()
+        else:
+            embedding = self.get_embedding(query)
+            os.makedirs(config.VECTOR_DB_PATH, exist_ok=True)
+            np.save(path, np.asarray(embedding, dtype=np.float32))
+        
+        self._query_embeddings[key] = embedding
+        return embedding
+    
+    @staticmethod
+    def dedupe_chunks(chunks: List[Dict[str, str]]) -> Dict[str, int]:
+        """Map each stable chunk ID to the index of its first occurrence"""
+        unique = {}
+        for i, chunk in enumerate(chunks):
+            chunk_key = chunk.get("id") or ClinicalNoteChunker.make_chunk_id(
+                chunk.get("patient_id", "unknown"),
+                chunk.get("note_id", chunk.get("encounter_id", "unknown")),
+                chunk["section"],
+                chunk["text"]
+            )
+            unique.setdefault(chunk_key, i)
+        return unique
+    
+    def build_memory_index(self, chunks: List[Dict[str, str]], batch_size: int = None) -> InMemoryIndex:
+        """Embed a note's chunks (through the embedding cache) into an InMemoryIndex"""
+        unique = [chunks[i] for i in self.dedupe_chunks(chunks).values()]
+        embeddings = self.get_embeddings([chunk["text"] for chunk in unique], batch_size=batch_size)
+        return InMemoryIndex(unique, embeddings)
+    
+    def add_chunks(
+        self,
+        chunks: List[Dict[str, str]],
+        batch_size: int = None,
+        embeddings: Union[np.ndarray, Dict[str, np.ndarray]] = None
+    ):
+        """
+        Upsert chunks into the vector database
+        
+        Chunks whose stable ID is already stored are skipped entirely, so
+        re-indexing an unchanged note does no embedding and no writes.
+        
+        Args:
+            chunks: Chunks from ClinicalNoteChunker.process_note
+            batch_size: Texts per embedding forward pass
+            embeddings: Optional precomputed embeddings aligned with `chunks`,
+                or a dict of chunk ID -> embedding (chunks missing from it
+                are embedded here)
+        """
+        if not chunks:
+            return
+        
         if not self.collection:
             self.get_collection()
         
+        # Deduplicate by stable ID (identical text in one section of one note)
+        positions = self.dedupe_chunks(chunks)
+        unique_chunks = {chunk_key: chunks[i] for chunk_key, i in positions.items()}
+        
+        with timed("vector_add"):
+            stored = self.collection.get(ids=list(unique_chunks), include=["metadatas"])
+            existing = set(stored["ids"])
+            new_chunks = {
+                chunk_key: chunk for chunk_key, chunk in unique_chunks.items()
+                if chunk_key not in existing
+            }
+            
+            # Unchanged chunks of a revised note may have been renumbered or
+            # moved; refresh their prompt alias and offsets without re-embedding
+            renumbered = []
+            for chunk_key, metadata in zip(stored["ids"], stored["metadatas"]):
+                chunk = unique_chunks[chunk_key]
+                current = {"chunk_id": chunk["chunk_id"], **InMemoryIndex.position(chunk)}
+                if any(metadata.get(key) != value for key, value in current.items()):
+                    renumbered.append((chunk_key, {**metadata, **current}))
+            if renumbered:
+                self.collection.update(
+                    ids=[chunk_key for chunk_key, _ in renumbered],
+                    metadatas=[metadata for _, metadata in renumbered]
+                )
+        
+        if not new_chunks:
+            print(f"✓ All {len(unique_chunks)} chunks already indexed (nothing to embed)")
+            return
+        
+        self._upsert(new_chunks, positions, embeddings, batch_size, len(existing))
+    
+    @staticmethod
+    def chunk_metadata(chunk: Dict) -> Dict:
+        """Chroma metadata stored with a chunk"""
+        return {
+            "chunk_id": chunk["chunk_id"],
+            "section": chunk["section"],
+            "patient_id": chunk.get("patient_id", "unknown"),
+            "encounter_id": chunk.get("encounter_id", "unknown"),
+            "note_id": chunk.get("note_id", chunk.get("encounter_id", "unknown")),
+            **InMemoryIndex.position(chunk)
+        }
+    
+    def _upsert(
+        self,
+        new_chunks: Dict[str, Dict],
+        positions: Dict[str, int],
+        embeddings: Union[np.ndarray, Dict[str, np.ndarray]],
+        batch_size: int,
+        already_indexed: int
+    ):
+        """Embed (unless precomputed) and upsert chunks known to be missing"""
         # Prepare data for ChromaDB
-        ids = []
-        documents = []
-        metadatas = []
-        embeddings = []
-        
-        print(f"Generating embeddings for {len(chunks)} chunks (FREE - no API costs!)...")
-        
-        for chunk in chunks:
-            ids.append(chunk["chunk_id"])
-            documents.append(chunk["text"])
-            metadatas.append({
-                "section": chunk["section"],
-                "patient_id": chunk.get("patient_id", "unknown")
-            })
+        ids = list(new_chunks)
+        documents = [chunk["text"] for chunk in new_chunks.values()]
+        metadatas = [self.chunk_metadata(chunk) for chunk in new_chunks.values()]
+        
+        if isinstance(embeddings, dict):
+            # Precomputed by ID; anything the caller did not expect to be new is embedded now
+            missing = [i for i, chunk_key in enumerate(ids) if chunk_key not in embeddings]
+            computed = {}
+            if missing:
+                with timed("embedding"):
+                    vectors = self.get_embeddings([documents[i] for i in missing], batch_size=batch_size)
+                computed = {ids[i]: vector for i, vector in zip(missing, vectors)}
+            new_embeddings = np.stack([
+                np.asarray(computed[chunk_key] if chunk_key in computed else embeddings[chunk_key],
+                           dtype=np.float32)
+                for chunk_key in ids
+            ])
+        elif embeddings is not None:
+            new_embeddings = np.asarray(embeddings, dtype=np.float32)[
+                [positions[chunk_key] for chunk_key in ids]
+            ]
+        else:
+            print(f"Generating embeddings for {len(new_chunks)} new chunks "
+                  f"({already_indexed} already indexed, FREE - no API costs!)...")
             
-            # Get embedding from FREE local model
-            embedding = self.get_embedding(chunk["text"])
-            embeddings.append(embedding)
-        
-        # Add to collection
-        self.collection.add(
-            ids=ids,
-            documents=documents,
-            metadatas=metadatas,
-            embeddings=embeddings
-        )
+            # One batched pass through the FREE local model instead of one call per chunk
+            with timed("embedding"):
+                new_embeddings = self.get_embeddings(documents, batch_size=batch_size)
+        
+        # Upsert into collection
+        with timed("vector_add"):
+            self.collection.upsert(
+                ids=ids,
+                documents=documents,
+                metadatas=metadatas,
+                embeddings=new_embeddings
+            )
+        
+        def add_to_lexical(index: BM25Index):
+            for chunk_key, text, metadata in zip(ids, documents, metadatas):
+                index.add(chunk_key, text, metadata["patient_id"],
+                          metadata["encounter_id"], metadata["note_id"])
+        self._update_lexical(add_to_lexical)
+        
+        print(f"✓ Upserted {len(new_chunks)} chunks into collection")
+        
+        if self.embedding_cache is not None:
+            stats = self.embedding_cache.stats()
+            print(f"  Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({stats['hit_rate']:.0%} hit rate)")
+    
+    def index_note_chunks(
+        self,
+        chunks: List[Dict[str, str]],
+        patient_id: str,
+        encounter_id: str,
+        note_id: str,
+        embeddings: Union[np.ndarray, Dict[str, np.ndarray]] = None,
+        batch_size: int = None
+    ) -> Dict[str, int]:
+        """
+        Make the stored version of one note match `chunks`
+        
+        The chunks are diffed against the note's manifest entry by stable
+        (content-hashed) ID: only new chunks are embedded and written,
+        vanished ones are deleted by ID, and chunks that merely moved or
+        were renumbered get a metadata update. Without a manifest entry the
+        note is reconciled against Chroma once, as add_chunks does.
+        
+        Args:
+            chunks: Chunks of the current version from ClinicalNoteChunker.process_note
+            patient_id / encounter_id / note_id: Scope of the note
+            embeddings: Optional precomputed embeddings, as for add_chunks
+            batch_size: Texts per embedding forward pass
+        
+        Returns:
+            Counts of added, removed, moved and unchanged chunks, and changed sections
+        """
+        if not self.collection:
+            self.get_collection()
+        
+        positions = self.dedupe_chunks(chunks)
+        current = {chunk_key: chunks[i] for chunk_key, i in positions.items()}
+        records = {chunk_key: NoteManifest.record(chunk) for chunk_key, chunk in current.items()}
+        previous = self.manifest.get(patient_id, note_id)
+        
+        if previous is None:
+            self.add_chunks(chunks, batch_size=batch_size, embeddings=embeddings)
+            self.prune_note(patient_id, encounter_id, note_id, records)
+            return {"added": len(current), "removed": 0, "moved": 0, "unchanged": 0,
+                    "sections_changed": len({record["section"] for record in records.values()})}
+        
+        added = {chunk_key: chunk for chunk_key, chunk in current.items() if chunk_key not in previous}
+        removed = [chunk_key for chunk_key in previous if chunk_key not in current]
+        moved = [
+            chunk_key for chunk_key in current
+            if chunk_key in previous and previous[chunk_key] != records[chunk_key]
+        ]
+        
+        with timed("vector_add"):
+            if removed:
+                self.collection.delete(ids=removed)
+                self._update_lexical(lambda index: index.remove(removed))
+            if moved:
+                self.collection.update(
+                    ids=moved,
+                    metadatas=[self.chunk_metadata(current[chunk_key]) for chunk_key in moved]
+                )
+        if added:
+            self._upsert(added, positions, embeddings, batch_size, len(current) - len(added))
+        
+        self.manifest.put(patient_id, encounter_id, note_id, records)
+        
+        changed_sections = {current[chunk_key]["section"] for chunk_key in added}
+        changed_sections.update(previous[chunk_key]["section"] for chunk_key in removed)
+        return {
+            "added": len(added),
+            "removed": len(removed),
+            "moved": len(moved),
+            "unchanged": len(current) - len(added) - len(moved),
+            "sections_changed": len(changed_sections)
+        }
+    
+    def prune_note(
+        self,
+        patient_id: str,
+        encounter_id: str,
+        note_id: str,
+        records: Dict[str, Dict]
+    ):
+        """
+        Delete a note's stored chunks that are not in `records`, then make
+        `records` its manifest entry
+        
+        Completes an index built with add_chunks, e.g. a large note streamed
+        in batches. Uses the manifest when it has the note, else Chroma.
+        """
+        if not self.collection:
+            self.get_collection()
         
-        print(f"✓ Added {len(chunks)} chunks to collection")
+        previous = self.manifest.get(patient_id, note_id)
+        with timed("vector_add"):
+            if previous is None:
+                self.delete_chunks(patient_id, note_id=note_id, keep_ids=list(records))
+            else:
+                stale = [chunk_key for chunk_key in previous if chunk_key not in records]
+                if stale:
+                    self.collection.delete(ids=stale)
+                    self._update_lexical(lambda index: index.remove(stale))
+                    print(f"✓ Removed {len(stale)} stale chunks")
+        
+        self.manifest.put(patient_id, encounter_id, note_id, records)
+    
+    @staticmethod
+    def build_where(
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> Optional[Dict]:
+        """Build a Chroma metadata filter scoping results to a patient/encounter/note"""
+        conditions = []
+        if patient_id:
+            conditions.append({"patient_id": patient_id})
+        if encounter_id:
+            conditions.append({"encounter_id": encounter_id})
+        if note_id:
+            conditions.append({"note_id": note_id})
+        
+        if not conditions:
+            return None
+        if len(conditions) == 1:
+            return conditions[0]
+        return {"$and": conditions}
     
-    def retrieve(self, query: str, k: int = None) -> List[Dict[str, str]]:
+    def delete_chunks(
+        self,
+        patient_id: str,
+        encounter_id: str = None,
+        note_id: str = None,
+        keep_ids: List[str] = None
+    ):
+        """
+        Delete a patient's chunks (optionally only one encounter's or note's)
+        
+        Args:
+            keep_ids: Chunk IDs in scope that must be kept, e.g. the chunks of
+                the current version of a re-indexed note
+        """
+        if not self.collection:
+            self.get_collection()
+        
+        where = self.build_where(patient_id, encounter_id, note_id)
+        if keep_ids is None:
+            self.collection.delete(where=where)
+            self.manifest.delete(patient_id, encounter_id, note_id)
+            self._update_lexical(lambda index: index.remove_where(patient_id, encounter_id, note_id))
+            return
+        
+        stored = self.collection.get(where=where, include=[])["ids"]
+        keep = set(keep_ids)
+        stale = [chunk_key for chunk_key in stored if chunk_key not in keep]
+        if stale:
+            self.collection.delete(ids=stale)
+            self._update_lexical(lambda index: index.remove(stale))
+            print(f"✓ Removed {len(stale)} stale chunks")
+    
+    def keyword_search(
+        self,
+        query: str,
+        k: int = None,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Exact-term BM25 lookup, without the embedding model or the vector DB
+        
+        Returns:
+            (stored chunk ID, BM25 score) pairs, best first
+        """
+        return self.lexical_index.search(
+            query, k or config.RETRIEVAL_K, patient_id, encounter_id, note_id
+        )
+    
+    def retrieve(
+        self,
+        query: str = None,
+        k: int = None,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> List[Dict[str, str]]:
         """
         Retrieve top K most relevant chunks for a query
         
+        Args:
+            query: Free-text query; if omitted, the precomputed embedding of
+                config.RETRIEVAL_QUERY_TEMPLATE is used
+            k: Number of chunks to retrieve
+            patient_id: Only search this patient's chunks
+            encounter_id: Only search this encounter's chunks
+            note_id: Only search this note's chunks
+        
         Returns:
-            List of chunks with chunk_id, section, text, and distance
+            List of chunks with id, chunk_id (per-note alias), section, text,
+            patient_id, note_id, and distance (plus rrf_score for hybrid retrieval)
+        
+        With HYBRID_RETRIEVAL, a free-text query is also run against the BM25
+        keyword index and both rankings are merged by reciprocal rank fusion,
+        so exact drug names, lab codes and doses are found even when the
+        embedding misses them. The default template query is dense-only.
+        
+        With MMR_ENABLED, the top MMR_FETCH_K candidates are re-ranked by
+        maximal marginal relevance over their stored embeddings, so fewer,
+        less redundant chunks reach the prompt (see mmr_select).
         """
         if not self.collection:
             self.get_collection()
         
         k = k or config.RETRIEVAL_K
+        hybrid = config.HYBRID_RETRIEVAL and query is not None
+        diverse = config.MMR_ENABLED
+        n_candidates = max(k, config.HYBRID_CANDIDATES) if hybrid else k
+        if diverse:
+            n_candidates = max(n_candidates, config.MMR_FETCH_K)
         
-        # Get query embedding from FREE local model
-        query_embedding = self.get_embedding(query)
+        # Get query embedding from FREE local model (memoized for the template)
+        if query is None:
+            query_embedding = self.get_query_embedding()
+        else:
+            query_embedding = self.get_embedding(query)
         
-        # Query the collection
+        # Query the collection, scoped by metadata so patients never mix
+        where = self.build_where(patient_id, encounter_id, note_id)
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if diverse else [])
         results = self.collection.query(
             query_embeddings=[query_embedding],
-            n_results=k
+            n_results=n_candidates,
+            where=where,
+            include=include
         )
         
         # Format results
-        chunks = []
-        for i in range(len(results['ids'][0])):
-            chunks.append({
-                "chunk_id": results['ids'][0][i],
-                "section": results['metadatas'][0][i].get('section', 'UNKNOWN'),
-                "text": results['documents'][0][i],
-                "distance": results['distances'][0][i] if 'distances' in results else 0.0
-            })
+        chunks = [
+            self._format_result(chunk_key, text, metadata, distance)
+            for chunk_key, text, metadata, distance in zip(
+                results['ids'][0],
+                results['documents'][0],
+                results['metadatas'][0],
+                results['distances'][0] if 'distances' in results else [0.0] * len(results['ids'][0])
+            )
+        ]
+        vectors = dict(zip(results['ids'][0], results['embeddings'][0])) if diverse else {}
         
-        return chunks
+        if hybrid:
+            chunks = self._fuse_keyword_hits(
+                query, query_embedding, chunks, vectors,
+                n_candidates if diverse else k, patient_id, encounter_id, note_id
+            )
+            relevance = [chunk["rrf_score"] for chunk in chunks]
+        else:
+            relevance = [1.0 - chunk["distance"] for chunk in chunks]
+        
+        if not diverse or not chunks:
+            return chunks[:k]
+        
+        # RRF scores are tiny; rescale so they weigh against cosine similarity
+        relevance = np.asarray(relevance, dtype=np.float32)
+        if hybrid:
+            relevance /= max(float(relevance.max()), 1e-12)
+        picks = mmr_select(
+            relevance,
+            np.stack([np.asarray(vectors[chunk["id"]], dtype=np.float32) for chunk in chunks]),
+            k,
+            sections=[chunk["section"] for chunk in chunks]
+        )
+        return [chunks[i] for i in picks]
+    
+    def _fuse_keyword_hits(
+        self,
+        query: str,
+        query_embedding: List[float],
+        chunks: List[Dict],
+        vectors: Dict[str, np.ndarray],
+        k: int,
+        patient_id: str = None,
+        encounter_id: str = None,
+        note_id: str = None
+    ) -> List[Dict]:
+        """Merge BM25 hits into dense hits by RRF; embeddings of keyword-only hits land in `vectors`"""
+        lexical = self.keyword_search(
+            query, max(k, config.HYBRID_CANDIDATES), patient_id, encounter_id, note_id
+        )
+        fused = reciprocal_rank_fusion(
+            [[chunk["id"] for chunk in chunks], [chunk_key for chunk_key, _ in lexical]],
+            config.RRF_K
+        )[:k]
+        
+        # Keyword-only hits are fetched by ID, with their true cosine distance
+        by_id = {chunk["id"]: chunk for chunk in chunks}
+        missing = [chunk_key for chunk_key, _ in fused if chunk_key not in by_id]
+        if missing:
+            stored = self.collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            query_vector /= max(float(np.linalg.norm(query_vector)), 1e-12)
+            for chunk_key, text, metadata, embedding in zip(
+                stored["ids"], stored["documents"], stored["metadatas"], stored["embeddings"]
+            ):
+                embedding = np.asarray(embedding, dtype=np.float32)
+                similarity = float(embedding @ query_vector) / max(float(np.linalg.norm(embedding)), 1e-12)
+                by_id[chunk_key] = self._format_result(chunk_key, text, metadata, 1.0 - similarity)
+                vectors[chunk_key] = embedding
+        
+        return [
+            {**by_id[chunk_key], "rrf_score": round(score, 6)}
+            for chunk_key, score in fused if chunk_key in by_id
+        ]
+    
+    @staticmethod
+    def _format_result(chunk_key: str, text: str, metadata: Dict, distance: float) -> Dict:
+        return {
+            "id": chunk_key,
+            "chunk_id": metadata.get('chunk_id', chunk_key),
+            "section": metadata.get('section', 'UNKNOWN'),
+            "text": text,
+            "patient_id": metadata.get('patient_id', 'unknown'),
+            "note_id": metadata.get('note_id', 'unknown'),
+            "distance": distance,
+            **InMemoryIndex.position(metadata)
+        }
     
     def clear_collection(self):
         """Clear all data from collection"""
         if self.collection:
             try:
-                self.client.delete_collection(name=config.COLLECTION_NAME)
-                print(f"Cleared collection: {config.COLLECTION_NAME}")
+                self.client.delete_collection(name=self.collection.name)
+                self.manifest.clear()
+                with self._lexical_lock:
+                    self._lexical = None
+                print(f"Cleared collection: {self.collection.name}")
             except:
                 pass
 
@@ -157,12 +898,12 @@ WBC 16.5 x10^9/L (elevated), CRP 120 mg/L (elevated).
     
     # Initialize LOCAL retriever (FREE!)
     retriever = ClinicalRAGRetriever()
-    retriever.create_collection()
+    retriever.get_collection()
     retriever.add_chunks(chunks)
     
     # Test retrieval
     query = "What are the patient's symptoms and lab findings?"
-    results = retriever.retrieve(query, k=3)
+    results = retriever.retrieve(query, k=3, patient_id="PT001")
     
     print(f"\nRetrieved {len(results)} chunks:")
     for chunk in results:
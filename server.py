@@ -0,0 +1,356 @@
+"""
+Long-running HTTP service for the Clinical RAG System
+Keeps one warm pipeline (embedding model, Chroma, Ollama connections) in memory
+so each request only pays for the work it actually needs
+"""
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from config import config
+from timing import render_prometheus
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding calls into shared forward passes
+
+    Callers block in encode() while a single worker thread collects requests
+    for up to `max_wait_ms` (or until `max_batch` texts are queued), runs
+    them through the model once and hands each caller its own rows.
+    """
+
+    def __init__(
+        self,
+        encode_fn: Callable[[List[str]], np.ndarray],
+        max_batch: int = None,
+        max_wait_ms: float = None
+    ):
+        self.encode_fn = encode_fn
+        self.max_batch = max_batch or config.SERVER_EMBED_MAX_BATCH
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else config.SERVER_EMBED_WAIT_MS) / 1000
+        self.batches = 0
+        self.texts = 0
+        self.requests = 0
+
+        self._queue: "queue.Queue[Tuple[List[str], Future]]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts as part of the next shared batch"""
+        future = Future()
+        self._queue.put((list(texts), future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0][0])
+            deadline = time.monotonic() + self.max_wait
+
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                size += len(item[0])
+
+            texts = [text for item_texts, _ in pending for text in item_texts]
+            try:
+                embeddings = self.encode_fn(texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.texts += len(texts)
+            self.requests += len(pending)
+
+            start = 0
+            for item_texts, future in pending:
+                future.set_result(embeddings[start:start + len(item_texts)])
+                start += len(item_texts)
+
+    def stats(self) -> Dict:
+        """Batching counters since startup"""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "texts": self.texts,
+            "mean_batch_size": self.texts / self.batches if self.batches else 0.0
+        }
+
+
+class ServiceMetrics:
+    """Request counters and latencies, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, int], int] = {}
+        self.latency: Dict[str, List[float]] = {}  # endpoint -> [sum, count]
+        self.generations_in_flight = 0
+        self.generations_waiting = 0
+
+    def observe(self, endpoint: str, status: int, seconds: float):
+        with self._lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            total = self.latency.setdefault(endpoint, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def adjust(self, name: str, delta: int):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def render(self, extra: Dict[str, float]) -> str:
+        lines = [
+            "# TYPE clinical_rag_requests_total counter",
+        ]
+        with self._lock:
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'clinical_rag_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}'
+                )
+            lines.append("# TYPE clinical_rag_request_seconds summary")
+            for endpoint, (total, count) in sorted(self.latency.items()):
+                lines.append(f'clinical_rag_request_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}')
+                lines.append(f'clinical_rag_request_seconds_count{{endpoint="{endpoint}"}} {count}')
+            gauges = {
+                "generations_in_flight": self.generations_in_flight,
+                "generations_waiting": self.generations_waiting,
+                "uptime_seconds": time.time() - self.started_at,
+            }
+        gauges.update(extra)
+
+        for name, value in gauges.items():
+            lines.append(f"# TYPE clinical_rag_{name} gauge")
+            lines.append(f"clinical_rag_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class ClinicalRAGService:
+    """Warm pipeline plus the request handling behind each endpoint"""
+
+    def __init__(self, pipeline=None, max_generations: int = None):
+        from pipeline import ClinicalRAGPipeline
+
+        self.pipeline = pipeline or ClinicalRAGPipeline()
+        self.metrics = ServiceMetrics()
+        self.max_generations = max_generations or config.SERVER_MAX_GENERATIONS
+        self._generation_slots = threading.BoundedSemaphore(self.max_generations)
+
+        # Concurrent /index and /analyze requests share embedding forward passes
+        retriever = self.pipeline.retriever
+        self.batcher = EmbeddingBatcher(retriever.encode_direct)
+        retriever.embedding_batcher = self.batcher
+
+    def warm_up(self):
+        """Load the embedding model, open Chroma and probe Ollama once at startup"""
+        retriever = self.pipeline.retriever
+        retriever.embedding_model
+        retriever.get_collection()
+        retriever.get_query_embedding()
+        self.pipeline.generator._check_ollama()
+        print("✓ Service warm: embedding model, vector DB and Ollama connection ready")
+
+    @staticmethod
+    def _scope(payload: Dict) -> Dict:
+        return {
+            "patient_id": payload.get("patient_id"),
+            "encounter_id": payload.get("encounter_id"),
+            "note_id": payload.get("note_id"),
+        }
+
+    def analyze(self, payload: Dict) -> Dict:
+        """Index the note (unless use_indexed) and generate summary + differential"""
+        use_indexed = bool(payload.get("use_indexed", False))
+        if not use_indexed and not payload.get("note"):
+            raise ValueError("'note' is required unless use_indexed is true")
+
+        scope = self._scope(payload)
+        timings = {}
+        chunks = self.pipeline.prepare_chunks(
+            payload.get("note"),
+            scope["patient_id"],
+            use_indexed,
+            payload.get("retrieval_k"),
+            scope["encounter_id"],
+            scope["note_id"],
+            timings,
+            persist=bool(payload.get("persist", False))
+        )
+
+        # Embedding work above is unbounded; only the LLM call waits for a slot
+        self.metrics.adjust("generations_waiting", 1)
+        with self._generation_slots:
+            self.metrics.adjust("generations_waiting", -1)
+            self.metrics.adjust("generations_in_flight", 1)
+            try:
+                result = self.pipeline.generator.generate_clinical_output(
+                    chunks, patient_id=scope["patient_id"]
+                )
+            finally:
+                self.metrics.adjust("generations_in_flight", -1)
+
+        return self.pipeline.merge_timings(result, timings)
+
+    def index(self, payload: Dict) -> Dict:
+        """Chunk, embed and store a note"""
+        if not payload.get("note"):
+            raise ValueError("'note' is required")
+
+        scope = self._scope(payload)
+        chunks = self.pipeline.index_note(payload["note"], **scope)
+        return {
+            "indexed": len(chunks),
+            "chunks": [
+                {"id": chunk["id"], "chunk_id": chunk["chunk_id"], "section": chunk["section"]}
+                for chunk in chunks
+            ]
+        }
+
+    def retrieve(self, payload: Dict) -> Dict:
+        """Top-k chunks for a query (or the default summary/differential query)"""
+        chunks = self.pipeline.retriever.retrieve(
+            query=payload.get("query"),
+            k=payload.get("k"),
+            **self._scope(payload)
+        )
+        return {"chunks": chunks}
+
+    def health(self) -> Dict:
+        """Liveness plus what is loaded, without calling out to Ollama"""
+        retriever = self.pipeline.retriever
+        return {
+            "status": "ok",
+            "model": self.pipeline.generator.model,
+            "embedding_model": config.LOCAL_EMBEDDING_MODEL,
+            "embedding_model_loaded": retriever._embedding_model is not None,
+            "collection": config.COLLECTION_NAME,
+            "chunks_indexed": retriever.collection.count() if retriever.collection else 0,
+            "max_generations": self.max_generations,
+            "uptime_seconds": round(time.time() - self.metrics.started_at, 1)
+        }
+
+    def metrics_text(self) -> str:
+        """Prometheus exposition of request, stage latency, batching and cache metrics"""
+        extra = {f"embedding_{key}": value for key, value in self.batcher.stats().items()}
+        retriever = self.pipeline.retriever
+        if retriever.embedding_cache is not None:
+            extra["embedding_cache_hit_rate"] = retriever.embedding_cache.stats()["hit_rate"]
+        generation_cache = self.pipeline.generator.generation_cache
+        if generation_cache is not None:
+            extra["generation_cache_hit_rate"] = generation_cache.stats()["hit_rate"]
+        return self.metrics.render(extra) + render_prometheus()
+
+
+def make_handler(service: ClinicalRAGService):
+    """Request handler class bound to a service instance"""
+
+    routes = {
+        "/analyze": service.analyze,
+        "/index": service.index,
+        "/retrieve": service.retrieve,
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are separate writes; avoid Nagle/delayed-ACK stalls
+        disable_nagle_algorithm = True
+
+        def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status: int, data: Dict):
+            self._send(status, json.dumps(data).encode("utf-8"))
+
+        def do_GET(self):
+            start = time.perf_counter()
+            if self.path == "/health":
+                status = 200
+                self._send_json(status, service.health())
+            elif self.path == "/metrics":
+                status = 200
+                self._send(status, service.metrics_text().encode("utf-8"),
+                           "text/plain; version=0.0.4")
+            else:
+                status = 404
+                self._send_json(status, {"error": f"Unknown endpoint: {self.path}"})
+            service.metrics.observe(self.path if status != 404 else "unknown", status,
+                                    time.perf_counter() - start)
+
+        def do_POST(self):
+            start = time.perf_counter()
+            endpoint = self.path if self.path in routes else "unknown"
+            status, data = self._dispatch()
+            self._send_json(status, data)
+            service.metrics.observe(endpoint, status, time.perf_counter() - start)
+
+        def _dispatch(self) -> Tuple[int, Dict]:
+            handler = routes.get(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > config.SERVER_MAX_BODY_BYTES:
+                self.close_connection = True
+                return 413, {"error": f"Request body exceeds {config.SERVER_MAX_BODY_BYTES} bytes"}
+
+            body = self.rfile.read(length)
+            if handler is None:
+                return 404, {"error": f"Unknown endpoint: {self.path}"}
+
+            try:
+                payload = json.loads(body or b"{}")
+                if not isinstance(payload, dict):
+                    raise ValueError("Request body must be a JSON object")
+                result = handler(payload)
+            except (json.JSONDecodeError, ValueError) as e:
+                return 400, {"error": str(e)}
+            except Exception as e:
+                print(f"⚠ {self.path} failed: {e}")
+                return 500, {"error": str(e)}
+
+            # Generation failures come back as error results, not exceptions
+            return (502 if "error" in result else 200), result
+
+    return Handler
+
+
+def serve(host: str = None, port: int = None, service: ClinicalRAGService = None):
+    """Run the HTTP service until interrupted"""
+    host = host or config.SERVER_HOST
+    port = port or config.SERVER_PORT
+
+    service = service or ClinicalRAGService()
+    service.warm_up()
+
+    httpd = ThreadingHTTPServer((host, port), make_handler(service))
+    httpd.daemon_threads = True
+    print(f"✓ Serving Clinical RAG API on http://{host}:{port} "
+          f"(POST /analyze, /index, /retrieve; GET /health, /metrics)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+    finally:
+        httpd.server_close()
+        service.pipeline.generator.close()
+
+
+if __name__ == "__main__":
+    serve()
@@ -5,6 +5,22 @@ FREE version using local models only
 """
 import sys
 import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def temporary_config(**overrides):
+    """Override config settings for the duration of a test"""
+    from config import config
+    
+    saved = {name: getattr(config, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    try:
+        yield config
+    finally:
+        for name, value in saved.items():
+            setattr(config, name, value)
 
 
 def test_imports():
@@ -129,6 +145,39 @@ Lungs: crackles in right base
         if len(chunks) > 0:
             print(f"  ✓ First chunk ID: {chunks[0]['chunk_id']}")
             print(f"  ✓ First section: {chunks[0]['section']}")
+            
+            # Stored IDs are stable per note and unique across patients
+            again = chunker.process_note(sample_note, patient_id="TEST")
+            other = chunker.process_note(sample_note, patient_id="OTHER")
+            if [c['id'] for c in again] != [c['id'] for c in chunks]:
+                print("  ✗ Chunk IDs are not stable across runs")
+                return False
+            if {c['id'] for c in other} & {c['id'] for c in chunks}:
+                print("  ✗ Chunk IDs collide across patients")
+                return False
+            print(f"  ✓ Stable chunk ID: {chunks[0]['id']}")
+            
+            # Section offsets point back into the note; aliases are configurable
+            sections = chunker.extract_sections(sample_note)
+            if any(sample_note[s['start']:s['end']] != s['text'] for s in sections):
+                print("  ✗ Section offsets do not match section text")
+                return False
+            extended = ClinicalNoteChunker(section_aliases=["Social History"])
+            names = [s['section'] for s in extended.extract_sections(sample_note + "Social history:\nNonsmoker\n")]
+            if names[-1] != "Social history":
+                print(f"  ✗ Configured section alias not detected: {names}")
+                return False
+            print(f"  ✓ {len(sections)} sections with offsets; custom aliases detected")
+            
+            # The streaming chunker matches process_note across block boundaries
+            import io
+            small = ClinicalNoteChunker(chunk_size=4, overlap=1)
+            expected = small.process_note(sample_note, patient_id="TEST", note_id="N1")
+            streamed = list(small.iter_chunks(io.BytesIO(sample_note.encode()), patient_id="TEST", note_id="N1", block_size=7))
+            if streamed != expected:
+                print("  ✗ Streaming chunker output differs from process_note")
+                return False
+            print(f"  ✓ Streaming chunker yields the same {len(streamed)} chunks")
             return True
         else:
             print("  ✗ No chunks generated")
@@ -139,6 +188,1009 @@ Lungs: crackles in right base
         return False
 
 
+def test_embedding_cache():
+    """Test the on-disk embedding cache"""
+    print("\nTesting embedding cache...")
+    
+    try:
+        import tempfile
+        import numpy as np
+        from cache import EmbeddingCache
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = EmbeddingCache(
+                model_name="test-model",
+                path=os.path.join(tmp, "cache.db"),
+                max_entries=2
+            )
+            cache.put_many(["Metformin 1000mg BID", "Lisinopril 10mg daily"],
+                           np.eye(2, dtype=np.float32))
+            
+            # Whitespace-only differences map to the same entry
+            found, missing = cache.get_many(["Metformin  1000mg\nBID", "Penicillin (rash)"])
+            if list(found) != [0] or missing != [1]:
+                print(f"  ✗ Unexpected lookup result: found={list(found)} missing={missing}")
+                return False
+            print("  ✓ Content-addressed lookup")
+            
+            # Lisinopril is now least recently used and gets evicted
+            cache.put("Atorvastatin 20mg daily", np.ones(2, dtype=np.float32))
+            if len(cache) != 2 or cache.get("Lisinopril 10mg daily") is not None:
+                print("  ✗ LRU eviction did not remove the oldest entry")
+                return False
+            print("  ✓ LRU eviction")
+            
+            stats = cache.stats()
+            print(f"  ✓ Counters: {stats['hits']} hits, {stats['misses']} misses")
+            cache.close()
+        
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Embedding cache error: {e}")
+        return False
+
+
+def test_startup():
+    """Test that the CLI entry point does not import heavy dependencies"""
+    print("\nTesting CLI startup...")
+    
+    try:
+        import subprocess
+        
+        heavy = ["chromadb", "sentence_transformers", "torch", "requests"]
+        check = (
+            "import sys, main; "
+            f"print(','.join(m for m in {heavy!r} if m in sys.modules))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", check],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+        
+        if output:
+            print(f"  ✗ main imports heavy modules at startup: {output}")
+            return False
+        
+        print("  ✓ main imports no heavy modules")
+        print("  ℹ Time it with: python benchmark.py startup")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Startup check error: {e}")
+        return False
+
+
+def test_generation_cache():
+    """Test the generation cache's keying and TTL"""
+    print("\nTesting generation cache...")
+    
+    try:
+        import tempfile
+        from cache import GenerationCache
+        
+        request = {"model": "llama3.2", "prompt": "CHUNKS: ...", "stream": False,
+                   "options": {"temperature": 0.0, "num_predict": 1200}}
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = GenerationCache(path=os.path.join(tmp, "generations.db"), ttl=60)
+            cache.put(request, {"response": "{}"})
+            
+            # Streaming vs blocking does not matter; the prompt and options do
+            if cache.get({**request, "stream": True}) != {"response": "{}"}:
+                print("  ✗ Identical request missed the cache")
+                return False
+            if cache.get({**request, "prompt": "CHUNKS: changed"}) is not None:
+                print("  ✗ Changed prompt hit the cache")
+                return False
+            print("  ✓ Keyed by model, options and prompt")
+            cache.close()
+            
+            expired = GenerationCache(path=os.path.join(tmp, "expired.db"), ttl=0.01)
+            expired.put(request, {"response": "{}"})
+            import time
+            time.sleep(0.05)
+            if expired.get(request) is not None:
+                print("  ✗ Expired entry was returned")
+                return False
+            print("  ✓ TTL expiry")
+            expired.close()
+        
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Generation cache error: {e}")
+        return False
+
+
+def test_json_stream():
+    """Test incremental parsing of streamed generation output"""
+    print("\nTesting streaming JSON parser...")
+    
+    try:
+        from json_stream import IncrementalJSONParser
+        
+        streamed = '```json\n{"summary": {"text": ["Fever, \\"39C\\"", "Cough"], ' \
+                   '"supporting_evidence": []}, "differential": [' \
+                   '{"rank": 1, "diagnosis": "CAP", "supporting_evidence": [{"offset": [0, 5]}]}]}\n```'
+        
+        parser = IncrementalJSONParser(watch=[("summary", "text"), ("differential",)])
+        events = []
+        for start in range(0, len(streamed), 3):
+            events.extend(parser.feed(streamed[start:start + 3]))
+        
+        values = [value for _, _, value in events]
+        expected = ['Fever, "39C"', "Cough", {"rank": 1, "diagnosis": "CAP",
+                                             "supporting_evidence": [{"offset": [0, 5]}]}]
+        if values != expected or not parser.complete:
+            print(f"  ✗ Unexpected events: {values}")
+            return False
+        
+        print(f"  ✓ Emitted {len(events)} elements incrementally")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Streaming parser error: {e}")
+        return False
+
+
+def test_analyze_notes():
+    """Test batch ordering (in order vs as completed) and input backpressure"""
+    print("\nTesting batch analysis...")
+    
+    try:
+        import time
+        from generator import ClinicalGenerator
+        from pipeline import ClinicalRAGPipeline
+        
+        with temporary_config(GENERATION_CACHE_ENABLED=False):
+            pipeline = ClinicalRAGPipeline()
+            pipeline._generator = ClinicalGenerator()
+        
+        # Stand-in stages: no embedding model or Ollama; the first note is slow
+        pipeline.prepare_chunks = lambda *args, **kwargs: []
+        
+        def generate(chunks, patient_id=None):
+            time.sleep(0.3 if patient_id == "P0" else 0.01)
+            return {"patient_id": patient_id, "model_metadata": {}}
+        pipeline.generator.generate_clinical_output = generate
+        
+        consumed = []
+        
+        def notes():
+            for i in range(6):
+                consumed.append(i)
+                yield {"note": "HPI: cough", "patient_id": f"P{i}"}
+        
+        in_order = pipeline.analyze_notes(notes(), generation_workers=2, max_pending=2)
+        first = next(in_order)
+        read_before_first = len(consumed)
+        rest = list(in_order)
+        if read_before_first > 2:
+            print(f"  ✗ Read {read_before_first} notes before the first result (max_pending=2)")
+            return False
+        indices = [first[0]] + [index for index, _ in rest]
+        if indices != list(range(6)) or rest[-1][1]["patient_id"] != "P5":
+            print(f"  ✗ Ordered results out of order: {indices}")
+            return False
+        
+        as_completed = [index for index, _ in pipeline.analyze_notes(
+            notes(), generation_workers=2, max_pending=4, ordered=False
+        )]
+        if sorted(as_completed) != list(range(6)) or as_completed[0] == 0:
+            print(f"  ✗ Unordered mode waited for the slow note: {as_completed}")
+            return False
+        
+        print(f"  ✓ Ordered and as-completed results; {read_before_first} notes read before the first result")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Batch analysis error: {e}")
+        return False
+
+
+def test_async_generation():
+    """Test async generation against the mock Ollama server across event loops"""
+    print("\nTesting async generation...")
+    
+    try:
+        import asyncio
+        from generator import ClinicalGenerator
+        from mock_ollama import start_mock_server
+        from pipeline import ClinicalRAGPipeline
+        
+        server = start_mock_server(latency=0.0, tokens_per_sec=10000.0, eval_tokens=10)
+        try:
+            with temporary_config(OLLAMA_BASE_URL=server.base_url, GENERATION_CACHE_ENABLED=False):
+                pipeline = ClinicalRAGPipeline()
+                pipeline._generator = ClinicalGenerator()
+            
+            chunks = [{"id": "PT1:N1:a", "chunk_id": "chunk_1", "section": "HPI",
+                       "text": "Chief complaint: cough", "note_id": "N1"}]
+            pipeline.prepare_chunks = lambda *args, **kwargs: chunks
+            
+            async def run_batch():
+                return await asyncio.gather(
+                    pipeline.generator.agenerate_clinical_output(chunks, patient_id="PT1"),
+                    pipeline.aanalyze_note("HPI: cough", patient_id="PT1")
+                )
+            
+            # A second asyncio.run() has a new loop; the client must follow it
+            results = asyncio.run(run_batch()) + asyncio.run(run_batch())
+            asyncio.run(pipeline.aclose())
+        finally:
+            server.shutdown()
+            server.server_close()
+        
+        errors = [result["error"] for result in results if "error" in result]
+        if errors:
+            print(f"  ✗ Async generation failed: {errors[0]}")
+            return False
+        if server.requests_served != 4 or any(len(result["differential"]) != 3 for result in results):
+            print(f"  ✗ Unexpected results ({server.requests_served} requests served)")
+            return False
+        
+        print("  ✓ agenerate_clinical_output and aanalyze_note work across event loops")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Async generation error: {e}")
+        return False
+
+
+def test_embedding_batcher():
+    """Test that concurrent embedding calls share forward passes"""
+    print("\nTesting embedding micro-batcher...")
+    
+    try:
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+        from server import EmbeddingBatcher
+        
+        calls = []
+        
+        def encode(texts):
+            calls.append(len(texts))
+            return np.array([[len(text), i] for i, text in enumerate(texts)], dtype=np.float32)
+        
+        batcher = EmbeddingBatcher(encode, max_batch=64, max_wait_ms=50)
+        requests = [["a" * (n + 1)] * (n + 1) for n in range(6)]
+        with ThreadPoolExecutor(6) as pool:
+            outputs = list(pool.map(batcher.encode, requests))
+        
+        if any(out.shape[0] != len(req) or out[0, 0] != len(req[0])
+               for req, out in zip(requests, outputs)):
+            print("  ✗ Rows returned to the wrong caller")
+            return False
+        if len(calls) >= len(requests):
+            print(f"  ✗ Calls were not coalesced: {calls}")
+            return False
+        
+        print(f"  ✓ {len(requests)} concurrent calls served by {len(calls)} forward pass(es)")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Embedding batcher error: {e}")
+        return False
+
+
+def test_structured_output():
+    """Test the output schema derived from the prompt and the format payload"""
+    print("\nTesting structured output...")
+    
+    try:
+        from generator import ClinicalGenerator, generation_output_schema
+        
+        schema = generation_output_schema()
+        evidence = schema["properties"]["summary"]["properties"]["supporting_evidence"]["items"]
+        differential = schema["properties"]["differential"]["items"]
+        if set(schema["required"]) != {"patient_id", "summary", "differential", "warnings"}:
+            print(f"  ✗ Unexpected top-level keys: {schema['required']}")
+            return False
+        if evidence["properties"]["offset"]["items"] != {"type": "integer"}:
+            print("  ✗ Citation offsets are not integer arrays")
+            return False
+        if differential["properties"]["confidence"] != {"type": "number"}:
+            print("  ✗ Confidence is not a number")
+            return False
+        
+        with temporary_config(GENERATION_CACHE_ENABLED=False):
+            generator = ClinicalGenerator()
+        generator.structured_output = True
+        if generator._request_body("prompt", stream=False).get("format") != schema:
+            print("  ✗ Schema not sent as Ollama's format")
+            return False
+        generator.structured_output = False
+        if "format" in generator._request_body("prompt", stream=True):
+            print("  ✗ format sent with structured output disabled")
+            return False
+        
+        print("  ✓ Schema matches the prompt's example and is sent as format")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Structured output error: {e}")
+        return False
+
+
+def test_http_service():
+    """Test the HTTP endpoints (/analyze, /health, /metrics) of the warm service"""
+    print("\nTesting HTTP service...")
+    
+    try:
+        import json
+        import threading
+        import urllib.error
+        import urllib.request
+        from http.server import ThreadingHTTPServer
+        from generator import ClinicalGenerator
+        from mock_ollama import start_mock_server
+        from pipeline import ClinicalRAGPipeline
+        from server import ClinicalRAGService, make_handler
+        
+        mock = start_mock_server(latency=0.0, tokens_per_sec=10000.0, eval_tokens=10)
+        with temporary_config(OLLAMA_BASE_URL=mock.base_url, GENERATION_CACHE_ENABLED=False,
+                              EMBEDDING_CACHE_ENABLED=False):
+            pipeline = ClinicalRAGPipeline()
+            pipeline._generator = ClinicalGenerator()
+            service = ClinicalRAGService(pipeline)
+        
+        # Retrieval is stubbed so no embedding model or vector DB is needed
+        chunks = [{"id": "PT1:N1:a", "chunk_id": "chunk_1", "section": "HPI",
+                   "text": "Chief complaint: cough", "note_id": "N1"}]
+        pipeline.prepare_chunks = lambda *args, **kwargs: chunks
+        
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service))
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{httpd.server_address[1]}"
+        
+        def call(path, payload=None):
+            data = json.dumps(payload).encode("utf-8") if payload is not None else None
+            request = urllib.request.Request(base + path, data=data, method="POST" if data else "GET")
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    return response.status, response.read().decode("utf-8")
+            except urllib.error.HTTPError as e:
+                return e.code, e.read().decode("utf-8")
+        
+        try:
+            analyze = call("/analyze", {"note": "HPI: cough", "patient_id": "PT1"})
+            invalid = call("/analyze", {"patient_id": "PT1"})
+            health = call("/health")
+            metrics = call("/metrics")
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            mock.shutdown()
+            mock.server_close()
+        
+        result = json.loads(analyze[1])
+        if analyze[0] != 200 or result.get("patient_id") != "PT1" or len(result["differential"]) != 3:
+            print(f"  ✗ /analyze returned {analyze[0]}: {analyze[1][:200]}")
+            return False
+        if invalid[0] != 400:
+            print(f"  ✗ /analyze without a note returned {invalid[0]}, expected 400")
+            return False
+        if health[0] != 200 or json.loads(health[1]).get("status") != "ok":
+            print(f"  ✗ /health returned {health[0]}")
+            return False
+        if 'clinical_rag_requests_total{endpoint="/analyze",status="200"} 1' not in metrics[1]:
+            print("  ✗ /metrics does not count the /analyze request")
+            return False
+        
+        print("  ✓ /analyze, /health and /metrics respond; bad input is a 400")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ HTTP service error: {e}")
+        return False
+
+
+def test_batch_resume():
+    """Test batch input reading and resume bookkeeping"""
+    print("\nTesting batch resume...")
+    
+    try:
+        import tempfile
+        from pathlib import Path
+        from main import iter_batch_records, load_completed
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "notes").mkdir()
+            (tmp / "notes" / "PT001.txt").write_text("Chief Complaint:\nCough")
+            records = list(iter_batch_records(str(tmp / "notes")))
+            if [(r["record_id"], r["patient_id"]) for r in records] != [("PT001.txt", "PT001")]:
+                print(f"  ✗ Unexpected directory records: {records}")
+                return False
+            
+            (tmp / "in.jsonl").write_text(
+                '{"patient_id": "PT1", "note": "a"}\n'
+                '{"patient_id": "PT2", "note_id": "N2", "note": "b"}\n'
+                'not json\n'
+            )
+            ids = [r["record_id"] for r in iter_batch_records(str(tmp / "in.jsonl"))]
+            if ids != ["PT1:1", "N2"]:
+                print(f"  ✗ Unexpected JSONL record IDs: {ids}")
+                return False
+            
+            # A crash after writing PT1:1 but before checkpointing it, mid-way through N2,
+            # with a corrupt line before PT1:1 that must not cost the results after it
+            output = tmp / "out.jsonl"
+            output.write_text('{"record_id": "PT0:1"}\n{"rec\n{"record_id": "PT1:1"}\n{"record_id": "N2", "summ')
+            checkpoint = tmp / "out.jsonl.checkpoint"
+            checkpoint.write_text("")
+            
+            completed = load_completed(output, checkpoint)
+            if completed != {"PT0:1", "PT1:1"} or not output.read_text().endswith('"PT1:1"}\n'):
+                print(f"  ✗ Unexpected resume state: {completed}")
+                return False
+        
+        print("  ✓ Directory/JSONL input and crash recovery work")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Batch resume error: {e}")
+        return False
+
+
+def test_timing():
+    """Test stage timing collection and histogram export"""
+    print("\nTesting stage timing...")
+    
+    try:
+        from timing import Histogram, collect, ollama_stats, timed
+        
+        with collect() as timings:
+            with timed("embedding"):
+                pass
+            with timed("embedding"):
+                pass
+        with timed("embedding"):
+            pass  # outside collect(): histogram only
+        if list(timings) != ["embedding"]:
+            print(f"  ✗ Unexpected timings: {timings}")
+            return False
+        
+        histogram = Histogram("test_seconds", "Test", "stage", buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe("generation", value)
+        rendered = histogram.render()
+        for line in ('le="0.1"} 1', 'le="1"} 2', 'le="+Inf"} 3', 'test_seconds_count{stage="generation"} 3'):
+            if line not in rendered:
+                print(f"  ✗ Missing '{line}' in histogram output")
+                return False
+        
+        stats = ollama_stats({"eval_count": 120, "eval_duration": 2_000_000_000})
+        if stats["eval_duration"] != 2.0 or stats["eval_tokens_per_sec"] != 60.0:
+            print(f"  ✗ Unexpected Ollama stats: {stats}")
+            return False
+        
+        print("  ✓ Timings collected and exported as histograms")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Timing error: {e}")
+        return False
+
+
+def test_memory_index():
+    """Test exact cosine top-k of the in-memory retrieval path"""
+    print("\nTesting in-memory index...")
+    
+    try:
+        import numpy as np
+        from retriever import InMemoryIndex
+        
+        chunks = [
+            {"id": f"P:N:{i}", "chunk_id": f"chunk_{i + 1}", "section": "HPI", "text": str(i)}
+            for i in range(4)
+        ]
+        embeddings = np.array([[1, 0], [0, 3], [1, 1], [-1, 0]], dtype=np.float32)
+        index = InMemoryIndex(chunks, embeddings)
+        
+        results = index.search([0.0, 2.0], k=3, diverse=False)
+        if [r["chunk_id"] for r in results] != ["chunk_2", "chunk_3", "chunk_1"]:
+            print(f"  ✗ Unexpected ranking: {[r['chunk_id'] for r in results]}")
+            return False
+        if abs(results[0]["distance"]) > 1e-6 or len(index.search([1.0, 0.0], k=10, diverse=False)) != 4:
+            print("  ✗ Unexpected distances or k handling")
+            return False
+        
+        print("  ✓ Exact cosine ranking without the vector DB")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ In-memory index error: {e}")
+        return False
+
+
+def test_evidence_offsets():
+    """Test chunk offsets into the note and quote-based citation offsets"""
+    print("\nTesting evidence offsets...")
+    
+    try:
+        from chunker import ClinicalNoteChunker
+        from generator import ClinicalGenerator
+        from sample_notes import SAMPLE_NOTES
+        
+        note = list(SAMPLE_NOTES.values())[0]
+        chunks = ClinicalNoteChunker(chunk_size=30, overlap=5).process_note(note, "TEST001")
+        if any(note[chunk["start"]:chunk["end"]] != chunk["text"] for chunk in chunks):
+            print("  ✗ Chunk text is not the note slice at its offsets")
+            return False
+        
+        chunk = chunks[1]
+        quote = chunk["text"].split()[2:6]
+        result = {
+            "summary": {"text": [], "supporting_evidence": [
+                {"chunk_id": chunk["chunk_id"], "offset": [0, 5], "quote": "  ".join(quote).upper()},
+                {"chunk_id": chunk["chunk_id"], "offset": [0, 5], "quote": "not in the note"}
+            ]},
+            "differential": []
+        }
+        with temporary_config(GENERATION_CACHE_ENABLED=False):
+            generator = ClinicalGenerator()
+        counts = generator.resolve_offsets(result, chunks)
+        found, missing = result["summary"]["supporting_evidence"]
+        start, end = found["note_offset"]
+        if counts != {"verified": 1, "total": 2} or missing["verified"] or missing["offset"] != [0, 5]:
+            print(f"  ✗ Unexpected verification: {counts}")
+            return False
+        if note[start:end].split() != quote:
+            print(f"  ✗ Resolved span {note[start:end]!r} does not match the quote")
+            return False
+        
+        print(f"  ✓ {len(chunks)} chunks slice the note; quotes resolved to real offsets")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Evidence offset error: {e}")
+        return False
+
+
+def test_evidence_aliases():
+    """Test that citations resolve to the right note when aliases repeat"""
+    print("\nTesting evidence aliases...")
+    
+    try:
+        from chunker import ClinicalNoteChunker
+        from generator import ClinicalGenerator
+        
+        chunker = ClinicalNoteChunker()
+        first = chunker.process_note("HPI:\nFever and cough.", "PT1", encounter_id="E1")
+        second = chunker.process_note("HPI:\nChest pain on exertion.", "PT1", encounter_id="E1")
+        if first[0]["note_id"] == second[0]["note_id"] or first[0]["chunk_id"] != second[0]["chunk_id"]:
+            print("  ✗ Un-IDed notes of one encounter share a note_id")
+            return False
+        
+        with temporary_config(GENERATION_CACHE_ENABLED=False):
+            generator = ClinicalGenerator()
+        chunks = first + second
+        prompt = generator.format_chunks_for_prompt(chunks)
+        result = {"summary": {"text": [], "supporting_evidence": [
+            {"chunk_id": "E2", "offset": [0, 5], "quote": "Chest pain"}
+        ]}, "differential": []}
+        generator.resolve_chunk_ids(result, chunks)
+        counts = generator.resolve_offsets(result, chunks)
+        evidence = result["summary"]["supporting_evidence"][0]
+        
+        if "CHUNK_ID: E2" not in prompt or "chunk_1" in prompt:
+            print("  ✗ Prompt does not use per-prompt aliases")
+            return False
+        if evidence.get("source_id") != second[0]["id"] or counts["verified"] != 1:
+            print(f"  ✗ Citation resolved to the wrong chunk: {evidence}")
+            return False
+        
+        print("  ✓ Per-prompt aliases resolve to the cited note; note IDs default to a text hash")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Evidence alias error: {e}")
+        return False
+
+
+def test_token_chunking():
+    """Test token-count chunking: windows stay within the embedding model's limit"""
+    print("\nTesting token-aware chunking...")
+    
+    try:
+        import re
+        from chunker import ClinicalNoteChunker
+        from sample_notes import SAMPLE_NOTES
+        
+        # Deterministic word-piece tokenizer (4-character pieces), so the test
+        # needs no model download; the real one is loaded from the embedding model
+        def tokenize(texts, **kwargs):
+            return {"offset_mapping": [
+                [(start, min(start + 4, word.end()))
+                 for word in re.finditer(r'\S+', text) for start in range(word.start(), word.end(), 4)]
+                for text in texts
+            ]}
+        
+        class PieceChunker(ClinicalNoteChunker):
+            tokenizer = property(lambda self: tokenize)
+        
+        with temporary_config(EMBEDDING_MAX_TOKENS=42):
+            chunker = PieceChunker(chunk_size=512, overlap=8, unit="tokens")
+        if chunker.chunk_size != 40:
+            print(f"  ✗ Chunk size not capped at the model limit: {chunker.chunk_size}")
+            return False
+        
+        note = list(SAMPLE_NOTES.values())[0]
+        chunks = chunker.process_note(note, "TEST001")
+        sizes = [len(tokenize([chunk["text"]])["offset_mapping"][0]) for chunk in chunks]
+        if max(sizes) > 40 or any(note[c["start"]:c["end"]] != c["text"] for c in chunks):
+            print(f"  ✗ Chunk over the token limit or not a note slice (max {max(sizes)} tokens)")
+            return False
+        
+        words = PieceChunker(chunk_size=40, overlap=8, unit="words").process_note(note, "TEST001")
+        if len(chunks) <= len(words):
+            print("  ✗ Token windows are not smaller than word windows of the same size")
+            return False
+        
+        print(f"  ✓ {len(chunks)} chunks of at most {max(sizes)} tokens (limit 40)")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Token chunking error: {e}")
+        return False
+
+
+def test_note_manifest():
+    """Test the per-note manifest used for incremental re-indexing"""
+    print("\nTesting note manifest...")
+    
+    try:
+        import tempfile
+        from manifest import NoteManifest
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = NoteManifest(path=os.path.join(tmp, "manifest.db"), collection="test")
+            record = NoteManifest.record({"chunk_id": "chunk_1", "section": "HPI", "text": "x", "start": 3, "end": 4})
+            manifest.put("P1", "E1", "N1", {"P1:N1:a": record})
+            manifest.put("P1", "E2", "N2", {"P1:N2:b": record})
+            
+            if manifest.get("P1", "N1") != {"P1:N1:a": record} or "text" in record:
+                print("  ✗ Manifest entry not stored as written")
+                return False
+            
+            manifest.delete("P1", encounter_id="E1")
+            if manifest.get("P1", "N1") is not None or manifest.get("P1", "N2") is None:
+                print("  ✗ Encounter-scoped delete removed the wrong notes")
+                return False
+            
+            manifest.clear()
+            remaining = len(manifest)
+            manifest.close()
+        
+        if remaining:
+            print("  ✗ Clear left entries behind")
+            return False
+        
+        print("  ✓ Per-note manifest stores, scopes and clears entries")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Note manifest error: {e}")
+        return False
+
+
+def test_incremental_indexing():
+    """Test re-indexing a revised note: only new chunks embedded, vanished ones deleted"""
+    print("\nTesting incremental re-indexing...")
+    
+    try:
+        import tempfile
+        import numpy as np
+        from chunker import ClinicalNoteChunker
+        from retriever import ClinicalRAGRetriever
+        
+        class CountingEncoder:
+            """Embedding-batcher hook recording every text sent to the model"""
+            def __init__(self):
+                self.texts = []
+            
+            def encode(self, texts):
+                self.texts.extend(texts)
+                return np.array([[len(text), text.count(" "), 1.0] for text in texts], dtype=np.float32)
+        
+        chunker = ClinicalNoteChunker(chunk_size=8, overlap=2)
+        v1 = ("HPI:\nThree days of fever and productive cough with dyspnea on exertion.\n"
+              "Labs:\nWBC 15.2, CRP 85, lactate 1.1, creatinine 0.9 mg/dL.\n"
+              "Assessment:\nCommunity-acquired pneumonia of the right lower lobe.\n")
+        # New leading section (renumbers every alias), revised labs, same HPI and assessment
+        v2 = ("Chief Complaint:\nFever.\n" + v1).replace("WBC 15.2, CRP 85", "WBC 11.0, CRP 40")
+        
+        with tempfile.TemporaryDirectory() as tmp, temporary_config(
+            VECTOR_DB_PATH=tmp, INDEX_MANIFEST_PATH="", COLLECTION_NAME="incremental_test",
+            EMBEDDING_CACHE_ENABLED=False
+        ):
+            retriever = ClinicalRAGRetriever()
+            encoder = CountingEncoder()
+            retriever.embedding_batcher = encoder
+            retriever.create_collection()
+            
+            first = chunker.process_note(v1, "PT1", "ENC1", "N1")
+            retriever.index_note_chunks(first, "PT1", "ENC1", "N1")
+            encoder.texts.clear()
+            
+            second = chunker.process_note(v2, "PT1", "ENC1", "N1")
+            changes = retriever.index_note_chunks(second, "PT1", "ENC1", "N1")
+            old_ids = {chunk["id"] for chunk in first}
+            new_chunks = [chunk for chunk in second if chunk["id"] not in old_ids]
+            stored = retriever.collection.get(where={"note_id": "N1"})
+            kept = next(chunk for chunk in second if chunk["id"] in old_ids)
+            kept_alias = retriever.collection.get(ids=[kept["id"]])["metadatas"][0]["chunk_id"]
+            
+            if sorted(encoder.texts) != sorted(chunk["text"] for chunk in new_chunks):
+                print(f"  ✗ Embedded {len(encoder.texts)} texts, expected only the {len(new_chunks)} new chunks")
+                return False
+            if set(stored["ids"]) != {chunk["id"] for chunk in second}:
+                print("  ✗ Stored chunks do not match the revised note")
+                return False
+            if changes["removed"] != len(old_ids - set(stored["ids"])) or not changes["removed"] or not changes["moved"]:
+                print(f"  ✗ Unexpected change counts: {changes}")
+                return False
+            if kept_alias != kept["chunk_id"]:
+                print(f"  ✗ Renumbered chunk kept alias {kept_alias}, expected {kept['chunk_id']}")
+                return False
+            
+            encoder.texts.clear()
+            unchanged = retriever.index_note_chunks(second, "PT1", "ENC1", "N1")
+            if encoder.texts or unchanged["added"] or unchanged["removed"]:
+                print(f"  ✗ Re-indexing an unchanged note did work: {unchanged}")
+                return False
+            
+            # prune_note drops stored chunks missing from the given records
+            records = {chunk["id"]: retriever.manifest.record(chunk) for chunk in second[:-1]}
+            retriever.prune_note("PT1", "ENC1", "N1", records)
+            if second[-1]["id"] in retriever.collection.get(where={"note_id": "N1"})["ids"]:
+                print("  ✗ prune_note left a dropped chunk in the vector DB")
+                return False
+            if set(retriever.manifest.get("PT1", "N1")) != set(records):
+                print("  ✗ prune_note did not update the manifest")
+                return False
+
+            # The manifest follows the active collection, so the same note is
+            # indexed in full into a second one
+            retriever.get_collection("incremental_other")
+            copied = retriever.index_note_chunks(second, "PT1", "ENC1", "N1")
+            if copied["added"] != len(second) or retriever.collection.count() != len(second):
+                print(f"  ✗ Second collection stored {retriever.collection.count()} chunks: {copied}")
+                return False
+            retriever.get_collection()
+            if set(retriever.manifest.get("PT1", "N1")) != set(records):
+                print("  ✗ Switching collections lost the first collection's manifest entry")
+                return False
+            retriever.manifest.close()
+        
+        print(f"  ✓ Revised note: {changes['added']} embedded, {changes['removed']} deleted, "
+              f"{changes['moved']} renumbered, {changes['unchanged']} untouched; prune_note works")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Incremental indexing error: {e}")
+        return False
+
+
+def test_bulk_ingest():
+    """Test bulk ingest counts: duplicates skipped, revised notes partly re-embedded"""
+    print("\nTesting bulk ingest...")
+    
+    try:
+        import tempfile
+        import numpy as np
+        from ingest import BulkIngestor
+        from pipeline import ClinicalRAGPipeline
+        
+        class CountingEncoder:
+            """Embedding-batcher hook standing in for the embedding worker pool"""
+            def __init__(self):
+                self.texts = 0
+            
+            def encode(self, texts):
+                self.texts += len(texts)
+                return np.array([[len(text), text.count(" "), 1.0] for text in texts], dtype=np.float32)
+        
+        note_a = "HPI:\nFever and cough for three days.\nAssessment:\nPneumonia."
+        note_b = "HPI:\nChest pain on exertion.\nLabs:\nTroponin 0.01.\nAssessment:\nStable angina."
+        revised_b = note_b.replace("Troponin 0.01", "Troponin 0.45")
+        
+        with tempfile.TemporaryDirectory() as tmp, temporary_config(
+            VECTOR_DB_PATH=tmp, INDEX_MANIFEST_PATH="", COLLECTION_NAME="ingest_test",
+            EMBEDDING_CACHE_ENABLED=False
+        ):
+            pipeline = ClinicalRAGPipeline()
+            pipeline.retriever.create_collection()
+            
+            # One ingestor for both runs: counts and errors are per run
+            encoder = CountingEncoder()
+            ingestor = BulkIngestor(pipeline, chunk_workers=1, embed_workers=1,
+                                    threads_per_worker=1, encoder=encoder)
+            
+            def ingest(records):
+                return ingestor.ingest(records), ingestor.errors
+            
+            first, _ = ingest([
+                {"note": note_a, "patient_id": "PT1", "record_id": "a.txt"},
+                {"note": note_b, "patient_id": "PT1", "record_id": "b.txt"},
+                {"note": None, "patient_id": "PT1", "record_id": "empty.txt"},
+            ])
+            second, errors = ingest([
+                {"note": note_a, "patient_id": "PT1", "record_id": "a.txt"},
+                {"note": revised_b, "patient_id": "PT1", "record_id": "b.txt"},
+                {"note": None, "patient_id": "PT1", "record_id": "broken.txt"},
+            ])
+            stored = pipeline.retriever.collection.count()
+            pipeline.retriever.manifest.close()
+        
+        if first["notes"] != 2 or first["embedded_texts"] != first["chunks"] or first["errors"] != 1:
+            print(f"  ✗ Unexpected first ingest: {first}")
+            return False
+        if (second["notes"], second["unchanged"], second["errors"]) != (2, 1, 1) or [e["record_id"] for e in errors] != ["broken.txt"]:
+            print(f"  ✗ Unexpected re-ingest: {second}, errors {errors}")
+            return False
+        if second["embedded_texts"] != 1 or second["reused_chunks"] != second["chunks"] - 1 or stored != first["chunks"]:
+            print(f"  ✗ Revised note re-embedded {second['embedded_texts']} chunks, expected only the changed one")
+            return False
+        
+        print(f"  ✓ {first['chunks']} chunks ingested; re-ingest reused {second['reused_chunks']}, "
+              f"embedded 1, reported 1 error")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Bulk ingest error: {e}")
+        return False
+
+
+def test_lexical_index():
+    """Test BM25 keyword search, incremental updates and rank fusion"""
+    print("\nTesting lexical index...")
+    
+    try:
+        from lexical import BM25Index, reciprocal_rank_fusion
+        
+        index = BM25Index()
+        index.add("a", "Metformin 1000mg BID", patient_id="P1")
+        index.add("b", "Lisinopril 10mg daily", patient_id="P1")
+        index.add("c", "Metformin held for AKI", patient_id="P2")
+        
+        hits = index.search("metformin 1000 mg", k=3)
+        if [key for key, _ in hits][:2] != ["a", "c"]:
+            print(f"  ✗ Unexpected keyword ranking: {hits}")
+            return False
+        if [key for key, _ in index.search("metformin", k=3, patient_id="P2")] != ["c"]:
+            print("  ✗ Patient scope not applied")
+            return False
+        
+        index.remove(["a"])
+        index.add("b", "Lisinopril 20mg daily", patient_id="P1")
+        if index.search("1000", k=3) or len(index) != 2 or not index.search("20mg", k=1):
+            print("  ✗ Removed or re-indexed chunks still match old text")
+            return False
+        
+        fused = [key for key, _ in reciprocal_rank_fusion([["x", "y"], ["y", "z"]])]
+        if fused != ["y", "x", "z"]:
+            print(f"  ✗ Unexpected fusion order: {fused}")
+            return False
+        
+        print("  ✓ BM25 ranking, scoping, updates and reciprocal rank fusion")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Lexical index error: {e}")
+        return False
+
+
+def test_hybrid_retrieval():
+    """Test keyword and hybrid retrieval on retrievers that have not opened a collection"""
+    print("\nTesting hybrid retrieval...")
+    
+    try:
+        import tempfile
+        import threading
+        import numpy as np
+        from chunker import ClinicalNoteChunker
+        from retriever import ClinicalRAGRetriever
+        
+        class HashEncoder:
+            """Embedding-batcher hook giving each text a fixed pseudo-random vector"""
+            def encode(self, texts):
+                return np.array([
+                    np.random.default_rng(sum(map(ord, text))).random(8) for text in texts
+                ], dtype=np.float32)
+        
+        def fresh_retriever():
+            retriever = ClinicalRAGRetriever()
+            retriever.embedding_batcher = HashEncoder()
+            return retriever
+        
+        def run(fn):
+            """Call fn on a thread; a deadlock shows up as a timeout instead of a hung suite"""
+            outcome = {}
+            thread = threading.Thread(target=lambda: outcome.update(value=fn()), daemon=True)
+            thread.start()
+            thread.join(timeout=60)
+            if thread.is_alive():
+                raise TimeoutError("retrieval did not return (deadlock?)")
+            return outcome["value"]
+        
+        note = ("HPI:\nChest pain on exertion.\nLabs:\nTroponin 0.45, Metformin 1000mg held.\n"
+                "Assessment:\nNSTEMI.")
+        with tempfile.TemporaryDirectory() as tmp, temporary_config(
+            VECTOR_DB_PATH=tmp, INDEX_MANIFEST_PATH="", COLLECTION_NAME="hybrid_test",
+            EMBEDDING_CACHE_ENABLED=False, HYBRID_RETRIEVAL=True
+        ):
+            # No collection exists yet: the first keyword search has to create it
+            empty = run(lambda: fresh_retriever().keyword_search("troponin", k=3))
+            
+            writer = fresh_retriever()
+            writer.index_note_chunks(
+                ClinicalNoteChunker().process_note(note, "PT1", note_id="N1"), "PT1", "unknown", "N1"
+            )
+            writer.manifest.close()
+            
+            reader = fresh_retriever()
+            keyword = run(lambda: reader.keyword_search("metformin 1000 mg", k=3, patient_id="PT1"))
+            hybrid = run(lambda: fresh_retriever().retrieve(query="troponin", k=2, patient_id="PT1"))
+        
+        if empty:
+            print(f"  ✗ Empty collection returned keyword hits: {empty}")
+            return False
+        if not keyword or not hybrid or "Troponin" not in hybrid[0]["text"] or "rrf_score" not in hybrid[0]:
+            print(f"  ✗ Keyword hit not found or not fused: {keyword}, {hybrid}")
+            return False
+        
+        print("  ✓ keyword_search and hybrid retrieve work on an uninitialised retriever")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ Hybrid retrieval error: {e}")
+        return False
+
+
+def test_mmr_selection():
+    """Test diverse top-k: MMR, near-duplicate removal and section quotas"""
+    print("\nTesting MMR selection...")
+    
+    try:
+        import numpy as np
+        from retriever import mmr_select
+        
+        # Two overlapping windows of one passage, then two other sections
+        embeddings = np.array([[1, 0.05, 0], [1, 0.06, 0], [0.6, 0.8, 0], [0.5, 0, 0.87]], dtype=np.float32)
+        relevance = np.array([0.95, 0.94, 0.7, 0.6], dtype=np.float32)
+        sections = ["Labs", "Labs", "Assessment", "Plan"]
+        
+        if mmr_select(relevance, embeddings, 3, lambda_mult=1.0, redundancy=1.0, section_quota=0) != [0, 1, 2]:
+            print("  ✗ lambda 1.0 is not plain top-k")
+            return False
+        picks = mmr_select(relevance, embeddings, 3, lambda_mult=0.5, redundancy=1.0, section_quota=0)
+        if picks != [0, 3, 2]:
+            print(f"  ✗ Near-duplicate window not demoted: {picks}")
+            return False
+        picks = mmr_select(relevance, embeddings, 4, lambda_mult=1.0, redundancy=0.99, section_quota=0)
+        if picks != [0, 2, 3]:
+            print(f"  ✗ Near-duplicate not dropped: {picks}")
+            return False
+        picks = mmr_select(relevance, embeddings, 4, lambda_mult=1.0, redundancy=1.0,
+                           sections=sections, section_quota=1)
+        if picks != [0, 2, 3]:
+            print(f"  ✗ Section quota not applied: {picks}")
+            return False
+        
+        print("  ✓ MMR re-ranking, near-duplicate removal and section quota")
+        return True
+        
+    except Exception as e:
+        print(f"  ✗ MMR selection error: {e}")
+        return False
+
+
 def main():
     """Run all tests"""
     print("=" * 70)
@@ -159,6 +1211,69 @@ def main():
     # Test chunker
     results.append(("Chunker", test_chunker()))
     
+    # Test CLI startup
+    results.append(("Startup", test_startup()))
+    
+    # Test embedding cache
+    results.append(("Embedding Cache", test_embedding_cache()))
+    
+    # Test generation cache
+    results.append(("Generation Cache", test_generation_cache()))
+    
+    # Test streaming JSON parser
+    results.append(("Streaming Parser", test_json_stream()))
+    
+    # Test structured output schema
+    results.append(("Structured Output", test_structured_output()))
+    
+    # Test batch analysis ordering and backpressure
+    results.append(("Batch Analysis", test_analyze_notes()))
+    
+    # Test async generation
+    results.append(("Async Generation", test_async_generation()))
+    
+    # Test embedding batching in the HTTP service
+    results.append(("Embedding Batcher", test_embedding_batcher()))
+    
+    # Test the HTTP service endpoints
+    results.append(("HTTP Service", test_http_service()))
+    
+    # Test batch input and resume
+    results.append(("Batch Resume", test_batch_resume()))
+    
+    # Test stage timing
+    results.append(("Stage Timing", test_timing()))
+    
+    # Test in-memory retrieval
+    results.append(("In-Memory Index", test_memory_index()))
+    
+    # Test citation offsets
+    results.append(("Evidence Offsets", test_evidence_offsets()))
+    
+    # Test citation aliases across notes
+    results.append(("Evidence Aliases", test_evidence_aliases()))
+    
+    # Test token-aware chunking
+    results.append(("Token Chunking", test_token_chunking()))
+    
+    # Test incremental indexing manifest
+    results.append(("Note Manifest", test_note_manifest()))
+    
+    # Test incremental re-indexing of a revised note
+    results.append(("Incremental Indexing", test_incremental_indexing()))
+    
+    # Test the bulk ingest engine
+    results.append(("Bulk Ingest", test_bulk_ingest()))
+    
+    # Test hybrid retrieval keyword index
+    results.append(("Lexical Index", test_lexical_index()))
+    
+    # Test hybrid retrieval on an uninitialised retriever
+    results.append(("Hybrid Retrieval", test_hybrid_retrieval()))
+    
+    # Test diverse top-k selection
+    results.append(("MMR Selection", test_mmr_selection()))
+    
     # Summary
     print("\n" + "=" * 70)
     print("Test Summary")
@@ -0,0 +1,172 @@
+"""
+Per-stage latency instrumentation for the Clinical RAG System
+Stage wall times are attached to each result's model_metadata and aggregated
+into process-wide Prometheus-style histograms
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence
+
+# Stages recorded by the pipeline, in execution order
+STAGES = ("chunking", "embedding", "vector_add", "retrieval", "http_generation", "json_parse")
+
+# Ollama response fields; durations are reported in nanoseconds
+OLLAMA_COUNT_FIELDS = ("prompt_eval_count", "eval_count")
+OLLAMA_DURATION_FIELDS = ("load_duration", "prompt_eval_duration", "eval_duration", "total_duration")
+
+# Timings dict of the analyze call running in this thread/task, if any
+_active_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "stage_timings", default=None
+)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one label, rendered in Prometheus text format"""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: Sequence[float]):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., +Inf count], sum
+        self._counts: Dict[str, list] = {}
+        self._sums: Dict[str, float] = {}
+
+    def observe(self, label_value: str, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(label_value, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self._sums[label_value] = self._sums.get(label_value, 0.0) + value
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Count, sum and mean per label value"""
+        with self._lock:
+            result = {}
+            for label_value, counts in self._counts.items():
+                count = sum(counts)
+                total = self._sums[label_value]
+                result[label_value] = {"count": count, "sum": total, "mean": total / count}
+            return result
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value in sorted(self._counts):
+                counts = self._counts[label_value]
+                label = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {cumulative}')
+                cumulative += counts[-1]
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{label}}} {self._sums[label_value]:.6f}')
+                lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "clinical_rag_stage_seconds",
+    "Wall time per pipeline stage",
+    "stage",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+OLLAMA_TOKENS = Histogram(
+    "clinical_rag_ollama_tokens",
+    "Tokens processed per Ollama generation",
+    "kind",
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+)
+
+OLLAMA_SECONDS = Histogram(
+    "clinical_rag_ollama_seconds",
+    "Ollama-reported durations per generation",
+    "phase",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+
+def record(stage: str, seconds: float, timings: Dict[str, float] = None):
+    """Add `seconds` to a stage in `timings` (or the active collection) and the histogram"""
+    target = timings if timings is not None else _active_timings.get()
+    if target is not None:
+        target[stage] = target.get(stage, 0.0) + seconds
+    STAGE_SECONDS.observe(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str, timings: Dict[str, float] = None) -> Iterator[None]:
+    """Time the enclosed block as `stage`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, timings)
+
+
+@contextmanager
+def collect(timings: Dict[str, float] = None) -> Iterator[Dict[str, float]]:
+    """
+    Route timed() blocks in this thread/task into `timings`
+
+    Lets deep calls (retriever embedding, vector DB writes) report stages
+    without threading a timings argument through every signature.
+    """
+    timings = timings if timings is not None else {}
+    token = _active_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _active_timings.reset(token)
+
+
+def ollama_stats(response_data: Dict) -> Dict[str, float]:
+    """
+    Token counts and durations (seconds) reported by Ollama for one generation
+
+    Also observes them in the Ollama histograms.
+    """
+    stats = {}
+    for field in OLLAMA_COUNT_FIELDS:
+        if response_data.get(field) is not None:
+            stats[field] = response_data[field]
+            OLLAMA_TOKENS.observe(field.replace("_count", ""), response_data[field])
+    for field in OLLAMA_DURATION_FIELDS:
+        if response_data.get(field) is not None:
+            seconds = response_data[field] / 1e9
+            stats[field] = round(seconds, 6)
+            OLLAMA_SECONDS.observe(field.replace("_duration", ""), seconds)
+
+    if stats.get("eval_count") and stats.get("eval_duration"):
+        stats["eval_tokens_per_sec"] = round(stats["eval_count"] / stats["eval_duration"], 2)
+    return stats
+
+
+def rounded(timings: Dict[str, float]) -> Dict[str, float]:
+    """Timings in stage order, rounded for output"""
+    ordered = [stage for stage in STAGES if stage in timings]
+    ordered += [stage for stage in timings if stage not in STAGES]
+    return {stage: round(timings[stage], 6) for stage in ordered}
+
+
+def render_prometheus() -> str:
+    """All timing histograms in Prometheus text format"""
+    return "".join(h.render() for h in (STAGE_SECONDS, OLLAMA_TOKENS, OLLAMA_SECONDS))
+
+
+if __name__ == "__main__":
+    # Test the timing helpers
+    with collect() as timings:
+        with timed("chunking"):
+            time.sleep(0.01)
+        with timed("embedding"):
+            time.sleep(0.02)
+    print(f"Timings: {rounded(timings)}")
+    print(f"Ollama: {ollama_stats({'eval_count': 200, 'eval_duration': 4_000_000_000})}")
+    print(render_prometheus())